@@ -0,0 +1,74 @@
+from math import gcd
+from functools import lru_cache
+import numpy as np
+import soundfile as sf
+import metrics
+
+
+@lru_cache(maxsize=16)
+def _polyphase_filter(up, down):
+    # Same Kaiser-windowed low-pass resample_poly designs by default, built once per rate pair;
+    # scipy is only imported once a recording needs resampling
+    from scipy.signal import firwin
+
+    max_rate = max(up, down)
+    taps = firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=('kaiser', 5.0)).astype(np.float32)
+    taps.setflags(write=False)
+    return taps
+
+
+@metrics.timed("preprocess")
+def resample_window(audio, sr, target_sr=48000):
+    """Polyphase-resample a mono float32 window from sr to target_sr."""
+    if sr == target_sr:
+        return audio
+    from scipy.signal import resample_poly
+
+    divisor = gcd(int(sr), int(target_sr))
+    up, down = int(target_sr) // divisor, int(sr) // divisor
+    return resample_poly(audio, up, down, window=_polyphase_filter(up, down)).astype(np.float32, copy=False)
+
+
+def fit_length(audio, length):
+    if len(audio) < length:
+        return np.pad(audio, (0, length - len(audio)))
+    return audio[:length]
+
+
+def read_first_window(source, target_sr=48000, duration_sec=3):
+    """
+    Return the first duration_sec of a recording as a (1, target_sr * duration_sec) float32 array.
+
+    Only the frames that make up the window are decoded, straight to float32.
+    """
+    with metrics.stage("decode"), sf.SoundFile(source) as f:
+        sr = f.samplerate
+        block = f.read(frames=int(np.ceil(duration_sec * sr)), dtype='float32', always_2d=True)
+    audio = resample_window(block.mean(axis=1), sr, target_sr)
+    return np.expand_dims(fit_length(audio, target_sr * duration_sec), axis=0)
+
+
+def iter_windows(source, target_sr=48000, duration_sec=3, overlap_sec=1.5):
+    """
+    Yield overlapping duration_sec float32 windows of a recording, resampled to target_sr.
+
+    The file is read block-by-block with soundfile, so memory stays bounded by
+    one window regardless of the recording length.
+    """
+    required_len = target_sr * duration_sec
+    with sf.SoundFile(source) as f:
+        sr = f.samplerate
+        window_len = int(round(duration_sec * sr))
+        hop_len = max(1, int(round((duration_sec - overlap_sec) * sr)))
+        overlap_len = window_len - hop_len
+
+        blocks = f.blocks(blocksize=window_len, overlap=overlap_len, dtype='float32', always_2d=True)
+        first = True
+        while True:
+            with metrics.stage("decode"):
+                block = next(blocks, None)
+            # A trailing block fully covered by the previous window adds nothing new
+            if block is None or (not first and len(block) <= overlap_len):
+                break
+            first = False
+            yield fit_length(resample_window(block.mean(axis=1), sr, target_sr), required_len)
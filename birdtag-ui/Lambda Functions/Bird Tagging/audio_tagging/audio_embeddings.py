@@ -0,0 +1,286 @@
+import os
+import argparse
+import numpy as np
+import boto3
+from boto3.dynamodb.conditions import Attr
+import index_snapshot
+import metrics
+
+region = os.environ.get("AWS_REGION", "ap-southeast-2")
+s3 = boto3.client('s3', region_name=region)
+
+# === Embedding settings ===
+# Each tagged recording stores the mean of its L2-normalised window embeddings (normalised
+# again) as float16 bytes in the birds_table "embedding" attribute. AUDIO_EMBEDDINGS=off skips it.
+embeddings_enabled = os.environ.get("AUDIO_EMBEDDINGS", "on") != "off"
+birds_table_name = os.environ.get("BIRDS_TABLE", "birds_table")
+
+# === Nearest-neighbour index settings ===
+# IVF-PQ: a coarse k-means quantizer picks nprobe lists, and the residuals in them are
+# compared through product-quantized codes (pq_m bytes per recording). One file, memory-mapped.
+ann_bucket = os.environ.get("AUDIO_ANN_BUCKET", "g116-models-s3")
+ann_key = os.environ.get("AUDIO_ANN_KEY", "embeddings/audio_ann.bin")
+ann_path = "/tmp/audio_ann.bin"
+refresh_seconds = float(os.environ.get("AUDIO_ANN_REFRESH_SECONDS", "300"))
+nprobe = int(os.environ.get("AUDIO_ANN_NPROBE", "16"))
+pq_m = int(os.environ.get("AUDIO_ANN_PQ_M", "64"))
+train_sample = int(os.environ.get("AUDIO_ANN_TRAIN_SAMPLE", "65536"))
+default_top_k = int(os.environ.get("AUDIO_ANN_TOP_K", "20"))
+
+_magic = b"BTANN001"
+
+
+def embedding_version(runtime):
+    """Cache version suffix: results carry an embedding only when this is non-empty."""
+    if not embeddings_enabled or runtime.embedding_index is None:
+        return ""
+    return f":emb:{runtime.embedding_dim}"
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def encode(vector):
+    return normalize(vector).astype('<f2').tobytes()
+
+
+def decode(raw):
+    # boto3 hands DynamoDB binary attributes back as Binary, whose bytes are in .value
+    raw = getattr(raw, 'value', raw)
+    return np.frombuffer(bytes(raw), dtype='<f2').astype(np.float32)
+
+
+class EmbeddingPool:
+    """Mean of the L2-normalised window embeddings of one recording."""
+
+    def __init__(self):
+        self.total = None
+        self.windows = 0
+
+    def add(self, embeddings):
+        if embeddings is None or not len(embeddings):
+            return
+        summed = normalize(embeddings).sum(axis=0)
+        self.total = summed if self.total is None else self.total + summed
+        self.windows += len(embeddings)
+
+    def encoded(self):
+        """float16 bytes of the pooled embedding, or None if no window was seen."""
+        return encode(self.total) if self.windows else None
+
+
+def pool_for(runtime):
+    """An EmbeddingPool when embeddings are on and the model exposes them, else None."""
+    return EmbeddingPool() if embedding_version(runtime) else None
+
+
+# === k-means and product quantization ===
+
+def nearest(x, centroids, chunk=16384):
+    """Index of the nearest centroid (squared L2) for every row of x."""
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    out = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk):
+        block = x[start:start + chunk]
+        out[start:start + chunk] = np.argmin(centroid_norms - 2 * block @ centroids.T, axis=1)
+    return out
+
+
+def kmeans(x, k, iterations=20, rng=None):
+    rng = rng or np.random.default_rng(0)
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = nearest(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        order = np.argsort(assign, kind='stable')
+        present = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[present]
+        centroids[present] = np.add.reduceat(x[order], starts, axis=0) / counts[present, None]
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            # Reseed empty clusters on random points rather than letting them die
+            centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+    return centroids
+
+
+def subspaces(dim, m):
+    """Largest sub-quantizer count <= m that divides dim."""
+    m = max(1, min(m, dim))
+    while dim % m:
+        m -= 1
+    return m
+
+
+def train_pq(residuals, m, rng=None):
+    """Return (m, ksub, dim / m) codebooks, ksub <= 256 so a code fits a byte."""
+    sub = residuals.shape[1] // m
+    ksub = min(256, len(residuals))
+    return np.stack([
+        kmeans(np.ascontiguousarray(residuals[:, j * sub:(j + 1) * sub]), ksub, rng=rng)
+        for j in range(m)
+    ])
+
+
+def encode_pq(residuals, codebooks):
+    m, _, sub = codebooks.shape
+    codes = np.empty((len(residuals), m), dtype=np.uint8)
+    for j in range(m):
+        codes[:, j] = nearest(np.ascontiguousarray(residuals[:, j * sub:(j + 1) * sub]), codebooks[j])
+    return codes
+
+
+# === Index file ===
+# An index_snapshot file with these arrays:
+#   centroids  float32 [nlist, dim]     coarse quantizer
+#   codebooks  float32 [m, ksub, dim/m] residual product quantizer
+#   list_ptr   int64   [nlist + 1]      recordings of list i are rows list_ptr[i]:list_ptr[i+1]
+#   codes      uint8   [items, m]
+#   keys       S<w>    [items]          "id\tfile_type", in list order
+
+def build_index(path, keys, vectors, nlist=None, m=None, rng=None):
+    """Train and write an IVF-PQ index of unit vectors[i] for keys[i]; returns the header."""
+    rng = rng or np.random.default_rng(0)
+    vectors = normalize(vectors)
+    n, dim = vectors.shape
+    nlist = nlist or int(np.clip(4 * np.sqrt(n), 1, 4096))
+    m = subspaces(dim, m or pq_m)
+
+    sample = vectors[rng.choice(n, min(n, train_sample), replace=False)]
+    centroids = kmeans(sample, nlist, rng=rng)
+    sample_lists = nearest(sample, centroids)
+    codebooks = train_pq(sample - centroids[sample_lists], m, rng=rng)
+
+    lists = nearest(vectors, centroids)
+    order = np.argsort(lists, kind='stable')
+    codes = encode_pq(vectors[order] - centroids[lists[order]], codebooks)
+    list_ptr = np.zeros(len(centroids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(lists, minlength=len(centroids)), out=list_ptr[1:])
+
+    arrays = {
+        'centroids': centroids.astype(np.float32),
+        'codebooks': codebooks.astype(np.float32),
+        'list_ptr': list_ptr,
+        'codes': codes,
+        'keys': index_snapshot.encode_keys([keys[i] for i in order]),
+    }
+    header = {'items': n, 'dim': dim, 'nlist': len(centroids), 'm': m}
+    return index_snapshot.write_file(path, _magic, header, arrays)
+
+
+class AnnIndex:
+    """Approximate nearest recordings by cosine similarity over a memory-mapped IVF-PQ file."""
+
+    def __init__(self, path):
+        header = index_snapshot.read_header(path, _magic, "audio embedding index")
+        self.n_items = header['items']
+        self.dim = header['dim']
+        self.m = header['m']
+        self.arrays = index_snapshot.map_arrays(path, header)
+        # Small and touched by every query, so held in memory
+        self.centroids = np.array(self.arrays['centroids'])
+        self.centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        self.codebooks = np.array(self.arrays['codebooks'])
+        self.codeword_norms = np.einsum('mks,mks->mk', self.codebooks, self.codebooks)
+        self.list_ptr = np.array(self.arrays['list_ptr'])
+
+    def __len__(self):
+        return self.n_items
+
+    def search(self, vector, k=None, probes=None):
+        """Return up to k [(key, approximate cosine similarity)], best first."""
+        k = k or default_top_k
+        q = normalize(vector)
+        if q.shape[-1] != self.dim or self.n_items == 0:
+            return []
+        probes = min(probes or nprobe, len(self.centroids))
+        coarse = self.centroid_norms - 2 * self.centroids @ q
+        lists = np.argpartition(coarse, probes - 1)[:probes]
+        lists = lists[self.list_ptr[lists + 1] > self.list_ptr[lists]]
+        if not len(lists):
+            return []
+
+        # One distance table per probed list: ||r_j - c||^2 = ||r_j||^2 + ||c||^2 - 2 r_j.c for
+        # residual r = q - centroid in every sub-space j, the dot products as one batched matmul
+        m, ksub, sub = self.codebooks.shape
+        residuals = (q - self.centroids[lists]).reshape(len(lists), m, sub)
+        dots = np.matmul(residuals.transpose(1, 0, 2), self.codebooks.transpose(0, 2, 1)).transpose(1, 0, 2)
+        tables = (np.einsum('pms,pms->pm', residuals, residuals)[:, :, None]
+                  + self.codeword_norms[None] - 2 * dots).astype(np.float32)
+
+        # Lists are contiguous runs of codes; each code byte picks its entry of the list's table
+        codes = self.arrays['codes']
+        offsets = np.arange(m, dtype=np.intp) * ksub
+        spans = [(int(self.list_ptr[i]), int(self.list_ptr[i + 1])) for i in lists]
+        rows = np.concatenate([np.arange(start, end) for start, end in spans])
+        distances = np.concatenate([
+            tables[p].ravel()[codes[start:end] + offsets].sum(axis=1)
+            for p, (start, end) in enumerate(spans)
+        ])
+
+        if len(rows) > k:
+            best = np.argpartition(distances, k - 1)[:k]
+            best = best[np.argsort(distances[best])]
+        else:
+            best = np.argsort(distances)
+        keys = self.arrays['keys']
+        # Both are unit vectors, so ||a - b||^2 = 2 - 2 cos
+        return [(keys[rows[i]].decode('utf-8'), float(1 - distances[i] / 2)) for i in best]
+
+
+_warm = index_snapshot.WarmIndex("audio embedding index", ann_bucket, ann_key, ann_path, refresh_seconds, AnnIndex)
+
+
+def get_index():
+    """Return the container's index, or None if none has been built; re-fetched when its ETag changes."""
+    return _warm.get()
+
+
+def similar_recordings(embedding, k=None):
+    """Return up to k [{"id", "file_type", "score"}] that sound like embedding (bytes or array), or None without an index."""
+    index = get_index()
+    if index is None:
+        return None
+    vector = embedding if isinstance(embedding, np.ndarray) else decode(embedding)
+    with metrics.stage("search"):
+        matches = index.search(vector, k)
+    return [
+        {'id': item_id, 'file_type': file_type, 'score': round(score, 4)}
+        for (item_id, file_type), score in ((index_snapshot.parse_key(key), score) for key, score in matches)
+    ]
+
+
+# === Index rebuild ===
+
+def _embedding_entry(item):
+    return index_snapshot.item_key(item['id'], item['file_type']), decode(item['embedding'])
+
+
+def rebuild_index(total_segments=8, path=ann_path):
+    """Scan the stored embeddings into a new IVF-PQ index and upload it."""
+    entries = index_snapshot.parallel_scan(
+        birds_table_name, _embedding_entry, total_segments,
+        ProjectionExpression='id, file_type, embedding', FilterExpression=Attr('embedding').exists(),
+    )
+    if not entries:
+        print("No stored embeddings to index")
+        return None
+    # Recordings embedded by an older model have another dimension; index the current one
+    dims = [len(vector) for _, vector in entries]
+    dim = max(set(dims), key=dims.count)
+    kept = [(key, vector) for key, vector in entries if len(vector) == dim]
+    header = build_index(path, [key for key, _ in kept], np.stack([vector for _, vector in kept]))
+    s3.upload_file(path, ann_bucket, ann_key)
+    print(f"Wrote audio embedding index of {header['items']} recordings ({header['nlist']} lists, "
+          f"{header['m']} bytes each, {os.path.getsize(path)} bytes) to s3://{ann_bucket}/{ann_key}")
+    return header
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the audio embedding index from birds_table.")
+    parser.add_argument("--segments", type=int, default=8, help="Parallel scan segments")
+    args = parser.parse_args()
+    rebuild_index(args.segments)
@@ -0,0 +1,132 @@
+import os
+import json
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus, quote
+import tag_index
+import item_ids
+import media_ingest
+import metrics
+
+region = os.environ.get("AWS_REGION", "ap-southeast-2")
+
+# === Batch ingest settings ===
+# Uploads land under "<type>/<fileName>" (see lambdaa3upload.js)
+media_types = ('image', 'video', 'audio')
+# Conditional birds_table puts in flight per write_items call
+put_concurrency = int(os.environ.get("PIPELINE_PUT_CONCURRENCY", "8"))
+
+
+def media_url(bucket, key):
+    return f"https://{bucket}.s3.{region}.amazonaws.com/{quote(key)}"
+
+
+def media_type(key):
+    """Return image, video or audio for an upload key, from its prefix or else its extension."""
+    prefix = key.split('/', 1)[0]
+    if prefix in media_types:
+        return prefix
+    guessed, _ = mimetypes.guess_type(key)
+    return guessed.split('/')[0] if guessed else None
+
+
+def _from_s3_record(record, identifier):
+    bucket = record['s3']['bucket']['name']
+    # Keys in S3 notifications are URL-encoded with spaces as "+"
+    key = unquote_plus(record['s3']['object']['key'])
+    return {
+        'identifier': identifier,
+        'bucket': bucket,
+        'key': key,
+        'fileName': os.path.basename(key),
+        'type': media_type(key),
+        'originalUrl': media_url(bucket, key),
+        'thumbnailUrl': None,
+    }
+
+
+def _from_tagging_event(body, identifier):
+    bucket, key = media_ingest.parse_s3_url(body['originalUrl'])
+    return {
+        'identifier': identifier,
+        'bucket': bucket,
+        'key': key,
+        'fileName': body.get('fileName') or os.path.basename(key),
+        'type': body.get('type') or media_type(key),
+        'originalUrl': body['originalUrl'],
+        'thumbnailUrl': body.get('thumbnailUrl'),
+    }
+
+
+def parse_records(event):
+    """
+    Turn an SQS batch or S3 event into media references.
+
+    An SQS message body may be a single-file tagging event ({fileName, type,
+    originalUrl, thumbnailUrl}) or an S3 event notification. Each reference
+    carries the identifier used in the partial batch response: the SQS
+    messageId, or the object key for direct S3 events.
+
+    Scratch uploads for "search by uploaded file" queries are skipped, in case the
+    scratch prefix shares a bucket with a tagging notification.
+
+    Returns (refs, failed_identifiers) where the failures could not be parsed.
+    """
+    refs = []
+    failed = []
+    for record in event.get('Records', []):
+        if 's3' in record:
+            refs.append(_from_s3_record(record, record['s3']['object']['key']))
+            continue
+
+        identifier = record.get('messageId')
+        try:
+            body = json.loads(record['body'])
+            if 'Records' in body:
+                # S3 sends a test event when a notification is first configured
+                refs.extend(_from_s3_record(r, identifier) for r in body['Records'] if 's3' in r)
+            else:
+                refs.append(_from_tagging_event(body, identifier))
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Unreadable batch record {identifier}: {repr(e)}")
+            failed.append(identifier)
+
+    tagged = []
+    for ref in refs:
+        if media_ingest.is_query_upload(ref['bucket'], ref['key']):
+            print(f"Skipping {ref['key']}: query upload")
+        else:
+            tagged.append(ref)
+    return tagged, failed
+
+
+def chunks(values, size):
+    for start in range(0, len(values), max(1, size)):
+        yield values[start:start + size]
+
+
+@metrics.timed("write")
+def write_items(table, items):
+    """
+    Write birds_table items with item_ids.put_new_item, several at a time, then their
+    tag index rows with a batch writer.
+
+    BatchWriteItem cannot carry a condition, so each item takes the same
+    attribute_not_exists(id) put as a single upload and retries with a fresh ID on a clash.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, put_concurrency)) as executor:
+        list(executor.map(lambda item: item_ids.put_new_item(table, item), items))
+
+    try:
+        with tag_index.index_table.batch_writer(overwrite_by_pkeys=['tag', 'count_key']) as writer:
+            for item in items:
+                tag_index.write_index(item, batch=writer)
+    except Exception as e:
+        print(f"Failed to update tag index: {repr(e)}")
+    return items
+
+
+def batch_response(failed_identifiers):
+    """Partial batch response: only the listed messages are retried (needs ReportBatchItemFailures)."""
+    unique = dict.fromkeys(i for i in failed_identifiers if i is not None)
+    return {"batchItemFailures": [{"itemIdentifier": i} for i in unique]}
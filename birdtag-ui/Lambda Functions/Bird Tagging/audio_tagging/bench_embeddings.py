@@ -0,0 +1,68 @@
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+from audio_embeddings import AnnIndex, build_index, normalize
+
+
+def synthetic_embeddings(rng, items, dim, songs):
+    """Recordings scattered around a set of song types, like calls of one species from different birds."""
+    centres = normalize(rng.standard_normal((songs, dim)))
+    song = rng.integers(0, songs, size=items)
+    return normalize(centres[song] + 0.35 * rng.standard_normal((items, dim)).astype(np.float32) / np.sqrt(dim) * 4), song
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the IVF-PQ audio embedding index against exact search.")
+    parser.add_argument("--items", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=1024, help="BirdNET V2.4 embeddings are 1024-d")
+    parser.add_argument("--songs", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--pq-m", type=int, default=None, help="Code bytes per recording (default AUDIO_ANN_PQ_M)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors, songs = synthetic_embeddings(rng, args.items + args.queries, args.dim, args.songs)
+    vectors, queries = vectors[:args.items], vectors[args.items:]
+    songs, query_songs = songs[:args.items], songs[args.items:]
+    keys = [f"{i:08d}\taudio" for i in range(args.items)]
+    path = os.path.join(tempfile.mkdtemp(), "audio_ann.bin")
+
+    start = time.perf_counter()
+    header = build_index(path, keys, vectors, m=args.pq_m)
+    print(f"index: {args.items} x {args.dim}, {header['nlist']} lists, {header['m']} bytes per recording, "
+          f"{os.path.getsize(path) / 1e6:.1f} MB (float32 vectors: {vectors.nbytes / 1e6:.0f} MB), built in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    index = AnnIndex(path)
+    print(f"open (mmap): {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    exact = [set(np.argsort(-(vectors @ q))[:args.top_k]) for q in queries]
+    # Within a song type the exact neighbours are near ties, so also count hits of the right song
+    exact_same = np.mean([np.mean(songs[list(truth)] == song) for truth, song in zip(exact, query_songs)])
+    exact_ms = []
+    for q in queries[:20]:
+        start = time.perf_counter()
+        np.argpartition(-(vectors @ q), args.top_k)[:args.top_k]
+        exact_ms.append((time.perf_counter() - start) * 1000)
+    print(f"exact float32 scan: {np.median(exact_ms):.2f} ms per query, same song@{args.top_k} {exact_same:.3f}")
+
+    print(f"{'nprobe':>6} {'p50 ms':>8} {'p95 ms':>8} {'recall@' + str(args.top_k):>10} {'same song':>10}")
+    for probes in args.nprobe:
+        latencies, recall, same = [], [], []
+        for q, truth, song in zip(queries, exact, query_songs):
+            start = time.perf_counter()
+            found = index.search(q, args.top_k, probes)
+            latencies.append((time.perf_counter() - start) * 1000)
+            rows = [int(key.split('\t')[0]) for key, _ in found]
+            recall.append(len(set(rows) & truth) / args.top_k)
+            same.append(np.mean(songs[rows] == song) if rows else 0.0)
+        print(f"{probes:>6} {np.percentile(latencies, 50):>8.2f} {np.percentile(latencies, 95):>8.2f} "
+              f"{np.mean(recall):>10.3f} {np.mean(same):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample
+import audio_decode
+
+
+def legacy_first_window(audio_path, target_sr=48000, duration_sec=3):
+    # preprocess_audio before audio_decode: whole file as float64, FFT-resampled, then cut
+    audio, sr = sf.read(audio_path)
+    if len(audio.shape) > 1:
+        audio = np.mean(audio, axis=1)
+    if sr != target_sr:
+        audio = resample(audio, int(len(audio) * target_sr / sr))
+    audio = audio.astype(np.float32)
+    return np.expand_dims(audio_decode.fit_length(audio, target_sr * duration_sec), axis=0)
+
+
+def legacy_windows(audio_path, target_sr=48000, duration_sec=3, overlap_sec=1.5):
+    # iter_audio_windows before audio_decode: FFT resample per window
+    required_len = target_sr * duration_sec
+    with sf.SoundFile(audio_path) as f:
+        sr = f.samplerate
+        window_len = int(round(duration_sec * sr))
+        overlap_len = window_len - max(1, int(round((duration_sec - overlap_sec) * sr)))
+        first = True
+        for block in f.blocks(blocksize=window_len, overlap=overlap_len, dtype='float32', always_2d=True):
+            if not first and len(block) <= overlap_len:
+                break
+            first = False
+            audio = block.mean(axis=1)
+            if sr != target_sr:
+                audio = resample(audio, int(len(audio) * target_sr / sr))
+            yield audio_decode.fit_length(audio.astype(np.float32), required_len)
+
+
+def write_recording(directory, sr, duration_sec, channels=2):
+    rng = np.random.default_rng(sr)
+    t = np.arange(int(sr * duration_sec)) / sr
+    # A chirp plus noise, so the resampler has real content across the band
+    signal = 0.3 * np.sin(2 * np.pi * (2000 + 1500 * np.sin(2 * np.pi * 0.5 * t)) * t)
+    audio = np.stack([signal + 0.05 * rng.standard_normal(len(t)) for _ in range(channels)], axis=1)
+    path = os.path.join(directory, f"bench_{sr}_{duration_sec}s.wav")
+    sf.write(path, audio.astype(np.float32), sr, subtype='PCM_16')
+    return path
+
+
+def timed_ms(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark legacy FFT preprocessing against the polyphase decode path.")
+    parser.add_argument("--rates", type=int, nargs="+", default=[22050, 44100, 48000, 96000])
+    parser.add_argument("--durations", type=float, nargs="+", default=[10, 60, 600])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-windows", action="store_true", help="Only time the first-window path")
+    args = parser.parse_args()
+
+    print(f"{'rate':>6} {'dur s':>6} {'path':<12} {'legacy ms':>10} {'poly ms':>9} {'speedup':>8} {'max diff':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for sr in args.rates:
+            for duration in args.durations:
+                path = write_recording(directory, sr, duration)
+
+                legacy_ms, expected = timed_ms(lambda: legacy_first_window(path), args.repeat)
+                poly_ms, result = timed_ms(lambda: audio_decode.read_first_window(path), args.repeat)
+                # Both resamplers ring differently at the window edges, so compare the interior
+                diff = float(np.max(np.abs(expected[0, 4800:-4800] - result[0, 4800:-4800])))
+                print(f"{sr:>6} {duration:>6g} {'first window':<12} {legacy_ms:>10.1f} {poly_ms:>9.1f} "
+                      f"{legacy_ms / poly_ms:>7.1f}x {diff:>9.4f}")
+
+                if args.skip_windows:
+                    continue
+                legacy_ms, _ = timed_ms(lambda: sum(1 for _ in legacy_windows(path)), 1)
+                poly_ms, windows = timed_ms(lambda: sum(1 for _ in audio_decode.iter_windows(path)), 1)
+                print(f"{sr:>6} {duration:>6g} {'all windows':<12} {legacy_ms:>10.1f} {poly_ms:>9.1f} "
+                      f"{legacy_ms / poly_ms:>7.1f}x {windows:>6} win")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import os
+import hashlib
+import threading
+import numpy as np
+import boto3
+import filter_bird_labels
+import metrics
+
+region = os.environ.get("AWS_REGION", "ap-southeast-2")
+s3 = boto3.client('s3', region_name=region)
+
+# === Define model and label location in another bucket ===
+model_bucket = "g116-models-s3"
+model_key = "model/BirdNET_GLOBAL_6K_V2.4_Model_FP32.tflite"
+# The model's full labels file: one line per output, non-bird classes included (masked at load)
+label_key = "model/BirdNET_GLOBAL_6K_V2.4_Labels.txt"
+model_path = "/tmp/model.tflite"
+label_path = "/tmp/labels.txt"
+
+# === Local model ===
+# Directory holding the model file under its S3 file name, baked into the image or an
+# EFS mount; when present the model is never fetched from S3
+local_model_dir = os.environ.get("MODEL_DIR")
+# Load the interpreter and run one inference during the init phase
+prewarm_enabled = os.environ.get("PREWARM", "off") == "on"
+
+# === Compiled labels ===
+# Directory written by `filter_bird_labels.py --compile`; baked into the image, it replaces
+# the text labels download. Tag granularity: species (full common name), genus, family, or
+# legacy (last word of the common name, which lumps e.g. every warbler together)
+labels_artifact_dir = os.environ.get("AUDIO_LABELS_ARTIFACT", os.path.join(os.path.dirname(os.path.abspath(__file__)), "labels_compiled"))
+tag_granularity = os.environ.get("AUDIO_TAG_GRANULARITY", "species")
+
+# === Embeddings ===
+# BirdNET's embedding is the pooled feature vector feeding its classifier layer. By default
+# it is the tensor just before the output, as BirdNET-Analyzer reads it; set a tensor index
+# or name when a converted model lays its tensors out differently.
+embedding_tensor = os.environ.get("AUDIO_EMBEDDING_TENSOR")
+
+
+def interpreter_class():
+    """The TFLite Interpreter, from tflite-runtime when installed, otherwise from TensorFlow."""
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        from tensorflow.lite import Interpreter
+    return Interpreter
+
+
+def file_digest(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def default_num_threads():
+    # Lambda exposes its vCPU allocation as the process CPU affinity
+    env_threads = os.environ.get("TFLITE_NUM_THREADS")
+    if env_threads:
+        return int(env_threads)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class LabelTable:
+    """BirdNET labels parsed once into scientific name, common name and tag key."""
+
+    def __init__(self, labels, granularity=None):
+        granularity = granularity or tag_granularity
+        self.labels = labels
+        split = [filter_bird_labels.split_label(label) for label in labels]
+        self.scientific_names = [scientific for scientific, _ in split]
+        self.common_names = [common for _, common in split]
+        # Same rule as the compiled tables, so both label sources tag alike
+        self.tag_keys = filter_bird_labels.tag_names(labels, granularity)
+        # True where the model output is a bird; None when every output is one
+        mask = filter_bird_labels.bird_mask(labels)
+        self.bird_mask = None if mask.all() else mask
+        self.version = f"text:{granularity}"
+
+    @classmethod
+    def from_file(cls, path, granularity=None):
+        with open(path, 'r') as f:
+            return cls([line.strip() for line in f if line.strip()], granularity)
+
+    @classmethod
+    def from_compiled(cls, directory, granularity=None):
+        """Load a compiled label artifact; tags come from the precomputed ids for granularity."""
+        granularity = granularity or tag_granularity
+        with np.load(os.path.join(directory, "labels.npz")) as artifact:
+            table = cls.__new__(cls)
+            table.labels = artifact["labels"].tolist()
+            table.scientific_names = artifact["scientific"].tolist()
+            table.common_names = artifact["common"].tolist()
+            names = artifact[f"{granularity}_tag_names"]
+            table.tag_keys = names[artifact[f"{granularity}_tag_id"]].tolist()
+        mask = np.load(os.path.join(directory, "bird_mask.npy"), mmap_mode='r')
+        # Compiled from a labels file with no non-bird classes the mask keeps everything; skip applying it
+        table.bird_mask = None if mask.all() else mask
+        with open(os.path.join(directory, "labels.npz"), 'rb') as f:
+            table.version = f"compiled:{hashlib.sha256(f.read()).hexdigest()[:12]}:{granularity}"
+        return table
+
+    def __len__(self):
+        return len(self.labels)
+
+
+# Loaded at import when the artifact ships with the code, so cold starts skip the labels download
+_compiled_labels = None
+if os.path.isdir(labels_artifact_dir):
+    _compiled_labels = LabelTable.from_compiled(labels_artifact_dir, tag_granularity)
+
+
+class BirdNetRuntime:
+    """A long-lived TFLite interpreter with its tensor indices resolved once."""
+
+    def __init__(self, model_path, label_path, num_threads=1, labels=None):
+        self.interpreter = interpreter_class()(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+
+        input_details = self.interpreter.get_input_details()[0]
+        output_details = self.interpreter.get_output_details()[0]
+        self.input_index = input_details['index']
+        self.output_index = output_details['index']
+        self.batch_size = int(input_details['shape'][0])
+        self.window_len = int(input_details['shape'][-1])
+
+        # (batch, D) tensor read alongside the logits, or None when the model has no such tensor
+        self.embedding_index = self._find_embedding_tensor(output_details)
+        self.embedding_dim = None
+        if self.embedding_index is not None:
+            self.embedding_dim = int(self._tensor_details()[self.embedding_index]['shape'][-1])
+
+        self.labels = labels or LabelTable.from_file(label_path)
+        num_outputs = int(output_details['shape'][-1])
+        if len(self.labels) != num_outputs:
+            # Labels are looked up by output index, so a shorter or longer file mislabels every class
+            raise ValueError(
+                f"{len(self.labels)} labels for a model with {num_outputs} outputs: the labels must list "
+                "the model's classes in output order (for the stock BirdNET model, its full labels file)"
+            )
+        self.num_threads = num_threads
+        # ETag of the model object, identifies the weights when caching results
+        self.model_version = None
+        # A TFLite interpreter is not safe to invoke from several threads at once
+        self.lock = threading.Lock()
+
+    def _tensor_details(self):
+        return {detail['index']: detail for detail in self.interpreter.get_tensor_details()}
+
+    def _find_embedding_tensor(self, output_details):
+        details = self._tensor_details()
+
+        def is_embedding(detail):
+            shape = detail['shape']
+            return (len(shape) == 2 and int(shape[0]) == self.batch_size
+                    and detail['dtype'] == np.float32 and detail['index'] not in (self.input_index, self.output_index))
+
+        if embedding_tensor:
+            by_name = [index for index, detail in details.items() if detail['name'] == embedding_tensor]
+            index = by_name[0] if by_name else int(embedding_tensor)
+            return index if index in details and is_embedding(details[index]) else None
+        candidates = [index for index, detail in details.items()
+                      if index < self.output_index and is_embedding(detail)
+                      and int(detail['shape'][1]) != int(output_details['shape'][-1])]
+        # The classifier's input is the closest such tensor before the output
+        return max(candidates) if candidates else None
+
+    def ensure_batch_size(self, batch_size):
+        if batch_size != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, [batch_size, self.window_len])
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch_size
+
+    @metrics.timed("inference")
+    def predict(self, batch, embeddings=False):
+        """
+        Run an (n, window_len) float32 batch, zero-padding it up to the allocated batch size.
+
+        With embeddings=True returns (logits, embeddings); embeddings is None when the
+        model has no embedding tensor.
+        """
+        n = len(batch)
+        metrics.count("audio_windows", n)
+        with self.lock:
+            if n > self.batch_size:
+                self.ensure_batch_size(n)
+            if n < self.batch_size:
+                padding = np.zeros((self.batch_size - n, self.window_len), dtype=np.float32)
+                batch = np.concatenate([batch, padding])
+            self.interpreter.set_tensor(self.input_index, batch)
+            self.interpreter.invoke()
+            logits = self.interpreter.get_tensor(self.output_index)[:n]
+            if not embeddings:
+                return logits
+            # Still intact after invoke: the classifier is the last op to read it
+            if self.embedding_index is None:
+                return logits, None
+            return logits, self.interpreter.get_tensor(self.embedding_index)[:n]
+
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+def get_runtime():
+    """Return the container-wide BirdNET runtime, downloading the model and labels on first use."""
+    global _runtime
+    with metrics.stage("model_load"), _runtime_lock:
+        metrics.count("model_cache_hit" if _runtime is not None else "model_cache_miss")
+        if _runtime is None:
+            path, labels_file = model_path, label_path
+            local_model = os.path.join(local_model_dir, os.path.basename(model_key)) if local_model_dir else None
+            if local_model and os.path.exists(local_model):
+                # Baked in or on EFS: identified by content, no S3 round trips
+                path = local_model
+                local_labels = os.path.join(local_model_dir, os.path.basename(label_key))
+                if os.path.exists(local_labels):
+                    labels_file = local_labels
+                model_version = f"local:{file_digest(path)[:16]}"
+            else:
+                if not os.path.exists(model_path):
+                    s3.download_file(model_bucket, model_key, model_path)
+                    metrics.count("bytes_fetched", os.path.getsize(model_path))
+                    print(f"Downloaded model from s3://{model_bucket}/{model_key}")
+                model_version = s3.head_object(Bucket=model_bucket, Key=model_key)['ETag']
+            if _compiled_labels is None and not os.path.exists(labels_file):
+                s3.download_file(model_bucket, label_key, labels_file)
+                metrics.count("bytes_fetched", os.path.getsize(labels_file))
+                print(f"Downloaded labels from s3://{model_bucket}/{label_key}")
+
+            runtime = BirdNetRuntime(path, labels_file, num_threads=default_num_threads(), labels=_compiled_labels)
+            # Tags depend on the labels and granularity as well as the weights
+            runtime.model_version = f"{model_version}:{runtime.labels.version}"
+            _runtime = runtime
+            print(f"Loaded BirdNET interpreter with {_runtime.num_threads} threads and {len(_runtime.labels)} labels")
+        return _runtime
+
+
+def prewarm():
+    """Load the runtime and run one silent window so the first request skips tensor allocation."""
+    runtime = get_runtime()
+    runtime.predict(np.zeros((1, runtime.window_len), dtype=np.float32))
+    return runtime
@@ -0,0 +1,238 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import metrics
+
+region = os.environ.get("AWS_REGION", "ap-southeast-2")
+dynamodb = boto3.resource('dynamodb', region_name=region)
+
+# === Detection cache settings ===
+# Set DETECTION_CACHE=off to always run the model
+cache_enabled = os.environ.get("DETECTION_CACHE", "on") != "off"
+cache_table_name = os.environ.get("DETECTION_CACHE_TABLE", "detection_cache")
+cache_max_entries = int(os.environ.get("DETECTION_CACHE_MAX_ENTRIES", "1024"))
+# Lifetime of a shared entry; the table's TTL attribute is expires_at
+cache_ttl_seconds = int(os.environ.get("DETECTION_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+# Optional integer lists stored alongside tags and counts (per-species first/last-seen times of videos)
+extra_fields = ('first_seen_ms', 'last_seen_ms')
+# Optional binary fields (the pooled audio embedding)
+binary_fields = ('embedding',)
+
+
+def hash_media(source, block_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a path, bytes, or seekable file object (rewound afterwards)."""
+    digest = hashlib.sha256()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        digest.update(source)
+    elif isinstance(source, str):
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+    else:
+        start = source.tell()
+        for block in iter(lambda: source.read(block_size), b''):
+            digest.update(block)
+        source.seek(start)
+    return digest.hexdigest()
+
+
+def object_digest(etag, size):
+    """Cache digest of an S3 object by ETag and size, for lookups before any of its bytes are read."""
+    etag = etag.strip('"')
+    return f"s3:{etag}:{size}"
+
+
+class DetectionCache:
+    """
+    Content-addressed cache of {tags, counts} keyed by media SHA-256 and model version.
+
+    Lookups go to a per-container LRU first and then to a DynamoDB table shared
+    by the tagging and query Lambdas. Cache failures never fail an invocation.
+    """
+
+    def __init__(self, table_name, max_entries=1024, ttl_seconds=30 * 24 * 3600):
+        self.table = dynamodb.Table(table_name)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(digest, model_version):
+        return f"{model_version}#{digest}"
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, digest, model_version):
+        key = self.cache_key(digest, model_version)
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                return result
+
+        try:
+            item = self.table.get_item(Key={'cache_key': key}).get('Item')
+        except Exception as e:
+            print(f"Detection cache lookup failed: {repr(e)}")
+            return None
+        # TTL deletion is lazy, so expired rows can still be returned for a while
+        if item is None or int(item.get('expires_at', 0)) < time.time():
+            return None
+
+        result = {"tags": list(item['tags']), "counts": [int(c) for c in item['counts']]}
+        for extra in extra_fields:
+            if extra in item:
+                result[extra] = [int(v) for v in item[extra]]
+        for field in binary_fields:
+            if field in item:
+                result[field] = bytes(getattr(item[field], 'value', item[field]))
+        self._remember(key, result)
+        return result
+
+    def put(self, digest, model_version, result):
+        key = self.cache_key(digest, model_version)
+        self._remember(key, result)
+        entry = {
+            'cache_key': key,
+            'tags': result["tags"],
+            'counts': result["counts"],
+            'expires_at': int(time.time()) + self.ttl_seconds,
+        }
+        entry.update({extra: result[extra] for extra in extra_fields if extra in result})
+        entry.update({field: result[field] for field in binary_fields if result.get(field)})
+        try:
+            self.table.put_item(Item=entry)
+        except Exception as e:
+            print(f"Detection cache write failed: {repr(e)}")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_hash_executor = None
+
+
+def get_cache():
+    """Return the container-wide cache, or None when DETECTION_CACHE=off."""
+    global _cache
+    if not cache_enabled:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = DetectionCache(cache_table_name, cache_max_entries, cache_ttl_seconds)
+        return _cache
+
+
+def _range_reader(source):
+    """The ranged-GET reader behind source, when it is one (media_ingest.open_s3_object on a large object)."""
+    reader = getattr(source, 'raw', None)
+    return reader if getattr(reader, 'etag', None) and hasattr(reader, 'hexdigest') else None
+
+
+def lookup(cache, source, model_version):
+    """
+    Return (result or None, digest to store a new result under) for the media in source.
+
+    An object read by range is looked up by ETag and size instead of being downloaded
+    once just to hash it; store() adds its content digest from the blocks decoding read.
+    """
+    reader = _range_reader(source)
+    digest = object_digest(reader.etag, reader.size) if reader is not None else hash_media(source)
+    result = cache.get(digest, model_version)
+    if result is not None:
+        metrics.count("detection_cache_hit")
+        print(f"Detection cache hit for {digest[:12]} ({model_version})")
+    else:
+        metrics.count("detection_cache_miss")
+    return result, digest
+
+
+def store(cache, source, digest, model_version, result):
+    """Store a result lookup() missed; empty or failed results are not stored."""
+    if not result.get("tags"):
+        return
+    cache.put(digest, model_version, result)
+    reader = _range_reader(source)
+    if reader is not None:
+        cache.put(reader.hexdigest(), model_version, result)
+
+
+def cached_detection(source, model_version, predict):
+    """
+    Return predict() for the media in source, reusing a stored result for identical bytes.
+
+    predict is only called on a cache miss. Empty or failed results are not stored,
+    since the prediction functions also report errors as empty tags.
+    """
+    cache = get_cache()
+    if cache is None:
+        return predict()
+
+    result, digest = lookup(cache, source, model_version)
+    if result is not None:
+        return result
+    result = predict()
+    store(cache, source, digest, model_version, result)
+    return result
+
+def _hash_pool():
+    global _hash_executor
+    with _cache_lock:
+        if _hash_executor is None:
+            _hash_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hash")
+        return _hash_executor
+
+
+def _hash_download(download):
+    with download.open_stream() as stream:
+        return hash_media(stream)
+
+
+def cached_stream_detection(download, model_version, predict):
+    """
+    Return predict(stream) for a media_ingest.S3Download, decoding while later ranges arrive.
+
+    The object is looked up by ETag and size first, so a re-sent object is answered
+    before its bytes are read. On a miss a second reader hashes the bytes as they land,
+    and the result is stored under both that key and the content digest the other
+    paths look up.
+    """
+    cache = get_cache()
+    if cache is None:
+        with download.open_stream() as stream:
+            return predict(stream)
+
+    object_key = object_digest(download.etag, download.size)
+    result = cache.get(object_key, model_version)
+    if result is not None:
+        metrics.count("detection_cache_hit")
+        print(f"Detection cache hit for {object_key} ({model_version})")
+        return result
+
+    metrics.count("detection_cache_miss")
+    hashing = _hash_pool().submit(_hash_download, download)
+    try:
+        with download.open_stream() as stream:
+            result = predict(stream)
+    finally:
+        # Readers must finish before the caller closes the download, so always wait for the hash
+        try:
+            digest = hashing.result()
+        except Exception as e:
+            print(f"Failed to hash {download.key}: {repr(e)}")
+            digest = None
+
+    if result.get("tags"):
+        cache.put(object_key, model_version, result)
+        if digest is not None:
+            cache.put(digest, model_version, result)
+    return result
@@ -1,47 +1,168 @@
+import os
+import argparse
+import numpy as np
+
+# Define keywords for non-bird entries to filter out
+non_bird_keywords = [
+    # Amphibians
+    'Acris', 'Anaxyrus', 'Eleutherodactylus', 'Hyliola', 'Lithobates',
+    'Pseudacris', 'Scaphiopus', 'Spea',
+
+    # Insects
+    'Allonemobius', 'Amblycorypha', 'Anaxipha', 'Atlanticus', 'Cyrtoxipha',
+    'Eunemobius', 'Gryllus', 'Microcentrum', 'Miogryllus', 'Neoconocephalus',
+    'Neonemobius', 'Oecanthus', 'Orchelimum', 'Orocharis', 'Phyllopalpus',
+    'Pterophylla', 'Scudderia', 'Conocephalus', 'Apis mellifera',
+
+    # Mammals
+    'Alouatta pigra', 'Canis', 'Odocoileus', 'Sciurus', 'Tamiasciurus', 'Tamias',
+
+    # Other non-animal sounds
+    'Dog_Dog', 'Engine_Engine', 'Environmental_Environmental', 'Fireworks_Fireworks',
+    'Gun_Gun', 'Human non-vocal', 'Human vocal', 'Human whistle',
+    'Noise_Noise', 'Power tools', 'Siren_Siren'
+]
+
+granularities = ('species', 'genus', 'family', 'legacy')
+
+
+def compile_keywords(keywords):
+    """
+    Split the keyword list into set lookups: whole labels ("Dog_Dog"), scientific names
+    ("Apis mellifera", "Human vocal") and genera ("Canis").
+    """
+    labels, scientific, genera = set(), set(), set()
+    for keyword in keywords:
+        if '_' in keyword:
+            labels.add(keyword)
+        elif ' ' in keyword:
+            scientific.add(keyword)
+        else:
+            genera.add(keyword)
+    return labels, scientific, genera
+
+
+def split_label(label):
+    parts = label.split('_')
+    if len(parts) > 1:
+        return parts[0], parts[1]
+    return label, label
+
+
+def bird_mask(labels, keywords=None):
+    """Return a bool array that is True for labels that are birds."""
+    non_bird_labels, non_bird_scientific, non_bird_genera = compile_keywords(keywords or non_bird_keywords)
+    mask = np.ones(len(labels), dtype=bool)
+    for i, label in enumerate(labels):
+        scientific, _ = split_label(label)
+        if (label in non_bird_labels or scientific in non_bird_scientific
+                or scientific.split(' ')[0] in non_bird_genera):
+            mask[i] = False
+    return mask
+
+
+def read_labels(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def read_taxonomy(path):
+    """Read "Genus,Family" lines into {genus: family}."""
+    families = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            genus, _, family = line.strip().partition(',')
+            if genus and family and not genus.startswith('#'):
+                families[genus.strip()] = family.strip()
+    return families
+
+
+def tag_names(labels, granularity, families=None):
+    """
+    Return the tag name of each label at the given granularity.
+
+    species: full common name; genus: scientific genus; family: family from the taxonomy
+    file (genus when missing); legacy: last word of the common name, as the Lambdas
+    derived it before.
+    """
+    names = []
+    for label in labels:
+        scientific, common = split_label(label)
+        genus = scientific.split(' ')[0]
+        if granularity == 'legacy':
+            names.append(common.split()[-1].lower() if '_' in label else label.lower())
+        elif scientific == common:
+            # Non-species classes such as "Engine_Engine"
+            names.append(common.lower())
+        elif granularity == 'species':
+            names.append(common.lower())
+        elif granularity == 'genus':
+            names.append(genus.lower())
+        elif granularity == 'family':
+            names.append((families or {}).get(genus, genus).lower())
+        else:
+            raise ValueError(f"Unknown tag granularity: {granularity}")
+    return names
+
+
+def compile_labels(input_file, output_dir, taxonomy_file=None):
+    """
+    Compile a BirdNET labels file into the artifact loaded by birdnet_runtime.
+
+    output_dir/labels.npz holds, per model output index, the scientific and common
+    names and a canonical tag id for every granularity ("<granularity>_tag_id" into
+    "<granularity>_tag_names"); output_dir/bird_mask.npy is the bird-only index mask,
+    kept separate so it can be memory-mapped.
+    """
+    labels = read_labels(input_file)
+    families = read_taxonomy(taxonomy_file) if taxonomy_file else None
+    split = [split_label(label) for label in labels]
+
+    arrays = {
+        'labels': np.array(labels),
+        'scientific': np.array([scientific for scientific, _ in split]),
+        'common': np.array([common for _, common in split]),
+    }
+    for granularity in granularities:
+        names, tag_id = np.unique(np.array(tag_names(labels, granularity, families)), return_inverse=True)
+        arrays[f'{granularity}_tag_names'] = names
+        arrays[f'{granularity}_tag_id'] = tag_id.astype(np.int32)
+
+    os.makedirs(output_dir, exist_ok=True)
+    np.savez_compressed(os.path.join(output_dir, 'labels.npz'), **arrays)
+    mask = bird_mask(labels)
+    np.save(os.path.join(output_dir, 'bird_mask.npy'), mask)
+
+    if families is not None:
+        missing = {s.split(' ')[0] for s, c in split if s != c} - set(families)
+        if missing:
+            print(f"{len(missing)} genera have no family in {taxonomy_file}; their family tag is the genus")
+    print(f"Compiled {len(labels)} labels ({int(mask.sum())} birds) into {output_dir}")
+    for granularity in granularities:
+        print(f"  {granularity}: {len(arrays[f'{granularity}_tag_names'])} tags")
+    return arrays, mask
+
+
 def filter_bird_labels(input_file, output_file):
     """
     Filter out non-bird species from the BirdNET labels file.
-    
+
     Parameters:
     input_file (str): Path to the original BirdNET labels file
     output_file (str): Path where the filtered bird-only file will be saved
     """
-    # Define keywords for non-bird entries to filter out
-    non_bird_keywords = [
-        # Amphibians
-        'Acris', 'Anaxyrus', 'Eleutherodactylus', 'Hyliola', 'Lithobates', 
-        'Pseudacris', 'Scaphiopus', 'Spea',
-        
-        # Insects
-        'Allonemobius', 'Amblycorypha', 'Anaxipha', 'Atlanticus', 'Cyrtoxipha',
-        'Eunemobius', 'Gryllus', 'Microcentrum', 'Miogryllus', 'Neoconocephalus', 
-        'Neonemobius', 'Oecanthus', 'Orchelimum', 'Orocharis', 'Phyllopalpus', 
-        'Pterophylla', 'Scudderia', 'Conocephalus', 'Apis mellifera',
-        
-        # Mammals
-        'Alouatta pigra', 'Canis', 'Odocoileus', 'Sciurus', 'Tamiasciurus', 'Tamias',
-        
-        # Other non-animal sounds
-        'Dog_Dog', 'Engine_Engine', 'Environmental_Environmental', 'Fireworks_Fireworks', 
-        'Gun_Gun', 'Human non-vocal', 'Human vocal', 'Human whistle', 
-        'Noise_Noise', 'Power tools', 'Siren_Siren'
-    ]
-    
     # Read the original file
     with open(input_file, 'r', encoding='utf-8') as f:
         lines = f.readlines()
-    
-    # Filter out non-bird species
-    bird_lines = []
-    for line in lines:
-        # Check if the line contains any non-bird keywords
-        if not any(keyword in line for keyword in non_bird_keywords):
-            bird_lines.append(line)
-    
+
+    # Genus, scientific name and label set lookups instead of a substring scan per keyword
+    mask = bird_mask([line.strip() for line in lines])
+    bird_lines = [line for line, is_bird in zip(lines, mask) if is_bird]
+
     # Write the filtered content to the output file
     with open(output_file, 'w', encoding='utf-8') as f:
         f.writelines(bird_lines)
-    
+
     # Print summary
     print(f"Original file had {len(lines)} entries")
     print(f"Bird-only file has {len(bird_lines)} entries")
@@ -50,7 +171,14 @@ def filter_bird_labels(input_file, output_file):
 
 # Example usage
 if __name__ == "__main__":
-    input_file = "BirdNET_GLOBAL_6K_V2.4_Labels.txt"  # Replace with your input file path
-    output_file = "BirdNET_GLOBAL_6K_V2.4_Labels_Birds_Only.txt"  # Replace with your desired output file path
-    
-    filter_bird_labels(input_file, output_file)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Filter or compile the BirdNET labels file.")
+    parser.add_argument("input_file", nargs="?", default="BirdNET_GLOBAL_6K_V2.4_Labels.txt")
+    parser.add_argument("output_file", nargs="?", default="BirdNET_GLOBAL_6K_V2.4_Labels_Birds_Only.txt")
+    parser.add_argument("--compile", metavar="DIR", help="Write the compiled label artifact to DIR instead")
+    parser.add_argument("--taxonomy", help="Genus,Family CSV for family-level tags")
+    args = parser.parse_args()
+
+    if args.compile:
+        compile_labels(args.input_file, args.compile, args.taxonomy)
+    else:
+        filter_bird_labels(args.input_file, args.output_file)
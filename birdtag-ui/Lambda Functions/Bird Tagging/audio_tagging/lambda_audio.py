@@ -1,78 +1,343 @@
 import os
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import boto3
-import soundfile as sf
-import tempfile
-import random
 from datetime import datetime
-from scipy.signal import resample 
-from tensorflow import lite as tflite
 from urllib.parse import urlparse
+import birdnet_runtime
+import audio_decode
+import species_filter
+import audio_embeddings
+import media_ingest
+import detection_cache
+import tag_index
+import item_ids
+import batch_ingest
+import metrics
 
 region = os.environ.get("AWS_REGION", "ap-southeast-2")
 dynamodb = boto3.resource('dynamodb', region_name=region)
 table = dynamodb.Table('birds_table')
 s3 = boto3.client('s3', region_name=region)
 
-# === Define model and label location in another bucket ===
-model_bucket = "g116-models-s3"
-model_key = "model/BirdNET_GLOBAL_6K_V2.4_Model_FP32.tflite"
-label_key = "model/BirdNET_GLOBAL_6K_V2.4_Labels_Birds_Only.txt"
-model_path = "/tmp/model.tflite"
-label_path = "/tmp/labels.txt"
+# === Streaming analysis settings ===
+# "full" slides overlapping windows over the whole recording, "first_window" keeps the legacy 3 s clip
+analysis_mode = os.environ.get("AUDIO_ANALYSIS_MODE", "full")
+window_overlap_sec = float(os.environ.get("AUDIO_WINDOW_OVERLAP_SEC", "1.5"))
+window_batch_size = int(os.environ.get("AUDIO_BATCH_SIZE", "16"))
+min_window_confidence = float(os.environ.get("AUDIO_MIN_CONFIDENCE", "0.0"))
 
-def load_labels(label_path):
-    with open(label_path, 'r') as f:
-        return [line.strip() for line in f.readlines()]
+# === Batch ingest settings ===
+# Stage concurrency: recordings fetched and hashed ahead of the runtime, and parallel DynamoDB flushes
+fetch_concurrency = int(os.environ.get("PIPELINE_FETCH_CONCURRENCY", "4"))
+write_concurrency = int(os.environ.get("PIPELINE_WRITE_CONCURRENCY", "2"))
+# Finished items per write_items flush
+write_batch_items = 25
 
-def load_model(model_path):
-    interpreter = tflite.Interpreter(model_path=model_path)
-    interpreter.allocate_tensors()
-    return interpreter
+# Optional pre-warm (PREWARM=on): the interpreter is loaded during the init phase, not the first request
+if birdnet_runtime.prewarm_enabled:
+    try:
+        birdnet_runtime.prewarm()
+    except Exception as e:
+        print(f"Pre-warm failed, loading on first request instead: {repr(e)}")
 
 def preprocess_audio(audio_path, target_sr=48000, duration_sec=3):
-    audio, sr = sf.read(audio_path)
-    if len(audio.shape) > 1:
-        audio = np.mean(audio, axis=1)
-    if sr != target_sr:
-        num_samples = int(len(audio) * target_sr / sr)
-        audio = resample(audio, num_samples)
-    audio = audio.astype(np.float32)
-    required_len = target_sr * duration_sec
-    if len(audio) < required_len:
-        audio = np.pad(audio, (0, required_len - len(audio)))
+    # Decodes only the first window, as float32, and resamples just that
+    return audio_decode.read_first_window(audio_path, target_sr=target_sr, duration_sec=duration_sec)
+
+def predict_species(runtime, audio_path, mask=None, pool=None):
+    # pool, when given, collects the window's BirdNET embedding alongside the prediction
+    if pool is not None:
+        predictions, embeddings = runtime.predict(preprocess_audio(audio_path), embeddings=True)
+        pool.add(embeddings)
+        prediction = predictions[0]
     else:
-        audio = audio[:required_len]
-    return np.expand_dims(audio, axis=0)
-
-def predict_species(interpreter, labels, audio_path):
-    input_details = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
-    audio = preprocess_audio(audio_path)
-    interpreter.set_tensor(input_details[0]['index'], audio)
-    interpreter.invoke()
-    prediction = interpreter.get_tensor(output_details[0]['index'])[0]
-    top_idx = np.argmax(prediction)
-    species = labels[top_idx]
+        prediction = runtime.predict(preprocess_audio(audio_path))[0]
+    if mask is not None:
+        prediction = np.where(mask, prediction, -np.inf)
+    top_idx = int(np.argmax(prediction))
     confidence = float(prediction[top_idx])
-    return species, confidence
+    return top_idx, confidence
+
+def iter_audio_windows(audio_path, target_sr=48000, duration_sec=3, overlap_sec=1.5):
+    """Yield overlapping fixed-length float32 windows from an audio file, resampled to target_sr."""
+    return audio_decode.iter_windows(audio_path, target_sr=target_sr, duration_sec=duration_sec, overlap_sec=overlap_sec)
+
+
+def iter_predictions(runtime, windows, batch_size=16, pool=None):
+    """Run BirdNET over an iterable of windows, yielding one output array per batch (embeddings go to pool)."""
+    # Resized once per container; short final batches are zero-padded by the runtime
+    runtime.ensure_batch_size(batch_size)
+
+    def run(batch):
+        if pool is None:
+            return runtime.predict(np.stack(batch))
+        predictions, embeddings = runtime.predict(np.stack(batch), embeddings=True)
+        pool.add(embeddings)
+        return predictions
+
+    batch = []
+    for window in windows:
+        batch.append(window)
+        if len(batch) == batch_size:
+            yield run(batch)
+            batch = []
+    if batch:
+        yield run(batch)
+
+
+def predict_species_windows(runtime, audio_path, overlap_sec=1.5, batch_size=16, min_confidence=0.0, mask=None, pool=None):
+    """
+    Run BirdNET over every window of the recording in batches.
+
+    Returns {label_index: {"count", "max_confidence", "mean_confidence"}} where count is
+    the number of windows whose top prediction is that label.
+    """
+    stats = {}
+
+    def accumulate(predictions):
+        if mask is not None:
+            predictions = np.where(mask, predictions, -np.inf)
+        top_idx = np.argmax(predictions, axis=1)
+        top_conf = predictions[np.arange(len(predictions)), top_idx]
+        for idx, conf in zip(top_idx, top_conf):
+            if conf < min_confidence:
+                continue
+            entry = stats.setdefault(int(idx), {"count": 0, "max_confidence": 0.0, "sum_confidence": 0.0})
+            entry["count"] += 1
+            entry["max_confidence"] = max(entry["max_confidence"], float(conf))
+            entry["sum_confidence"] += float(conf)
+
+    for predictions in iter_predictions(runtime, iter_audio_windows(audio_path, overlap_sec=overlap_sec), batch_size, pool):
+        accumulate(predictions)
+
+    for entry in stats.values():
+        entry["mean_confidence"] = entry.pop("sum_confidence") / entry["count"]
+    return stats
+
+
+def predict_species_multi(runtime, windows, batch_size=16, threshold=0.5, sensitivity=1.0, mask=None, pool=None):
+    """
+    Multi-label pass: every class whose sigmoid confidence reaches threshold in a window counts.
+
+    Returns the same {label_index: {"count", "max_confidence", "mean_confidence"}} shape as
+    predict_species_windows, with count the number of windows above threshold.
+    """
+    scores = species_filter.WindowScores(len(runtime.labels), threshold, sensitivity, mask)
+    for predictions in iter_predictions(runtime, windows, batch_size, pool):
+        scores.add(predictions)
+    return scores.stats()
+
+
+def pipeline_version(runtime):
+    # Results depend on the analysis settings as well as the weights
+    _, mask_tag = species_filter.output_mask(runtime.labels)
+    suffix = species_filter.settings_version(mask_tag) + audio_embeddings.embedding_version(runtime)
+    if analysis_mode == "first_window":
+        return f"birdnet:{runtime.model_version}:first_window{suffix}"
+    return f"birdnet:{runtime.model_version}:windows:{window_overlap_sec}:{min_window_confidence}{suffix}"
+
+
+def tag_recording(runtime, audio_file):
+    labels = runtime.labels
+    mask, _ = species_filter.output_mask(labels)
+    pool = audio_embeddings.pool_for(runtime)
+    if species_filter.label_mode == "multi":
+        if analysis_mode == "first_window":
+            windows = preprocess_audio(audio_file)
+        else:
+            windows = iter_audio_windows(audio_file, overlap_sec=window_overlap_sec)
+        stats = predict_species_multi(
+            runtime, windows,
+            batch_size=window_batch_size,
+            threshold=species_filter.multi_label_threshold,
+            sensitivity=species_filter.sigmoid_sensitivity,
+            mask=mask,
+            pool=pool,
+        )
+    elif analysis_mode == "first_window":
+        label_idx, confidence = predict_species(runtime, audio_file, mask=mask, pool=pool)
+        stats = {label_idx: {"count": 1, "max_confidence": confidence, "mean_confidence": confidence}}
+    else:
+        stats = predict_species_windows(
+            runtime, audio_file,
+            overlap_sec=window_overlap_sec,
+            batch_size=window_batch_size,
+            min_confidence=min_window_confidence,
+            mask=mask,
+            pool=pool,
+        )
+
+    # Several labels can share a common name, so merge their window counts
+    species_count = {}
+    for label_idx, entry in sorted(stats.items(), key=lambda kv: (-kv[1]["count"], -kv[1]["max_confidence"])):
+        common_name = labels.tag_keys[label_idx]
+        species_count[common_name] = species_count.get(common_name, 0) + entry["count"]
+        print(f"{labels.labels[label_idx]}: {entry['count']} windows, max {entry['max_confidence']:.3f}, mean {entry['mean_confidence']:.3f}")
+
+    result = {"tags": list(species_count.keys()), "counts": list(species_count.values())}
+    # Pooled over every analysed window, for "sounds like this" search
+    if pool is not None and pool.windows:
+        result["embedding"] = pool.encoded()
+    return result
+
+
+def new_item(file_type, file_name, s3_url, result):
+    item = {
+        'file_type': file_type,
+        'file_name': file_name,
+        's3_url': s3_url,
+        'tags': result["tags"],
+        'counts': result["counts"],
+        'timestamp': datetime.utcnow().isoformat()
+    }
+    if result.get("embedding"):
+        item['embedding'] = result["embedding"]
+    return item
+
+
+def fetch_recording(ref, cache=None, version=None):
+    """
+    Fetch stage: open one recording off the runtime thread.
+
+    With the detection cache on, the recording is also looked up here, so a cached
+    recording never reaches the runtime.
+    """
+    audio_file = media_ingest.open_s3_object(ref['bucket'], ref['key'])
+    if cache is None:
+        return {'source': audio_file, 'digest': None}
+    cached, digest = detection_cache.lookup(cache, audio_file, version)
+    if cached is not None:
+        audio_file.close()
+        return {'result': cached}
+    return {'source': audio_file, 'digest': digest}
 
+
+def iter_fetched(refs, executor, depth, cache=None, version=None):
+    """Yield (ref, fetched or exception) in order, keeping up to depth fetches in flight."""
+    pending = deque()
+    refs = iter(refs)
+
+    def submit_next():
+        ref = next(refs, None)
+        if ref is not None:
+            pending.append((ref, executor.submit(fetch_recording, ref, cache, version)))
+
+    for _ in range(max(1, depth)):
+        submit_next()
+    while pending:
+        ref, future = pending.popleft()
+        submit_next()
+        try:
+            yield ref, future.result()
+        except Exception as e:
+            yield ref, e
+
+
+@metrics.instrumented("lambda_audio")
+def batch_handler(event, context=None):
+    """
+    Tag a batch of audio uploads from SQS (single-file tagging events or S3 notifications) or S3 events.
+
+    Runs as a staged pipeline like the image handler: a fetch pool opens and hashes
+    recordings ahead of the runtime, the warm runtime analyses each one in window
+    batches on this thread, and a write pool flushes finished items while analysis
+    continues. Returns a partial batch response so only the messages that failed are retried.
+    """
+    refs, failed = batch_ingest.parse_records(event)
+    failed = set(failed)
+
+    supported = []
+    for ref in refs:
+        if ref['type'] == 'audio':
+            supported.append(ref)
+        else:
+            print(f"Skipping {ref['key']}: unsupported file type {ref['type']}")
+
+    try:
+        runtime = birdnet_runtime.get_runtime()
+        # Also loads the species allowlist, which fails on a mask that does not fit the labels
+        version = pipeline_version(runtime)
+    except Exception as e:
+        print(f"Failed to load model, labels or species allowlist: {e}")
+        return batch_ingest.batch_response(list(failed) + [ref['identifier'] for ref in supported])
+
+    cache = detection_cache.get_cache()
+
+    # A message is retried as a whole, so its items are only written once all of its files succeed
+    remaining = Counter(ref['identifier'] for ref in supported)
+    finished = defaultdict(list)
+    ready = []
+    writes = []
+
+    with ThreadPoolExecutor(max_workers=fetch_concurrency) as fetch_pool, \
+            ThreadPoolExecutor(max_workers=write_concurrency) as write_pool:
+
+        def flush():
+            if ready:
+                batch = list(ready)
+                ready.clear()
+                future = write_pool.submit(batch_ingest.write_items, table, [item for _, item in batch])
+                writes.append((future, {identifier for identifier, _ in batch}))
+
+        def finish(ref, result):
+            identifier = ref['identifier']
+            if result is None:
+                failed.add(identifier)
+            else:
+                finished[identifier].append(new_item(ref['type'], ref['fileName'], ref['originalUrl'], result))
+            remaining[identifier] -= 1
+            if remaining[identifier] == 0:
+                items = finished.pop(identifier, [])
+                if identifier not in failed:
+                    ready.extend((identifier, item) for item in items)
+            if len(ready) >= write_batch_items:
+                flush()
+
+        for ref, fetched in iter_fetched(supported, fetch_pool, fetch_concurrency, cache, version):
+            if isinstance(fetched, Exception):
+                print(f"Failed to fetch {ref['key']}: {repr(fetched)}")
+                finish(ref, None)
+            elif 'result' in fetched:
+                finish(ref, fetched['result'])
+            else:
+                try:
+                    with fetched['source'] as audio_file:
+                        result = tag_recording(runtime, audio_file)
+                        if cache is not None:
+                            detection_cache.store(cache, audio_file, fetched['digest'], version, result)
+                    finish(ref, result)
+                except Exception as e:
+                    print(f"Failed to tag {ref['key']}: {repr(e)}")
+                    finish(ref, None)
+        flush()
+
+    saved = 0
+    for future, identifiers in writes:
+        try:
+            saved += len(future.result())
+        except Exception as e:
+            print(f"Failed to save batch to DynamoDB: {repr(e)}")
+            failed.update(identifiers)
+    print(f"Saved {saved} items to DynamoDB")
+
+    return batch_ingest.batch_response(list(failed))
+
+
+@metrics.instrumented("lambda_audio")
 def lambda_handler(event, context=None):
-    # === Download model and label file from different S3 bucket ===
+    # Multi-file events (SQS batches, S3 notifications) go through the staged pipeline
+    if 'Records' in event:
+        return batch_handler(event, context)
+
+    # === Load model and labels from different S3 bucket (kept warm across invocations) ===
     try:
-        s3.download_file(model_bucket, model_key, model_path)
-        print(f"Downloaded model from s3://{model_bucket}/{model_key}")
-        s3.download_file(model_bucket, label_key, label_path)
-        print(f"Downloaded labels from s3://{model_bucket}/{label_key}")
+        runtime = birdnet_runtime.get_runtime()
     except Exception as e:
         print(f"Failed to download model or label file from S3: {e}")
         return {"message": "Failed to load model from external S3 bucket."}
 
-    # Load model and labels
-    interpreter = load_model(model_path)
-    labels = load_labels(label_path)
-
-    item_id = random.randint(0, 9999999)
     file_name = event.get('fileName')
     file_type = event.get('type')
     s3_url = event.get('originalUrl')
@@ -82,30 +347,27 @@ def lambda_handler(event, context=None):
     bucket = parsed.netloc.split('.')[0]
     key = parsed.path.lstrip('/')
 
-    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-        tmp_path = tmp_file.name
-        s3.download_file(bucket, key, tmp_path)
-
+    # Decode straight from S3 (in memory or by ranged GETs) instead of a /tmp copy
+    with media_ingest.open_s3_object(bucket, key) as audio_file:
         try:
-            species, confidence = predict_species(interpreter, labels, tmp_path)
-        except ValueError as e:
+            result = detection_cache.cached_detection(
+                audio_file, pipeline_version(runtime), lambda: tag_recording(runtime, audio_file)
+            )
+        except (ValueError, RuntimeError) as e:
             return {"error": str(e)}
 
-    # Extract common name from label
-    parts = species.split('_')
-    common_name = parts[1].split()[-1].lower() if len(parts) > 1 else species.lower()
+    item = new_item(file_type, file_name, s3_url, result)
 
-    item = {
-        'id': item_id,
-        'file_type': file_type,
-        'file_name': file_name,
-        's3_url': s3_url,
-        'tags': [common_name],
-        'counts': [1],
-        'timestamp': datetime.utcnow().isoformat()
-    }
-
-    table.put_item(Item=item)
+    # Assigns a time-ordered id and upload_date bucket; never overwrites an existing item
+    item_ids.put_new_item(table, item)
+    # The embedding is binary, so it stays out of the log line and the JSON response
+    item = {key: value for key, value in item.items() if key != 'embedding'}
     print("Saved item to DynamoDB:", item)
 
+    # Keep the inverted tag index in step with the item
+    try:
+        tag_index.write_index(item)
+    except Exception as e:
+        print(f"Failed to update tag index: {repr(e)}")
+
     return item
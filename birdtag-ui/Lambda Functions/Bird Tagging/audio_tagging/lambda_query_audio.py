@@ -1,65 +1,94 @@
 import os
 import numpy as np
 import boto3
-import soundfile as sf
-import tempfile
-import random
+import io
 import json
-from datetime import datetime
-from scipy.signal import resample 
-from tensorflow import lite as tflite
-from urllib.parse import urlparse
 import base64
+import birdnet_runtime
+import audio_decode
+import species_filter
+import audio_embeddings
+import media_ingest
+import detection_cache
+import similarity_index
+import metrics
 
 region = os.environ.get("AWS_REGION", "ap-southeast-2")
 lambda_client = boto3.client('lambda')
 s3 = boto3.client('s3', region_name=region)
 
-# === Define model and label location in another bucket ===
-model_bucket = "g116-models-s3"
-model_key = "model/BirdNET_GLOBAL_6K_V2.4_Model_FP32.tflite"
-label_key = "model/BirdNET_GLOBAL_6K_V2.4_Labels_Birds_Only.txt"
-model_path = "/tmp/model.tflite"
-label_path = "/tmp/labels.txt"
+# === Similarity search settings ===
+# "on" answers with files ranked by the similarity index instead of return_file_query_handler's
+# exact tag match; a request can also ask for it with "ranked": true
+similarity_search = os.environ.get("SIMILARITY_SEARCH", "off")
+# "on" answers with recordings that sound like the upload (nearest BirdNET embeddings);
+# a request can also ask for it with "sounds_like": true
+sounds_like_search = os.environ.get("AUDIO_SOUNDS_LIKE", "off")
 
-def load_labels(label_path):
-    with open(label_path, 'r') as f:
-        return [line.strip() for line in f.readlines()]
-
-def load_model(model_path):
-    interpreter = tflite.Interpreter(model_path=model_path)
-    interpreter.allocate_tensors()
-    return interpreter
+# Optional pre-warm (PREWARM=on): the interpreter is loaded during the init phase, not the first request
+if birdnet_runtime.prewarm_enabled:
+    try:
+        birdnet_runtime.prewarm()
+    except Exception as e:
+        print(f"Pre-warm failed, loading on first request instead: {repr(e)}")
 
 def preprocess_audio(audio_path, target_sr=48000, duration_sec=3):
-    audio, sr = sf.read(audio_path)
-    if len(audio.shape) > 1:
-        audio = np.mean(audio, axis=1)
-    if sr != target_sr:
-        num_samples = int(len(audio) * target_sr / sr)
-        audio = resample(audio, num_samples)
-    audio = audio.astype(np.float32)
-    required_len = target_sr * duration_sec
-    if len(audio) < required_len:
-        audio = np.pad(audio, (0, required_len - len(audio)))
+    # Decodes only the first window, as float32, and resamples just that
+    return audio_decode.read_first_window(audio_path, target_sr=target_sr, duration_sec=duration_sec)
+
+def predict_species(runtime, audio_path, mask=None, pool=None):
+    # pool, when given, collects the window's BirdNET embedding alongside the prediction
+    if pool is not None:
+        predictions, embeddings = runtime.predict(preprocess_audio(audio_path), embeddings=True)
+        pool.add(embeddings)
+        prediction = predictions[0]
     else:
-        audio = audio[:required_len]
-    return np.expand_dims(audio, axis=0)
-
-def predict_species(interpreter, labels, audio_path):
-    input_details = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
-    audio = preprocess_audio(audio_path)
-    interpreter.set_tensor(input_details[0]['index'], audio)
-    interpreter.invoke()
-    prediction = interpreter.get_tensor(output_details[0]['index'])[0]
-    top_idx = np.argmax(prediction)
-    species = labels[top_idx]
+        prediction = runtime.predict(preprocess_audio(audio_path))[0]
+    if mask is not None:
+        prediction = np.where(mask, prediction, -np.inf)
+    top_idx = int(np.argmax(prediction))
     confidence = float(prediction[top_idx])
-    return species, confidence
+    return top_idx, confidence
+
+
+
+def pipeline_version(runtime):
+    # Queries tag only the first window (and order multi-label tags by confidence), so their
+    # results are kept apart from lambda_audio's, whatever its analysis mode
+    _, mask_tag = species_filter.output_mask(runtime.labels)
+    suffix = species_filter.settings_version(mask_tag) + audio_embeddings.embedding_version(runtime)
+    return f"birdnet:{runtime.model_version}:query:first_window{suffix}"
+
 
+def tag_query(runtime, audio_file):
+    mask, _ = species_filter.output_mask(runtime.labels)
+    pool = audio_embeddings.pool_for(runtime)
+    if species_filter.label_mode != "multi":
+        label_idx, confidence = predict_species(runtime, audio_file, mask=mask, pool=pool)
+        result = {'tags': [runtime.labels.tag_keys[label_idx]], 'counts': [1]}
+    else:
+        # Every species above threshold in the clip, strongest first
+        scores = species_filter.WindowScores(
+            len(runtime.labels), species_filter.multi_label_threshold, species_filter.sigmoid_sensitivity, mask
+        )
+        if pool is not None:
+            predictions, embeddings = runtime.predict(preprocess_audio(audio_file), embeddings=True)
+            pool.add(embeddings)
+        else:
+            predictions = runtime.predict(preprocess_audio(audio_file))
+        scores.add(predictions)
+        tags = []
+        for label_idx, _ in sorted(scores.stats().items(), key=lambda kv: -kv[1]["max_confidence"]):
+            if runtime.labels.tag_keys[label_idx] not in tags:
+                tags.append(runtime.labels.tag_keys[label_idx])
+        result = {'tags': tags, 'counts': [1] * len(tags)}
+
+    if pool is not None and pool.windows:
+        result['embedding'] = pool.encoded()
+    return result
 
 
+@metrics.instrumented("lambda_query_audio")
 def lambda_handler(event, context=None):
     # If the entire event is passed as string or bytes, decode it
     if isinstance(event, (bytes, str)):
@@ -69,81 +98,93 @@ def lambda_handler(event, context=None):
     file_name = event.get('file_name')
     file_type = event.get('file_type')
     file_content_b64 = event.get('file_content')
+    s3_url = event.get('s3_url')
 
-    if not all([file_name, file_type, file_content_b64]):
-        return {"message": "Missing required parameters: file_name, file_type, file_content"}
+    # Step 1 of the reference flow: hand out a presigned URL for the scratch prefix
+    if event.get('action') == 'upload_url':
+        if not (file_name and file_type):
+            return {"message": "Missing required parameters: file_name, file_type"}
+        return media_ingest.create_query_upload(file_name, event.get('content_type'))
+
+    if not (file_name and file_type and (file_content_b64 or s3_url)):
+        return {"message": "Missing required parameters: file_name, file_type, file_content or s3_url"}
 
     if file_type != 'audio':
         return {"message": "Unsupported file type. Only 'audio' is supported."}
 
-    # Decode and save the base64 audio
-    try:
-        audio_bytes = base64.b64decode(file_content_b64)
-        _, ext = os.path.splitext(file_name)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp_file:
-            tmp_path = tmp_file.name
-            tmp_file.write(audio_bytes)
-    except Exception as e:
-        return {"message": f"Failed to decode and write audio file: {repr(e)}"}
-
-
-    # Download model and label file from S3 only if not already present
-    try:
-        if not os.path.exists(model_path):
-            s3.download_file(model_bucket, model_key, model_path)
-            print(f"Downloaded model to {model_path}")
-        else:
-            print(f"Model already exists at {model_path}, skipping download.")
-
-        if not os.path.exists(label_path):
-            s3.download_file(model_bucket, label_key, label_path)
-            print(f"Downloaded labels to {label_path}")
-        else:
-            print(f"Labels already exist at {label_path}, skipping download.")
-
-    except Exception as e:
-        return {"message": f"Failed to download model or labels: {repr(e)}"}
-
+    # Only scratch uploads handed out by action "upload_url" are read by reference, never other objects
+    if s3_url and not media_ingest.is_query_upload(*media_ingest.parse_s3_url(s3_url)):
+        return {"message": "s3_url must be an upload URL returned by action 'upload_url'"}
 
-    # Load model and labels
+    # Download model and labels once per container and keep the interpreter warm
     try:
-        interpreter = load_model(model_path)
-        labels = load_labels(label_path)
+        runtime = birdnet_runtime.get_runtime()
     except Exception as e:
         return {"message": f"Model or label loading failed: {repr(e)}"}
 
-    # Predict species
+    # Predict species, decoding from memory (base64) or straight from S3 (s3_url)
     try:
-        species, confidence = predict_species(interpreter, labels, tmp_path)
+        if s3_url:
+            bucket, key = media_ingest.parse_s3_url(s3_url)
+            try:
+                with media_ingest.open_s3_object(bucket, key) as audio_file:
+                    item = detection_cache.cached_detection(
+                        audio_file, pipeline_version(runtime), lambda: tag_query(runtime, audio_file)
+                    )
+            finally:
+                media_ingest.delete_query_upload(bucket, key)
+        else:
+            try:
+                audio_file = io.BytesIO(base64.b64decode(file_content_b64))
+            except Exception as e:
+                return {"message": f"Failed to decode audio file: {repr(e)}"}
+            item = detection_cache.cached_detection(
+                audio_file, pipeline_version(runtime), lambda: tag_query(runtime, audio_file)
+            )
     except ValueError as e:
         return {"error": str(e)}
+    except Exception as e:
+        return {"message": f"Failed to read audio file: {repr(e)}"}
+
+    # The cached result may carry the binary embedding, which must not reach the JSON payloads
+    embedding = item.get('embedding')
+    item = {'tags': item['tags'], 'counts': item['counts']}
+
+    # Recordings that sound like the upload, whatever they were tagged as
+    if embedding and event.get('sounds_like', sounds_like_search == "on"):
+        try:
+            matches = audio_embeddings.similar_recordings(embedding, event.get('top_k'))
+            response = None if matches is None else similarity_index.matches_response(
+                matches, item['tags'], item['counts'], "Found {} recordings that sound like the uploaded file"
+            )
+        except Exception as e:
+            print(f"Sounds-like search failed, using tag search: {repr(e)}")
+            response = None
+        if response is not None:
+            return response
+
+    # Ranked search runs in this container against the warm index; without a snapshot yet, fall back
+    if event.get('ranked', similarity_search == "on"):
+        try:
+            response = similarity_index.search_response(item['tags'], item['counts'], event.get('top_k'))
+        except Exception as e:
+            print(f"Similarity search failed, using exact tag match: {repr(e)}")
+            response = None
+        if response is not None:
+            return response
 
-    parts = species.split('_')
-    common_name = parts[1].split()[-1].lower() if len(parts) > 1 else species.lower()
-
-    item = {
-        'tags': [common_name],
-        'counts': [1]
-    }
-    
-    
     # Invoke return_file_query_handler Lambda
     try:
-        response = lambda_client.invoke(
-            FunctionName='return_file_query_handler',
-            InvocationType='RequestResponse',
-            Payload=json.dumps(item).encode('utf-8')
-        )
-        print("reach here")
+        with metrics.stage("invoke"):
+            response = lambda_client.invoke(
+                FunctionName='return_file_query_handler',
+                InvocationType='RequestResponse',
+                Payload=json.dumps(item).encode('utf-8')
+            )
         response_payload = response['Payload'].read().decode('utf-8')
         print("Invoked return_file_query_handler:", response_payload)
         return json.loads(response_payload)
 
     except Exception as e:
         print(f"Failed to invoke return_file_query_handler: {repr(e)}")
-        return {"message": "Failed to invoke downstream Lambda."}
-
-    finally:
-        # Cleanup temp file
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
\ No newline at end of file
+        return {"message": "Failed to invoke downstream Lambda."}
\ No newline at end of file
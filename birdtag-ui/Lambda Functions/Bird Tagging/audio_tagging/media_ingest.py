@@ -0,0 +1,169 @@
+import io
+import os
+import uuid
+import hashlib
+from collections import OrderedDict
+import boto3
+from urllib.parse import urlparse, unquote, quote
+import metrics
+
+region = os.environ.get("AWS_REGION", "ap-southeast-2")
+s3 = boto3.client('s3', region_name=region)
+
+# === Ingest settings ===
+# Objects up to this size are fetched with one GET into memory, larger ones are read by range
+in_memory_max_bytes = int(os.environ.get("INGEST_IN_MEMORY_MAX_BYTES", str(32 * 1024 * 1024)))
+range_block_bytes = int(os.environ.get("INGEST_RANGE_BLOCK_BYTES", str(4 * 1024 * 1024)))
+range_cache_blocks = int(os.environ.get("INGEST_RANGE_CACHE_BLOCKS", "4"))
+
+
+class S3RangeReader(io.RawIOBase):
+    """
+    Seekable read-only view of an S3 object backed by ranged GETs.
+
+    Blocks are fetched on demand and a few recent ones are kept, so decoders
+    such as soundfile can seek around the header while memory stays bounded
+    and nothing touches /tmp. Blocks are also hashed in file order as they
+    arrive, so a decode that reads the whole object digests it on the way.
+    """
+
+    def __init__(self, bucket, key, size=None, block_size=None, cache_blocks=None, etag=None):
+        self.bucket = bucket
+        self.key = key
+        if size is None:
+            head = s3.head_object(Bucket=bucket, Key=key)
+            size, etag = head['ContentLength'], head['ETag']
+        self.size = size
+        self.etag = etag
+        self.block_size = block_size or range_block_bytes
+        self.cache_blocks = cache_blocks or range_cache_blocks
+        self.bytes_fetched = 0
+        self.pos = 0
+        self._blocks = OrderedDict()
+        self._hash = hashlib.sha256()
+        self._hashed_blocks = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = self.size + offset
+        return self.pos
+
+    def _block(self, index):
+        block = self._blocks.get(index)
+        if block is not None:
+            self._blocks.move_to_end(index)
+            return block
+
+        start = index * self.block_size
+        end = min(self.size, start + self.block_size) - 1
+        with metrics.stage("download"):
+            block = s3.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end}")['Body'].read()
+        self.bytes_fetched += len(block)
+        metrics.count("bytes_fetched", len(block))
+
+        self._blocks[index] = block
+        self._advance_hash()
+        if len(self._blocks) > self.cache_blocks:
+            self._blocks.popitem(last=False)
+        return block
+
+    def _advance_hash(self):
+        while self._hashed_blocks in self._blocks:
+            self._hash.update(self._blocks[self._hashed_blocks])
+            self._hashed_blocks += 1
+
+    def hexdigest(self):
+        """SHA-256 of the object; only blocks reads have not already hashed are fetched."""
+        n_blocks = -(-self.size // self.block_size)
+        while self._hashed_blocks < n_blocks:
+            self._block(self._hashed_blocks)
+            self._advance_hash()
+        return self._hash.hexdigest()
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self.size - self.pos)
+        if n <= 0:
+            return 0
+        view = memoryview(buffer)
+        written = 0
+        while written < n:
+            index, offset = divmod(self.pos, self.block_size)
+            block = self._block(index)
+            chunk = block[offset:offset + n - written]
+            view[written:written + len(chunk)] = chunk
+            written += len(chunk)
+            self.pos += len(chunk)
+        return written
+
+
+def open_s3_object(bucket, key):
+    """
+    Return a seekable binary file object for s3://bucket/key without writing to /tmp.
+
+    Small objects are read into memory with a single GET; larger ones are
+    streamed through ranged GETs.
+    """
+    with metrics.stage("download"):
+        head = s3.head_object(Bucket=bucket, Key=key)
+        size = head['ContentLength']
+        if size <= in_memory_max_bytes:
+            metrics.count("bytes_fetched", size)
+            return io.BytesIO(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    reader = S3RangeReader(bucket, key, size=size, etag=head['ETag'])
+    return io.BufferedReader(reader, buffer_size=1024 * 1024)
+
+
+# === Scratch uploads for "search by uploaded file" queries ===
+# Kept out of the media bucket, whose uploads trigger tagging; give the prefix a short
+# S3 lifecycle expiry (handlers also delete objects once processed)
+query_upload_bucket = os.environ.get("QUERY_UPLOAD_BUCKET", "g116-query-uploads-s3")
+query_upload_prefix = os.environ.get("QUERY_UPLOAD_PREFIX", "query-uploads/")
+query_upload_expires = int(os.environ.get("QUERY_UPLOAD_EXPIRES", "300"))
+
+
+def parse_s3_url(s3_url):
+    """Split a virtual-hosted style S3 URL into (bucket, key)."""
+    parsed = urlparse(s3_url)
+    return parsed.netloc.split('.')[0], unquote(parsed.path.lstrip('/'))
+
+
+def create_query_upload(file_name, content_type=None):
+    """Return a presigned PUT URL under the scratch prefix and the s3_url to query with afterwards."""
+    key = f"{query_upload_prefix}{uuid.uuid4().hex}/{os.path.basename(file_name)}"
+    params = {'Bucket': query_upload_bucket, 'Key': key}
+    if content_type:
+        params['ContentType'] = content_type
+    upload_url = s3.generate_presigned_url('put_object', Params=params, ExpiresIn=query_upload_expires)
+    return {
+        "upload_url": upload_url,
+        "s3_url": f"https://{query_upload_bucket}.s3.{region}.amazonaws.com/{quote(key)}",
+        "expires_in": query_upload_expires,
+    }
+
+
+def is_query_upload(bucket, key):
+    """True for objects under the scratch prefix, which are queried and deleted, never tagged."""
+    return bucket == query_upload_bucket and key.startswith(query_upload_prefix)
+
+
+def delete_query_upload(bucket, key):
+    """Remove a processed scratch upload; objects outside the scratch prefix are left alone."""
+    if not is_query_upload(bucket, key):
+        return
+    try:
+        s3.delete_object(Bucket=bucket, Key=key)
+    except Exception as e:
+        print(f"Failed to delete scratch upload s3://{bucket}/{key}: {repr(e)}")
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import functools
+import threading
+
+# === Metrics settings ===
+# One CloudWatch Embedded Metric Format record per invocation, printed to stdout
+# (CloudWatch Logs turns it into metrics). METRICS=off removes the layer entirely.
+metrics_enabled = os.environ.get("METRICS", "on") != "off"
+metrics_namespace = os.environ.get("METRICS_NAMESPACE", "BirdTag")
+
+# Metric name -> CloudWatch unit; stage timers are "<stage>_ms"
+units = {
+    "duration_ms": "Milliseconds",
+    "cold_start": "Count",
+    "model_cache_hit": "Count",
+    "model_cache_miss": "Count",
+    "detection_cache_hit": "Count",
+    "detection_cache_miss": "Count",
+    "frames_sampled": "Count",
+    "audio_windows": "Count",
+    "image_tiles": "Count",
+    "previews_uploaded": "Count",
+    "bytes_fetched": "Bytes",
+}
+
+# Set at import, cleared by the first invocation of the container
+_cold_start = True
+_current = None
+_current_lock = threading.Lock()
+_local = threading.local()
+
+
+class Invocation:
+    """Stage times, counters and properties of one handler invocation."""
+
+    def __init__(self, function_name, context=None):
+        self.function_name = function_name
+        self.values = {}
+        self.properties = {}
+        request_id = getattr(context, "aws_request_id", None)
+        if request_id:
+            self.properties["request_id"] = request_id
+        self._lock = threading.Lock()
+
+    def add(self, name, value):
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def record(self):
+        """Return the EMF record for this invocation."""
+        with self._lock:
+            values = dict(self.values)
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": metrics_namespace,
+                    "Dimensions": [["Function"]],
+                    "Metrics": [
+                        {"Name": name, "Unit": units.get(name, "Milliseconds" if name.endswith("_ms") else "Count")}
+                        for name in values
+                    ],
+                }],
+            },
+            "Function": self.function_name,
+            **self.properties,
+            **{name: round(value, 3) if isinstance(value, float) else value for name, value in values.items()},
+        }
+
+
+class _Stage:
+    """Times a stage exclusively: time spent in a stage nested inside it is charged to the inner one."""
+
+    __slots__ = ("invocation", "name", "start")
+
+    def __init__(self, invocation, name):
+        self.invocation = invocation
+        self.name = name
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stack = _local.stack
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        self.invocation.add(f"{self.name}_ms", (elapsed - nested) * 1000)
+        return False
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_stage = _NoStage()
+
+
+def stage(name):
+    """Context manager timing a stage (download, decode, preprocess, inference, write, ...) of the current invocation."""
+    invocation = _current
+    if invocation is None:
+        return _no_stage
+    return _Stage(invocation, name)
+
+
+def timed(name):
+    """Decorate a function so every call is timed as stage name; undecorated with METRICS=off."""
+    def decorate(fn):
+        if not metrics_enabled:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, value=1):
+    """Add to a counter of the current invocation; a no-op outside an instrumented handler."""
+    invocation = _current
+    if invocation is not None:
+        invocation.add(name, value)
+
+
+def set_property(name, value):
+    """Attach a searchable (non-metric) field such as file_type to the current invocation's record."""
+    invocation = _current
+    if invocation is not None:
+        invocation.properties[name] = value
+
+
+def emit(invocation):
+    print(json.dumps(invocation.record(), default=str))
+
+
+def instrumented(function_name):
+    """
+    Decorate a Lambda handler to emit one EMF record per invocation.
+
+    A handler called from another instrumented handler (lambda_handler delegating to
+    batch_handler) reports into the outer invocation. With METRICS=off the handler
+    is returned undecorated.
+    """
+    def decorate(handler):
+        if not metrics_enabled:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event, context=None):
+            global _current, _cold_start
+            with _current_lock:
+                if _current is not None:
+                    outer = None
+                else:
+                    outer = _current = Invocation(getattr(context, "function_name", None) or function_name, context)
+                    cold, _cold_start = _cold_start, False
+            if outer is None:
+                return handler(event, context)
+
+            outer.add("cold_start", int(cold))
+            start = time.perf_counter()
+            try:
+                return handler(event, context)
+            finally:
+                outer.add("duration_ms", (time.perf_counter() - start) * 1000)
+                with _current_lock:
+                    _current = None
+                try:
+                    emit(outer)
+                except Exception as e:
+                    print(f"Failed to emit metrics: {repr(e)}")
+        return wrapper
+    return decorate
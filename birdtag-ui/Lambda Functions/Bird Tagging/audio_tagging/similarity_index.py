@@ -0,0 +1,491 @@
+import os
+import json
+import time
+import uuid
+import argparse
+import threading
+import numpy as np
+import boto3
+from boto3.dynamodb.types import TypeDeserializer
+import tag_index
+import index_snapshot
+import metrics
+from index_snapshot import item_key, parse_key
+
+region = os.environ.get("AWS_REGION", "ap-southeast-2")
+s3 = boto3.client('s3', region_name=region)
+
+# === Similarity index settings ===
+# A species x item sparse matrix of birds_table, rebuilt from a scan into one snapshot
+# file in S3 and memory-mapped by warm query containers. Writes after the snapshot
+# arrive as small delta objects from the birds_table stream.
+birds_table_name = os.environ.get("BIRDS_TABLE", "birds_table")
+index_bucket = os.environ.get("SIMILARITY_BUCKET", "g116-models-s3")
+snapshot_key = os.environ.get("SIMILARITY_SNAPSHOT_KEY", "similarity/snapshot.bin")
+delta_prefix = os.environ.get("SIMILARITY_DELTA_PREFIX", "similarity/deltas/")
+snapshot_path = "/tmp/similarity_snapshot.bin"
+# Seconds a warm index is trusted before the snapshot ETag and new deltas are checked
+refresh_seconds = float(os.environ.get("SIMILARITY_REFRESH_SECONDS", "30"))
+# "cosine" (idf-weighted) or "jaccard" (weighted, sum of minimums over sum of maximums)
+similarity_metric = os.environ.get("SIMILARITY_METRIC", "cosine")
+# How a count enters the vector: "log" (1 + log count), "linear" or "binary"; fixed per snapshot
+count_weighting = os.environ.get("SIMILARITY_COUNT_WEIGHT", "log")
+default_top_k = int(os.environ.get("SIMILARITY_TOP_K", "20"))
+# Deltas are replayed from this long before the snapshot scan started, and pruned after it
+delta_margin_ms = int(float(os.environ.get("SIMILARITY_DELTA_MARGIN_SECONDS", "300")) * 1000)
+
+_magic = b"BTSIM001"
+
+
+def count_weights(counts, weighting=None):
+    counts = np.asarray(counts, dtype=np.float32)
+    weighting = weighting or count_weighting
+    if weighting == "binary":
+        return (counts > 0).astype(np.float32)
+    if weighting == "linear":
+        return counts
+    return np.where(counts > 0, 1 + np.log(np.maximum(counts, 1)), 0).astype(np.float32)
+
+
+def item_vector(item):
+    """Return {species: count} of a birds_table item, merging repeated tags."""
+    vector = {}
+    for tag, count in zip(item.get('tags') or [], item.get('counts') or []):
+        if tag and int(count) > 0:
+            species = str(tag).lower()
+            vector[species] = vector.get(species, 0) + int(count)
+    return vector
+
+
+# === Snapshot file ===
+# An index_snapshot file with these arrays:
+#   keys     S<w>     [items]       "id\tfile_type", sorted so a key's row is a binary search
+#   col_ptr  int64    [species + 1] CSC column pointers (species-major, since queries name few species)
+#   rows     int32    [nnz]         item row of each entry
+#   weights  float32  [nnz]         count_weights of the entry's count
+#   norms    float32  [items]       idf-weighted L2 norm of each item
+#   totals   float32  [items]       idf-weighted sum of each item, for Jaccard
+
+def write_snapshot(path, keys, vectors, weighting=None, watermark_ms=0):
+    """Write the snapshot of items keys[i] -> vectors[i] ({species: count}) to path; returns the header."""
+    weighting = weighting or count_weighting
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    species = sorted({s for vector in vectors for s in vector})
+    column = {s: i for i, s in enumerate(species)}
+
+    cols, rows, counts = [], [], []
+    for row, i in enumerate(order):
+        for s, count in vectors[i].items():
+            cols.append(column[s])
+            rows.append(row)
+            counts.append(count)
+    cols = np.array(cols, dtype=np.int64)
+    rows = np.array(rows, dtype=np.int32)
+    weights = count_weights(counts, weighting)
+
+    n_items = len(keys)
+    df = np.bincount(cols, minlength=len(species))
+    idf = (np.log((1 + n_items) / (1 + df)) + 1).astype(np.float32)
+    entry_idf = idf[cols]
+    norms = np.sqrt(np.bincount(rows, weights=(weights * entry_idf) ** 2, minlength=n_items)).astype(np.float32)
+    totals = np.bincount(rows, weights=weights * entry_idf, minlength=n_items).astype(np.float32)
+
+    by_column = np.argsort(cols, kind='stable')
+    col_ptr = np.zeros(len(species) + 1, dtype=np.int64)
+    np.cumsum(df, out=col_ptr[1:])
+    arrays = {
+        'keys': index_snapshot.encode_keys([keys[i] for i in order]),
+        'col_ptr': col_ptr,
+        'rows': rows[by_column],
+        'weights': weights[by_column],
+        'norms': norms,
+        'totals': totals,
+    }
+
+    header = {
+        'items': n_items,
+        'species': species,
+        'idf': idf.tolist(),
+        'count_weighting': weighting,
+        'watermark_ms': int(watermark_ms),
+    }
+    return index_snapshot.write_file(path, _magic, header, arrays)
+
+
+def read_header(path):
+    return index_snapshot.read_header(path, _magic, "similarity snapshot")
+
+
+class SimilarityIndex:
+    """
+    Top-k search over a memory-mapped snapshot plus an in-memory overlay of later writes.
+
+    Scoring multiplies the query vector into the CSC matrix once: the columns of the
+    query's species are concatenated and scattered into per-item scores with a single
+    add.at into a reused accumulator, so the cost follows the postings of those
+    species, not the item count.
+    """
+
+    def __init__(self, path):
+        header = read_header(path)
+        self.path = path
+        self.n_items = header['items']
+        self.species = header['species']
+        self.column = {s: i for i, s in enumerate(self.species)}
+        self.idf = np.array(header['idf'], dtype=np.float32)
+        self.weighting = header['count_weighting']
+        self.watermark_ms = header['watermark_ms']
+        # Pages are only read in as queries touch them, so a warm container's RSS stays small
+        self.arrays = index_snapshot.map_arrays(path, header)
+        # key -> {species: count}, or None for a deleted item; overrides its snapshot row
+        self.overlay = {}
+        # species -> {key: idf-weighted value} and key -> (norm, total) of live overlay items,
+        # so a query only touches the overlay items it shares a species with
+        self._overlay_postings = {}
+        self._overlay_stats = {}
+        # Snapshot rows overridden by the overlay, allocated on the first delta
+        self._masked = None
+        self._lock = threading.Lock()
+        # Zero between queries; allocating (and faulting in) a fresh one per query costs more than the multiply
+        self._accumulator = None
+        self._accumulator_lock = threading.Lock()
+
+    def __len__(self):
+        return self.n_items
+
+    def row_of(self, key):
+        keys = self.arrays['keys']
+        encoded = key.encode('utf-8')
+        row = int(np.searchsorted(keys, encoded))
+        return row if row < len(keys) and keys[row] == encoded else None
+
+    def apply(self, changes):
+        """Apply (key, {species: count} or None) changes from writes made after the snapshot."""
+        with self._lock:
+            masked = self._masked.copy() if self._masked is not None else np.zeros(self.n_items, dtype=bool)
+            for key, vector in changes:
+                for s in self.overlay.get(key) or ():
+                    self._overlay_postings[s].pop(key, None)
+                self._overlay_stats.pop(key, None)
+                self.overlay[key] = vector or None
+                if vector:
+                    values = self._weighted(vector)
+                    for s, value in values.items():
+                        self._overlay_postings.setdefault(s, {})[key] = value
+                    self._overlay_stats[key] = (float(np.sqrt(sum(v * v for v in values.values()))), sum(values.values()))
+                row = self.row_of(key)
+                if row is not None:
+                    masked[row] = True
+            # Swapped in whole, so a concurrent query sees the old or the new mask
+            self._masked = masked
+
+    def _weighted(self, vector):
+        species = list(vector)
+        weights = count_weights([vector[s] for s in species], self.weighting)
+        return {s: float(w) * self._idf_of(s) for s, w in zip(species, weights)}
+
+    def _idf_of(self, species):
+        column = self.column.get(species)
+        # Species first seen after the snapshot count as the rarest
+        return float(self.idf[column]) if column is not None else float(np.log(1 + self.n_items) + 1)
+
+    def query(self, vector, k=None, metric=None):
+        """Return up to k [(key, score)] most similar to vector ({species: count}), best first."""
+        k = k or default_top_k
+        metric = metric or similarity_metric
+        vector = {str(s).lower(): c for s, c in vector.items() if c and int(c) > 0}
+        if not vector:
+            return []
+
+        species = list(vector)
+        q = count_weights([vector[s] for s in species], self.weighting)
+        query = self._weighted(vector)
+        q_norm = float(np.sqrt(sum(v * v for v in query.values())))
+        q_total = sum(query.values())
+
+        with metrics.stage("search"):
+            scored = self._query_snapshot(species, q, q_norm, q_total, k, metric)
+            with self._lock:
+                scored.extend(self._query_overlay(query, q_norm, q_total, metric))
+        scored.sort(key=lambda pair: -pair[1])
+        return scored[:k]
+
+    def _query_snapshot(self, species, q, q_norm, q_total, k, metric):
+        columns = [(self.column[s], i) for i, s in enumerate(species) if s in self.column]
+        if not columns or self.n_items == 0:
+            return []
+        col_ptr, rows, weights = self.arrays['col_ptr'], self.arrays['rows'], self.arrays['weights']
+        spans = [(int(col_ptr[c]), int(col_ptr[c + 1]), i) for c, i in columns]
+        entry_rows = np.concatenate([rows[start:end] for start, end, _ in spans])
+        entry_weights = np.concatenate([weights[start:end] for start, end, _ in spans])
+        lengths = [end - start for start, end, _ in spans]
+        entry_q = np.repeat(np.array([q[i] for _, _, i in spans], dtype=np.float32), lengths)
+        entry_idf = np.repeat(self.idf[[c for c, _ in columns]], lengths)
+
+        if metric == "jaccard":
+            contributions = np.minimum(entry_weights, entry_q) * entry_idf
+        else:
+            contributions = entry_weights * entry_q * entry_idf ** 2
+
+        # Rows are unique within a column, so a one-species query needs no accumulation;
+        # otherwise an item in several columns appears once per column with the same total
+        candidates = entry_rows
+        if len(spans) == 1:
+            overlap = contributions
+        else:
+            with self._accumulator_lock:
+                if self._accumulator is None:
+                    self._accumulator = np.zeros(self.n_items, dtype=np.float32)
+                np.add.at(self._accumulator, entry_rows, contributions)
+                overlap = self._accumulator[entry_rows]
+                self._accumulator[entry_rows] = 0
+
+        masked = self._masked
+        if masked is not None:
+            live = ~masked[candidates]
+            candidates, overlap = candidates[live], overlap[live]
+        if not len(candidates):
+            return []
+        if metric == "jaccard":
+            union = self.arrays['totals'][candidates] + q_total - overlap
+            scores = overlap / np.maximum(union, 1e-9)
+        else:
+            scores = overlap / np.maximum(self.arrays['norms'][candidates] * q_norm, 1e-9)
+
+        take = k * len(spans)
+        if len(candidates) > take:
+            best = np.argpartition(-scores, take - 1)[:take]
+        else:
+            best = np.arange(len(candidates))
+        keys = self.arrays['keys']
+        found = {}
+        for i in best[np.argsort(-scores[best], kind='stable')]:
+            row = int(candidates[i])
+            if row not in found:
+                found[row] = float(scores[i])
+                if len(found) == k:
+                    break
+        return [(keys[row].decode('utf-8'), score) for row, score in found.items()]
+
+    def _query_overlay(self, query, q_norm, q_total, metric):
+        overlap = {}
+        for s, q_value in query.items():
+            for key, value in self._overlay_postings.get(s, {}).items():
+                overlap[key] = overlap.get(key, 0.0) + (min(value, q_value) if metric == "jaccard" else value * q_value)
+        scored = []
+        for key, value in overlap.items():
+            norm, total = self._overlay_stats[key]
+            if metric == "jaccard":
+                scored.append((key, value / max(total + q_total - value, 1e-9)))
+            else:
+                scored.append((key, value / max(norm * q_norm, 1e-9)))
+        return scored
+
+
+# === Deltas ===
+# One JSON object per stream batch, named by write time. A PUT can finish after a later
+# one, so a container re-lists from its cursor minus the margin and skips keys it applied.
+
+def _delta_key(timestamp_ms):
+    return f"{delta_prefix}{int(timestamp_ms):013d}-{uuid.uuid4().hex[:8]}.json"
+
+
+def _delta_ms(key):
+    return int(key[len(delta_prefix):len(delta_prefix) + 13])
+
+
+def put_delta(changes):
+    """Publish [(id, file_type, {species: count} or None)] for warm indexes to pick up."""
+    if not changes:
+        return None
+    key = _delta_key(time.time() * 1000)
+    body = [{'key': item_key(i, t), 'vector': vector} for i, t, vector in changes]
+    s3.put_object(Bucket=index_bucket, Key=key, Body=json.dumps(body).encode('utf-8'))
+    return key
+
+
+def _list_deltas(start_after):
+    kwargs = {'Bucket': index_bucket, 'Prefix': delta_prefix, 'StartAfter': start_after}
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        for entry in response.get('Contents', []):
+            yield entry['Key']
+        if not response.get('IsTruncated'):
+            return
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def _read_delta(key):
+    body = s3.get_object(Bucket=index_bucket, Key=key)['Body'].read()
+    return [(change['key'], change['vector']) for change in json.loads(body)]
+
+
+_deserializer = TypeDeserializer()
+
+
+def _from_stream_image(image):
+    return {k: _deserializer.deserialize(v) for k, v in image.items()} if image else None
+
+
+def stream_handler(event, context=None):
+    """
+    DynamoDB Streams handler for birds_table (NEW_AND_OLD_IMAGES).
+
+    Publishes the changed tag vectors as one delta, so warm query containers see new
+    and edited files before the next snapshot rebuild.
+    """
+    changes = []
+    for record in event.get('Records', []):
+        old = _from_stream_image(record['dynamodb'].get('OldImage'))
+        new = _from_stream_image(record['dynamodb'].get('NewImage'))
+        item = new or old
+        if item is None:
+            continue
+        changes.append((item['id'], item['file_type'], item_vector(new) if new is not None else None))
+    put_delta(changes)
+    return {"processed": len(changes)}
+
+
+# === Warm index ===
+
+_state = {'cursor_ms': 0, 'applied': set()}
+
+
+def _apply_deltas(index, loaded):
+    if loaded:
+        _state['cursor_ms'] = max(0, index.watermark_ms - delta_margin_ms)
+        _state['applied'] = set()
+    start_ms = max(0, _state['cursor_ms'] - delta_margin_ms)
+    for key in _list_deltas(f"{delta_prefix}{start_ms:013d}"):
+        if key in _state['applied']:
+            continue
+        index.apply(_read_delta(key))
+        _state['applied'].add(key)
+        _state['cursor_ms'] = max(_state['cursor_ms'], _delta_ms(key))
+    # Keys before the next listing window are never listed again
+    floor = f"{delta_prefix}{max(0, _state['cursor_ms'] - delta_margin_ms):013d}"
+    _state['applied'] = {key for key in _state['applied'] if key >= floor}
+
+
+_warm = index_snapshot.WarmIndex(
+    "similarity snapshot", index_bucket, snapshot_key, snapshot_path, refresh_seconds, SimilarityIndex, _apply_deltas
+)
+
+
+def get_index():
+    """
+    Return the container's index, or None if no snapshot has been built yet.
+
+    At most every SIMILARITY_REFRESH_SECONDS the snapshot ETag is checked (a new
+    snapshot replaces the index) and deltas written since are applied.
+    """
+    return _warm.get()
+
+
+def similar_items(tags, counts, k=None, metric=None):
+    """Return up to k [{"id", "file_type", "score"}] most similar to a file's tags and counts, or None without an index."""
+    index = get_index()
+    if index is None:
+        return None
+    matches = index.query(item_vector({'tags': tags, 'counts': counts}), k, metric)
+    return [
+        {'id': item_id, 'file_type': file_type, 'score': round(score, 4)}
+        for (item_id, file_type), score in ((parse_key(key), score) for key, score in matches)
+    ]
+
+
+def _https_url(url):
+    # Same rewrite as return_file_query_handler, so the UI gets identical links
+    if url and url.startswith("s3://"):
+        bucket, _, key = url[len("s3://"):].partition("/")
+        if key:
+            return f"https://{bucket}.s3.{region}.amazonaws.com/{key}"
+    return url
+
+
+def search_response(tags, counts, k=None, metric=None):
+    """
+    Rank birds_table by similarity to a file's tags and counts, in the response format of
+    return_file_query_handler (plus a score per result), or None without an index.
+    """
+    matches = similar_items(tags, counts, k, metric)
+    if matches is None:
+        return None
+    return matches_response(matches, tags, counts)
+
+
+def matches_response(matches, tags, counts, message="Found {} files similar to the uploaded file"):
+    """Look up ranked [{"id", "file_type", "score"}] matches and format them like return_file_query_handler."""
+    # ids are numbers on both sides: ints from parse_key, Decimals from DynamoDB
+    keys = [(int(m['id']), m['file_type']) for m in matches]
+    items = {(int(item['id']), item['file_type']): item for item in tag_index.fetch_items(keys)}
+
+    results = []
+    for (item_id, file_type), match in zip(keys, matches):
+        item = items.get((item_id, file_type))
+        if item is None:
+            continue
+        full_url = _https_url(item.get('s3_url'))
+        results.append({
+            'url': (_https_url(item.get('s3_thumbnail_url')) or full_url) if item['file_type'] == 'image' else full_url,
+            'fullUrl': full_url,
+            'fileName': item.get('file_name'),
+            'fileType': item['file_type'],
+            'detectedBirds': {str(t).lower(): int(c) for t, c in zip(item.get('tags') or [], item.get('counts') or [])},
+            'uploadDate': item.get('timestamp'),
+            'fileId': item_id,
+            'score': match['score'],
+        })
+
+    body = {
+        'message': message.format(len(results)),
+        'searchTags': tags,
+        'searchCounts': counts,
+        'links': [result['url'] for result in results],
+        'results': results,
+        'totalCount': len(results),
+        'summary': {
+            'matchingFiles': len(results),
+            'imageCount': sum(result['fileType'] == 'image' for result in results),
+            'videoCount': sum(result['fileType'] == 'video' for result in results),
+            'audioCount': sum(result['fileType'] == 'audio' for result in results),
+        },
+    }
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(body, default=str),
+    }
+
+
+# === Snapshot rebuild ===
+
+def _vector_entry(item):
+    vector = item_vector(item)
+    return (item_key(item['id'], item['file_type']), vector) if vector else None
+
+
+def rebuild_snapshot(total_segments=8, path=snapshot_path):
+    """Scan birds_table into a new snapshot, upload it, and prune deltas it already covers."""
+    watermark_ms = time.time() * 1000
+    entries = index_snapshot.parallel_scan(
+        birds_table_name, _vector_entry, total_segments, ProjectionExpression='id, file_type, tags, counts'
+    )
+    header = write_snapshot(path, [key for key, _ in entries], [vector for _, vector in entries], watermark_ms=watermark_ms)
+    s3.upload_file(path, index_bucket, snapshot_key)
+    print(f"Wrote similarity snapshot of {header['items']} items, {len(header['species'])} species "
+          f"({os.path.getsize(path)} bytes) to s3://{index_bucket}/{snapshot_key}")
+
+    # Containers replay deltas from the watermark minus the margin, so older ones are dead weight
+    cutoff = f"{delta_prefix}{max(0, int(watermark_ms) - 2 * delta_margin_ms):013d}"
+    stale = [key for key in _list_deltas(delta_prefix) if key < cutoff]
+    for start in range(0, len(stale), 1000):
+        s3.delete_objects(Bucket=index_bucket, Delete={'Objects': [{'Key': key} for key in stale[start:start + 1000]]})
+    return header
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the tag similarity snapshot from birds_table.")
+    parser.add_argument("--segments", type=int, default=8, help="Parallel scan segments")
+    args = parser.parse_args()
+    rebuild_snapshot(args.segments)
@@ -0,0 +1,186 @@
+import os
+import argparse
+import threading
+from datetime import datetime
+import numpy as np
+import boto3
+
+region = os.environ.get("AWS_REGION", "ap-southeast-2")
+s3 = boto3.client('s3', region_name=region)
+
+# === Multi-label settings ===
+# "top1" keeps the single best class per window, "multi" keeps every class above the threshold
+label_mode = os.environ.get("AUDIO_LABEL_MODE", "top1")
+multi_label_threshold = float(os.environ.get("AUDIO_MULTI_LABEL_THRESHOLD", "0.5"))
+sigmoid_sensitivity = float(os.environ.get("AUDIO_SIGMOID_SENSITIVITY", "1.0"))
+
+# === Species allowlist ===
+# Optional .npy in the model bucket, built by this module's CLI from the labels the runtime
+# loads: a bool mask over the model outputs, either (labels,) or one row per BirdNET week (48, labels)
+allowlist_bucket = os.environ.get("AUDIO_ALLOWLIST_BUCKET", "g116-models-s3")
+allowlist_key = os.environ.get("AUDIO_ALLOWLIST_KEY")
+allowlist_path = "/tmp/allowlist.npy"
+# Fixes the week row instead of using the current date
+allowlist_week = os.environ.get("AUDIO_ALLOWLIST_WEEK")
+
+weeks_per_year = 48
+
+
+def flat_sigmoid(logits, sensitivity=1.0):
+    """BirdNET's output activation: logits to independent per-class confidences."""
+    return 1.0 / (1.0 + np.exp(-sensitivity * np.clip(logits, -15, 15)))
+
+
+def birdnet_week(date=None):
+    """BirdNET's 48-week year: four weeks per month, 1-based."""
+    date = date or datetime.utcnow()
+    return (date.month - 1) * 4 + min(4, (date.day - 1) // 7 + 1)
+
+
+def read_region_file(path):
+    """
+    Parse a region species list into {week: set of scientific names}; week 0 means every week.
+
+    Each line is a label ("Scientific name_Common name") or a scientific name, optionally
+    prefixed by a week number and a tab or comma, e.g. "12,Turdus merula". Lines starting
+    with # are ignored.
+    """
+    weeks = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            week = 0
+            for sep in ('\t', ','):
+                head, _, rest = line.partition(sep)
+                if rest and head.strip().isdigit():
+                    week, line = int(head), rest.strip()
+                    break
+            weeks.setdefault(week, set()).add(line.split('_')[0])
+    return weeks
+
+
+def build_allowlist(labels, region_path):
+    """Return a (48, len(labels)) bool mask of the labels listed for each week of the region file."""
+    weeks = read_region_file(region_path)
+    scientific = np.array([label.split('_')[0] for label in labels])
+    every_week = np.isin(scientific, list(weeks.get(0, ())))
+    mask = np.tile(every_week, (weeks_per_year, 1))
+    for week, names in weeks.items():
+        if 1 <= week <= weeks_per_year:
+            mask[week - 1] |= np.isin(scientific, list(names))
+    return mask
+
+
+_allowlist = None
+_allowlist_lock = threading.Lock()
+
+
+def get_allowlist():
+    """Return the container-wide allowlist array (memory-mapped), or None when none is configured."""
+    global _allowlist
+    if not allowlist_key:
+        return None
+    with _allowlist_lock:
+        if _allowlist is None:
+            if not os.path.exists(allowlist_path):
+                s3.download_file(allowlist_bucket, allowlist_key, allowlist_path)
+                print(f"Downloaded species allowlist from s3://{allowlist_bucket}/{allowlist_key}")
+            _allowlist = np.load(allowlist_path, mmap_mode='r')
+        return _allowlist
+
+
+def allowlist_mask(num_labels, date=None):
+    """
+    Return (mask, tag): the bool allowlist row for the recording's week, or (None, "") when
+    no allowlist is configured. tag identifies the row in cache versions.
+    """
+    allowlist = get_allowlist()
+    if allowlist is None:
+        return None, ""
+    if allowlist.shape[-1] != num_labels:
+        # Indexed by model output, so a mask of another width would allow the wrong species
+        raise ValueError(
+            f"Species allowlist {allowlist_key} has {allowlist.shape[-1]} entries for {num_labels} labels; "
+            "rebuild it from the labels the runtime loads"
+        )
+    if allowlist.ndim == 1:
+        return np.asarray(allowlist, dtype=bool), f":allow:{allowlist_key}"
+    week = int(allowlist_week) if allowlist_week else birdnet_week(date)
+    return np.asarray(allowlist[week - 1], dtype=bool), f":allow:{allowlist_key}:w{week}"
+
+
+def output_mask(labels, date=None):
+    """
+    Return (mask, tag) to apply to the model outputs: the label table's bird-only mask,
+    narrowed by the allowlist row when one is configured. mask is None when neither applies.
+    """
+    mask, tag = allowlist_mask(len(labels), date)
+    bird_mask = getattr(labels, 'bird_mask', None)
+    if bird_mask is not None:
+        mask = np.asarray(bird_mask, dtype=bool) if mask is None else mask & bird_mask
+    return mask, tag
+
+
+class WindowScores:
+    """
+    Multi-label window statistics: per-class sigmoid confidences are masked by the
+    allowlist and thresholded per window, then accumulated as arrays.
+    """
+
+    def __init__(self, num_labels, threshold=0.5, sensitivity=1.0, mask=None):
+        self.threshold = threshold
+        self.sensitivity = sensitivity
+        self.mask = mask
+        self.counts = np.zeros(num_labels, dtype=np.int64)
+        self.max_confidence = np.zeros(num_labels, dtype=np.float32)
+        self.sum_confidence = np.zeros(num_labels, dtype=np.float64)
+
+    def add(self, logits):
+        scores = flat_sigmoid(logits, self.sensitivity)
+        if self.mask is not None:
+            scores = scores * self.mask
+        above = scores >= self.threshold
+        self.counts += above.sum(axis=0)
+        np.maximum(self.max_confidence, scores.max(axis=0), out=self.max_confidence)
+        self.sum_confidence += np.where(above, scores, 0.0).sum(axis=0)
+
+    def stats(self):
+        """Return {label_index: {"count", "max_confidence", "mean_confidence"}} for classes with any window."""
+        return {
+            int(idx): {
+                "count": int(self.counts[idx]),
+                "max_confidence": float(self.max_confidence[idx]),
+                "mean_confidence": float(self.sum_confidence[idx] / self.counts[idx]),
+            }
+            for idx in np.flatnonzero(self.counts)
+        }
+
+
+def settings_version(mask_tag=""):
+    """Cache version suffix for the label mode, threshold and allowlist in use."""
+    if label_mode != "multi":
+        return mask_tag
+    return f":multi:{multi_label_threshold}:{sigmoid_sensitivity}{mask_tag}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a per-week species allowlist mask for the BirdNET labels.")
+    parser.add_argument("region", help="Region species list (labels or scientific names, optionally week-prefixed)")
+    parser.add_argument("--labels", default=None,
+                        help="Compiled label artifact directory or labels file the runtime loads "
+                             "(default: its compiled artifact)")
+    parser.add_argument("--out", default="allowlist.npy")
+    args = parser.parse_args()
+
+    import birdnet_runtime
+
+    labels_source = args.labels or birdnet_runtime.labels_artifact_dir
+    if os.path.isdir(labels_source):
+        labels = birdnet_runtime.LabelTable.from_compiled(labels_source).labels
+    else:
+        labels = birdnet_runtime.LabelTable.from_file(labels_source).labels
+    mask = build_allowlist(labels, args.region)
+    np.save(args.out, mask)
+    print(f"Saved {mask.shape} allowlist to {args.out}; {int(mask.any(axis=0).sum())} of {len(labels)} labels allowed in some week")
@@ -0,0 +1,177 @@
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeDeserializer
+import metrics
+
+region = os.environ.get("AWS_REGION", "ap-southeast-2")
+dynamodb = boto3.resource('dynamodb', region_name=region)
+
+# === Inverted tag index ===
+# One row per (species, count, item): partition key "tag", sort key "count_key"
+# ("<zero-padded count>#<id>#<file_type>"), so "at least N birds of a species"
+# is a single key-range Query.
+birds_table_name = os.environ.get("BIRDS_TABLE", "birds_table")
+index_table_name = os.environ.get("TAG_INDEX_TABLE", "birds_tag_index")
+birds_table = dynamodb.Table(birds_table_name)
+index_table = dynamodb.Table(index_table_name)
+
+_count_width = 10
+
+
+def count_key(count, item_id, file_type):
+    return f"{int(count):0{_count_width}d}#{item_id}#{file_type}"
+
+
+def index_rows(item):
+    """Return the index rows for a birds_table item."""
+    rows = []
+    for tag, count in zip(item.get('tags') or [], item.get('counts') or []):
+        if not tag:
+            continue
+        rows.append({
+            'tag': str(tag).lower(),
+            'count_key': count_key(count, item['id'], item['file_type']),
+            'id': item['id'],
+            'file_type': item['file_type'],
+            'count': int(count),
+        })
+    return rows
+
+
+@metrics.timed("write")
+def write_index(item, previous=None, batch=None):
+    """
+    Index a birds_table item, removing the rows of its previous version if given.
+
+    Pass an open batch_writer as batch to group rows from several items.
+    """
+    new_rows = {(row['tag'], row['count_key']): row for row in index_rows(item)}
+    old_keys = {(row['tag'], row['count_key']) for row in index_rows(previous)} if previous else set()
+
+    def apply(writer):
+        for tag, key in old_keys - set(new_rows):
+            writer.delete_item(Key={'tag': tag, 'count_key': key})
+        for row in new_rows.values():
+            writer.put_item(Item=row)
+
+    if batch is not None:
+        apply(batch)
+    else:
+        with index_table.batch_writer(overwrite_by_pkeys=['tag', 'count_key']) as writer:
+            apply(writer)
+
+
+def remove_index(item, batch=None):
+    def apply(writer):
+        for row in index_rows(item):
+            writer.delete_item(Key={'tag': row['tag'], 'count_key': row['count_key']})
+
+    if batch is not None:
+        apply(batch)
+    else:
+        with index_table.batch_writer(overwrite_by_pkeys=['tag', 'count_key']) as writer:
+            apply(writer)
+
+
+def _query_tag(tag, min_count):
+    keys = {}
+    kwargs = {
+        'KeyConditionExpression': Key('tag').eq(tag.lower()) & Key('count_key').gte(f"{int(min_count):0{_count_width}d}#"),
+        'ProjectionExpression': 'id, file_type',
+    }
+    while True:
+        response = index_table.query(**kwargs)
+        for row in response['Items']:
+            keys[(row['id'], row['file_type'])] = None
+        if 'LastEvaluatedKey' not in response:
+            return keys
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def query_min_counts(criteria, match="all"):
+    """
+    Return the (id, file_type) keys of items with at least criteria[species] of every
+    species (match="all") or of any species (match="any").
+    """
+    result = None
+    # Query the most selective-looking (highest threshold) species first so the intersection shrinks fast
+    for tag, min_count in sorted(criteria.items(), key=lambda kv: -int(kv[1])):
+        keys = _query_tag(tag, min_count)
+        if result is None:
+            result = keys
+        elif match == "all":
+            result = {key: None for key in result if key in keys}
+        else:
+            result.update(keys)
+        if match == "all" and not result:
+            break
+    return list(result or [])
+
+
+def fetch_items(keys):
+    """BatchGet the birds_table items for (id, file_type) keys, 100 at a time."""
+    items = []
+    for start in range(0, len(keys), 100):
+        request = {birds_table_name: {'Keys': [{'id': i, 'file_type': t} for i, t in keys[start:start + 100]]}}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            items.extend(response['Responses'].get(birds_table_name, []))
+            request = response.get('UnprocessedKeys') or None
+    return items
+
+
+_deserializer = TypeDeserializer()
+
+
+def _from_stream_image(image):
+    return {k: _deserializer.deserialize(v) for k, v in image.items()} if image else None
+
+
+def stream_handler(event, context=None):
+    """
+    DynamoDB Streams handler for birds_table (NEW_AND_OLD_IMAGES).
+
+    Keeps the index in sync with writes made outside the tagging Lambdas,
+    such as manual tag edits and deletions.
+    """
+    with index_table.batch_writer(overwrite_by_pkeys=['tag', 'count_key']) as writer:
+        for record in event.get('Records', []):
+            old = _from_stream_image(record['dynamodb'].get('OldImage'))
+            new = _from_stream_image(record['dynamodb'].get('NewImage'))
+            if new is not None:
+                write_index(new, previous=old, batch=writer)
+            elif old is not None:
+                remove_index(old, batch=writer)
+    return {"processed": len(event.get('Records', []))}
+
+
+def _rebuild_segment(segment, total_segments):
+    indexed = 0
+    kwargs = {'Segment': segment, 'TotalSegments': total_segments, 'ProjectionExpression': 'id, file_type, tags, counts'}
+    with index_table.batch_writer(overwrite_by_pkeys=['tag', 'count_key']) as writer:
+        while True:
+            response = birds_table.scan(**kwargs)
+            for item in response['Items']:
+                write_index(item, batch=writer)
+                indexed += 1
+            if 'LastEvaluatedKey' not in response:
+                return indexed
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def rebuild_index(total_segments=8):
+    """Backfill the index from every birds_table item using a parallel segmented scan."""
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        counts = list(executor.map(lambda s: _rebuild_segment(s, total_segments), range(total_segments)))
+    print(f"Indexed {sum(counts)} items from {birds_table_name} into {index_table_name}")
+    return sum(counts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill the inverted tag index from birds_table.")
+    parser.add_argument("--segments", type=int, default=8, help="Parallel scan segments")
+    args = parser.parse_args()
+    rebuild_index(args.segments)
@@ -0,0 +1,59 @@
+import json
+from decimal import Decimal
+import numpy as np
+import pytest
+import audio_embeddings
+import index_snapshot
+import similarity_index
+import tag_index
+from audio_embeddings import AnnIndex, build_index
+
+
+class StubDynamoDB:
+    """batch_get_item over items, refusing keys whose id is not a number as birds_table would."""
+
+    def __init__(self, items):
+        self.items = {(int(item['id']), item['file_type']): item for item in items}
+
+    def batch_get_item(self, RequestItems):
+        (table, request), = RequestItems.items()
+        for key in request['Keys']:
+            assert isinstance(key['id'], (int, Decimal)), f"S-typed id {key['id']!r} for a numeric key"
+        found = [self.items[(int(key['id']), key['file_type'])] for key in request['Keys']
+                 if (int(key['id']), key['file_type']) in self.items]
+        return {'Responses': {table: found}, 'UnprocessedKeys': {}}
+
+
+@pytest.fixture
+def recordings(monkeypatch, tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = audio_embeddings.normalize(rng.normal(size=(64, 32)))
+    ids = [Decimal(5000 + i) for i in range(len(vectors))]
+    path = str(tmp_path / "ann.bin")
+    build_index(path, [index_snapshot.item_key(i, 'audio') for i in ids], vectors, nlist=4, m=8)
+    index = AnnIndex(path)
+    monkeypatch.setattr(audio_embeddings, 'get_index', lambda: index)
+    items = [{'id': i, 'file_type': 'audio', 'tags': ['magpie'], 'counts': [Decimal(1)],
+              's3_url': f"s3://g116-media-s3/audio/{i}.wav"} for i in ids]
+    monkeypatch.setattr(tag_index, 'dynamodb', StubDynamoDB(items))
+    return ids, vectors
+
+
+def test_similar_recordings_returns_numeric_ids(recordings):
+    ids, vectors = recordings
+    matches = audio_embeddings.similar_recordings(audio_embeddings.encode(vectors[7]), k=5)
+
+    assert len(matches) == 5
+    assert matches[0]['id'] == int(ids[7])
+    assert all(isinstance(match['id'], int) for match in matches)
+
+
+def test_sounds_like_response_end_to_end(recordings):
+    ids, vectors = recordings
+    matches = audio_embeddings.similar_recordings(audio_embeddings.encode(vectors[3]), k=3)
+    response = similarity_index.matches_response(matches, ['magpie'], [1], "Found {} recordings")
+
+    body = json.loads(response['body'])
+    assert body['totalCount'] == 3
+    assert body['results'][0]['fileId'] == int(ids[3])
+    assert body['summary']['audioCount'] == 3
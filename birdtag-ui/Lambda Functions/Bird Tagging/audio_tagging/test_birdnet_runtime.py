@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import filter_bird_labels
+import species_filter
+from birdnet_runtime import LabelTable
+
+LABELS = [
+    "Corvus orru_Torresian Crow",
+    "Dog_Dog",
+    "Setophaga petechia_Yellow Warbler",
+    "Setophaga coronata_Yellow-rumped Warbler",
+]
+
+
+def test_text_labels_mask_non_bird_outputs():
+    table = LabelTable(LABELS)
+
+    assert table.bird_mask.tolist() == [True, False, True, True]
+    assert LabelTable([LABELS[0], LABELS[2]]).bird_mask is None
+
+
+def test_compiled_labels_match_text_labels_by_default(tmp_path):
+    path = tmp_path / "labels.txt"
+    path.write_text("\n".join(LABELS) + "\n")
+    filter_bird_labels.compile_labels(str(path), str(tmp_path / "compiled"))
+
+    compiled = LabelTable.from_compiled(str(tmp_path / "compiled"))
+    text = LabelTable.from_file(str(path))
+
+    assert compiled.tag_keys == text.tag_keys == ["torresian crow", "dog", "yellow warbler", "yellow-rumped warbler"]
+    assert compiled.bird_mask.tolist() == text.bird_mask.tolist()
+    assert compiled.version.endswith(":species")
+
+
+def test_allowlist_of_another_width_fails(monkeypatch):
+    monkeypatch.setattr(species_filter, 'allowlist_key', 'allowlist.npy')
+    monkeypatch.setattr(species_filter, 'get_allowlist', lambda: np.ones((48, 3), dtype=bool))
+
+    with pytest.raises(ValueError, match="3 entries for 4 labels"):
+        species_filter.output_mask(LabelTable(LABELS))
@@ -0,0 +1,85 @@
+import io
+import hashlib
+import pytest
+import detection_cache
+import media_ingest
+
+DATA = bytes(range(256)) * 1000
+
+
+class StubS3:
+    """head_object and ranged get_object over one object, counting the bytes served."""
+
+    def __init__(self, data):
+        self.data = data
+        self.served = 0
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.data), 'ETag': '"e1"'}
+
+    def get_object(self, Bucket, Key, Range=None):
+        start, end = (int(v) for v in Range.split('=')[1].split('-')) if Range else (0, len(self.data) - 1)
+        self.served += end - start + 1
+        return {'Body': io.BytesIO(self.data[start:end + 1])}
+
+
+class StubCache:
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, digest, model_version):
+        return self.entries.get((digest, model_version))
+
+    def put(self, digest, model_version, result):
+        self.entries[(digest, model_version)] = result
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    stub = StubS3(DATA)
+    monkeypatch.setattr(media_ingest, 's3', stub)
+    # Small enough that the object is read by range
+    monkeypatch.setattr(media_ingest, 'in_memory_max_bytes', 1000)
+    monkeypatch.setattr(media_ingest, 'range_block_bytes', 4096)
+    return stub
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    stub = StubCache()
+    monkeypatch.setattr(detection_cache, 'get_cache', lambda: stub)
+    return stub
+
+
+def test_range_read_miss_downloads_once(s3, cache):
+    with media_ingest.open_s3_object("bucket", "audio/long.wav") as source:
+        result = detection_cache.cached_detection(
+            source, "v1", lambda: {"tags": ["owl"], "counts": [len(source.read())]}
+        )
+
+    assert result == {"tags": ["owl"], "counts": [len(DATA)]}
+    assert s3.served == len(DATA)
+    assert cache.get(hashlib.sha256(DATA).hexdigest(), "v1") == result
+    assert cache.get(detection_cache.object_digest('"e1"', len(DATA)), "v1") == result
+
+
+def test_range_read_hit_by_etag_reads_nothing(s3, cache):
+    cache.put(detection_cache.object_digest('"e1"', len(DATA)), "v1", {"tags": ["owl"], "counts": [1]})
+
+    with media_ingest.open_s3_object("bucket", "audio/long.wav") as source:
+        result = detection_cache.cached_detection(source, "v1", lambda: pytest.fail("model ran"))
+
+    assert result == {"tags": ["owl"], "counts": [1]}
+    assert s3.served == 0
+
+
+def test_partial_read_fetches_only_the_rest_to_hash(s3):
+    reader = media_ingest.S3RangeReader("bucket", "audio/long.wav")
+    reader.seek(len(DATA) - 10)
+    reader.read(10)
+    reader.seek(0)
+    reader.read(5000)
+
+    assert reader.hexdigest() == hashlib.sha256(DATA).hexdigest()
+    # The tail block was fetched for the header read and again for the hash, nothing else twice
+    assert s3.served <= len(DATA) + 4096
@@ -0,0 +1,375 @@
+"""
+End-to-end benchmark of the tagging and query Lambdas against local AWS stand-ins.
+
+S3 and DynamoDB are served by a moto server and the downstream
+return_file_query_handler Lambda is replaced in-process, so nothing touches AWS.
+Each handler runs in its own worker process (one per simulated container) over a
+fixed synthetic media corpus. The report covers per-stage latency, throughput at
+each concurrency level and peak RSS. Results can be saved as a baseline and later
+runs compared against it.
+
+    pip install -r requirements.txt
+    python bench_e2e.py --save-baseline
+    python bench_e2e.py --concurrency 1 4 8      # exits 1 if anything regressed past --tolerance
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import importlib
+import subprocess
+from itertools import cycle, islice
+import stage_timing
+
+# numpy, boto3 and the fixtures are imported inside the functions that need them, so a
+# worker's init time covers only what the handler module itself imports
+
+here = os.path.dirname(os.path.abspath(__file__))
+bird_tagging_dir = os.path.dirname(here)
+
+# name -> (handler directory, module, handler function, media kinds, event shape, model needed)
+scenarios = {
+    "bird_detection": ("image_video_tagging", "lambda_bird_detection", "lambda_handler", ("image", "video"), "tagging", "detector"),
+    "bird_detection_batch": ("image_video_tagging", "lambda_bird_detection", "batch_handler", ("image", "video"), "sqs", "detector"),
+    "query_image_video": ("image_video_tagging", "lambda_query_imageVideo", "lambda_handler", ("image", "video"), "query", "detector"),
+    "audio": ("audio_tagging", "lambda_audio", "lambda_handler", ("audio",), "tagging", "audio"),
+    "audio_batch": ("audio_tagging", "lambda_audio", "batch_handler", ("audio",), "sqs", "audio"),
+    "query_audio": ("audio_tagging", "lambda_query_audio", "lambda_handler", ("audio",), "query", "audio"),
+}
+
+# Metrics compared against the baseline; True where higher is better
+compared_metrics = {"cold_ms": False, "p50_ms": False, "p95_ms": False, "throughput": True, "peak_rss_mb": False}
+# Stage means below this are too small to compare meaningfully
+min_compared_stage_ms = 1.0
+
+
+# === Worker: one simulated Lambda container ===
+
+def peak_rss_mb():
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def invoke(handler, event, timer):
+    timer.reset()
+    error = None
+    start_wall, start = time.time(), time.perf_counter()
+    try:
+        response = handler(event, None)
+        if isinstance(response, dict):
+            if "message" in response or "error" in response:
+                error = str(response.get("message") or response.get("error"))[:200]
+            elif response.get("batchItemFailures"):
+                error = f"{len(response['batchItemFailures'])} batch item failures"
+    except Exception as e:
+        error = repr(e)[:200]
+    total_ms = (time.perf_counter() - start) * 1000
+    return {"start": start_wall, "end": time.time(), "total_ms": total_ms, "stages": timer.reset(), "error": error}
+
+
+def run_worker(config_path):
+    with open(config_path) as f:
+        config = json.load(f)
+
+    # Handler output goes to a log file; stdout carries the JSON protocol lines
+    protocol = os.fdopen(os.dup(1), "w")
+    log = open(os.path.join(config["work_dir"], "handler.log"), "w")
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+
+    def send(message):
+        protocol.write(json.dumps(message) + "\n")
+        protocol.flush()
+
+    sys.path.insert(0, config["handler_dir"])
+    start = time.perf_counter()
+    module = importlib.import_module(config["module"])
+    init_ms = (time.perf_counter() - start) * 1000
+
+    # Models land in this worker's directory, so every worker starts cold
+    work_dir = config["work_dir"]
+    if "detector_backends" in sys.modules:
+        backends = sys.modules["detector_backends"].backends
+        for backend, (key, _) in list(backends.items()):
+            backends[backend] = (key, os.path.join(work_dir, os.path.basename(key)))
+    if "birdnet_runtime" in sys.modules:
+        sys.modules["birdnet_runtime"].model_path = os.path.join(work_dir, "model.tflite")
+        sys.modules["birdnet_runtime"].label_path = os.path.join(work_dir, "labels.txt")
+    if "species_filter" in sys.modules:
+        sys.modules["species_filter"].allowlist_path = os.path.join(work_dir, "allowlist.npy")
+
+    import boto3
+    import bench_fixtures
+
+    timer = stage_timing.StageTimer()
+    timer.install()
+    if hasattr(module, "lambda_client"):
+        table = boto3.resource("dynamodb", region_name=bench_fixtures.region).Table(bench_fixtures.birds_table_name)
+        module.lambda_client = bench_fixtures.FakeReturnFileQuery(table)
+        timer.wrap_client(module.lambda_client, "invoke", "invoke")
+
+    handler = getattr(module, config["handler"])
+    cold = invoke(handler, config["warmup"], timer)
+    send({"ready": True, "init_ms": init_ms, "cold": cold})
+
+    sys.stdin.readline()
+    records = [invoke(handler, event, timer) for event in config["events"]]
+    send({"records": records, "peak_rss_mb": peak_rss_mb()})
+
+
+# === Driver ===
+
+def build_events(kind_filter, shape, urls, manifest, batch_size):
+    entries = [e for e in manifest["files"] if e["kind"] in kind_filter]
+    single = []
+    for entry in entries:
+        url = urls[entry["name"]]
+        if shape == "query":
+            single.append({"file_name": entry["name"], "file_type": entry["kind"], "s3_url": url})
+        else:
+            single.append({"fileName": entry["name"], "type": entry["kind"], "originalUrl": url, "thumbnailUrl": None})
+    if shape != "sqs":
+        return single
+
+    # Each invocation is an SQS batch of batch_size tagging events, cycling through the corpus
+    events = []
+    bodies = cycle(single)
+    for n in range(len(single)):
+        records = [{"messageId": f"msg-{n}-{i}", "body": json.dumps(next(bodies))} for i in range(batch_size)]
+        events.append({"Records": records})
+    return events
+
+
+def run_scenario(name, concurrency, invocations, events, env, work_root):
+    handler_dir, module, handler = os.path.join(bird_tagging_dir, scenarios[name][0]), scenarios[name][1], scenarios[name][2]
+    measured = list(islice(cycle(events), invocations))
+
+    workers = []
+    for n in range(concurrency):
+        work_dir = tempfile.mkdtemp(prefix=f"{name}-c{concurrency}-w{n}-", dir=work_root)
+        config_path = os.path.join(work_dir, "worker.json")
+        with open(config_path, "w") as f:
+            json.dump({
+                "handler_dir": handler_dir, "module": module, "handler": handler, "work_dir": work_dir,
+                "warmup": events[n % len(events)], "events": measured[n::concurrency],
+            }, f)
+        worker_env = dict(env, INGEST_TMP_DIR=work_dir, TMPDIR=work_dir)
+        proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--worker", config_path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, cwd=handler_dir, env=worker_env,
+        )
+        workers.append((proc, work_dir))
+
+    def receive(proc, work_dir):
+        line = proc.stdout.readline()
+        if not line:
+            proc.wait()
+            with open(os.path.join(work_dir, "handler.log")) as f:
+                tail = f.read()[-2000:]
+            raise RuntimeError(f"{name} worker exited with {proc.returncode}:\n{tail}")
+        return json.loads(line)
+
+    try:
+        # Every worker initialises and serves its cold invocation before the timed phase starts together
+        ready = [receive(proc, work_dir) for proc, work_dir in workers]
+        for proc, _ in workers:
+            proc.stdin.write("go\n")
+            proc.stdin.flush()
+        done = [receive(proc, work_dir) for proc, work_dir in workers]
+    finally:
+        for proc, _ in workers:
+            proc.stdin.close()
+            proc.wait()
+
+    return summarize(ready, done)
+
+
+def summarize(ready, done):
+    import numpy as np
+
+    records = [record for worker in done for record in worker["records"]]
+    totals = np.array([r["total_ms"] for r in records]) if records else np.zeros(1)
+    span = max(r["end"] for r in records) - min(r["start"] for r in records) if records else 0.0
+    stage_means = {
+        stage: float(np.mean([r["stages"].get(stage, 0.0) for r in records])) if records else 0.0
+        for stage in stage_timing.stages
+    }
+    stage_means["other"] = max(0.0, float(np.mean(totals)) - sum(stage_means.values()))
+    errors = [r["error"] for r in records + [w["cold"] for w in ready] if r["error"]]
+    return {
+        "init_ms": float(np.median([w["init_ms"] for w in ready])),
+        "cold_ms": float(np.median([w["cold"]["total_ms"] for w in ready])),
+        "cold_stages": {k: float(v) for k, v in ready[0]["cold"]["stages"].items()},
+        "p50_ms": float(np.percentile(totals, 50)),
+        "p95_ms": float(np.percentile(totals, 95)),
+        "throughput": len(records) / span if span > 0 else 0.0,
+        "peak_rss_mb": max(w["peak_rss_mb"] for w in done),
+        "stages": stage_means,
+        "invocations": len(records),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of (key, metric, baseline value, current value, change) regressions."""
+    regressions = []
+    for key, current in results["results"].items():
+        previous = baseline.get("results", {}).get(key)
+        if previous is None:
+            continue
+        for metric, higher_better in compared_metrics.items():
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if higher_better else change) > tolerance:
+                regressions.append((key, metric, old, new, change))
+        for stage, old in previous.get("stages", {}).items():
+            new = current["stages"].get(stage, 0.0)
+            if old >= min_compared_stage_ms and (new - old) / old > tolerance:
+                regressions.append((key, f"stage:{stage}", old, new, (new - old) / old))
+    return regressions
+
+
+def print_report(results):
+    print(f"\n{'scenario':<28} {'init ms':>8} {'cold ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'inv/s':>7} {'RSS MB':>7} {'errors':>6}")
+    for key, r in results["results"].items():
+        print(f"{key:<28} {r['init_ms']:>8.0f} {r['cold_ms']:>8.0f} {r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} "
+              f"{r['throughput']:>7.2f} {r['peak_rss_mb']:>7.0f} {r['errors']:>6}")
+
+    stage_names = stage_timing.stages + ("other",)
+    print("\nMean warm stage ms (summed over threads, so pipelined handlers can exceed their latency)")
+    print(f"{'scenario':<28} " + " ".join(f"{stage:>10}" for stage in stage_names))
+    for key, r in results["results"].items():
+        print(f"{key:<28} " + " ".join(f"{r['stages'].get(stage, 0.0):>10.1f}" for stage in stage_names))
+
+    for key, r in results["results"].items():
+        if r["first_error"]:
+            print(f"{key}: {r['errors']} failed invocations, e.g. {r['first_error']}")
+
+
+def prepare_models(args, endpoint):
+    """Upload the given or synthetic models; returns (available, model digests for the report)."""
+    import bench_fixtures
+
+    models_dir = os.path.join(args.work_dir, "models")
+    os.makedirs(models_dir, exist_ok=True)
+
+    detector = args.detector_model
+    if detector is None:
+        try:
+            detector = bench_fixtures.build_synthetic_detector(os.path.join(models_dir, "synthetic_detector.onnx"))
+        except ImportError:
+            print("onnx is not installed and no --detector-model was given; skipping image/video scenarios")
+    backend = args.detector_backend or ("torch" if detector and detector.endswith(".pt") else "onnx")
+
+    birdnet = args.birdnet_model
+    if birdnet is None:
+        with open(args.labels) as f:
+            num_labels = sum(1 for line in f if line.strip())
+        try:
+            birdnet = bench_fixtures.build_synthetic_birdnet(os.path.join(models_dir, "synthetic_birdnet.tflite"), num_labels)
+        except ImportError:
+            print("TensorFlow is not installed and no --birdnet-model was given; skipping audio scenarios")
+
+    available = bench_fixtures.upload_models(endpoint, detector, backend, birdnet, args.labels)
+    digests = {
+        "detector": f"{backend}:{bench_fixtures.file_digest(detector)[:12]}" if detector else None,
+        "birdnet": bench_fixtures.file_digest(birdnet)[:12] if birdnet else None,
+    }
+    return available, digests
+
+
+def main():
+    import bench_fixtures
+
+    parser = argparse.ArgumentParser(description="Benchmark the Lambda handlers end to end against local AWS stand-ins.")
+    parser.add_argument("--scenarios", nargs="+", default=list(scenarios), choices=list(scenarios))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4], help="Concurrent containers per run")
+    parser.add_argument("--invocations", type=int, default=24, help="Timed invocations per scenario and concurrency")
+    parser.add_argument("--batch-size", type=int, default=10, help="Files per SQS batch in the batch scenarios")
+    parser.add_argument("--detector-model", help="Detector to benchmark (.pt or .onnx); default: a synthetic ONNX model")
+    parser.add_argument("--detector-backend", choices=list(bench_fixtures.detector_keys))
+    parser.add_argument("--birdnet-model", help="BirdNET .tflite to benchmark; default: a synthetic model (needs TensorFlow)")
+    parser.add_argument("--labels", default=os.path.join(bird_tagging_dir, "audio_tagging", "BirdNET_GLOBAL_6K_V2.4_Labels_Birds_Only.txt"))
+    parser.add_argument("--cache", action="store_true", help="Leave the detection cache on (repeated media then hits it)")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "birdtag-bench"))
+    parser.add_argument("--output", help="Also write the results JSON here")
+    parser.add_argument("--baseline", default=os.path.join(here, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative slowdown before a metric counts as regressed")
+    args = parser.parse_args()
+
+    manifest = bench_fixtures.build_corpus(os.path.join(args.work_dir, "corpus"))
+    results = {"meta": {}, "results": {}}
+
+    with bench_fixtures.MotoEndpoint() as endpoint:
+        bench_fixtures.create_resources(endpoint)
+        urls = bench_fixtures.upload_corpus(endpoint, manifest)
+        available, digests = prepare_models(args, endpoint)
+
+        env = dict(os.environ, **endpoint.env())
+        env["PREWARM"] = "off"
+        env["DETECTION_CACHE"] = "on" if args.cache else "off"
+        if available["detector"]:
+            env["DETECTOR_BACKEND"] = available["detector"]
+
+        results["meta"] = {
+            "corpus": manifest["digest"],
+            "models": digests,
+            "cache": args.cache,
+            "batch_size": args.batch_size,
+            "python": platform.python_version(),
+            "machine": f"{platform.system()} {platform.machine()}, {os.cpu_count()} CPUs",
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+
+        runs_root = tempfile.mkdtemp(prefix="runs-", dir=args.work_dir)
+        for name in args.scenarios:
+            _, _, _, kinds, shape, needs = scenarios[name]
+            if not (available["detector"] if needs == "detector" else available["audio"]):
+                continue
+            events = build_events(kinds, shape, urls, manifest, args.batch_size)
+            for concurrency in args.concurrency:
+                key = f"{name}@{concurrency}"
+                print(f"Running {key} ({args.invocations} invocations)")
+                results["results"][key] = run_scenario(name, concurrency, args.invocations, events, env, runs_root)
+
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    status = 0
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for field in ("corpus", "models", "cache", "batch_size", "machine"):
+            if baseline["meta"].get(field) != results["meta"].get(field):
+                print(f"Warning: baseline {field} differs ({baseline['meta'].get(field)} vs {results['meta'].get(field)})")
+        regressions = compare(results, baseline, args.tolerance)
+        print(f"\nCompared with baseline from {baseline['meta'].get('timestamp')}: {len(regressions)} regressions")
+        for key, metric, old, new, change in regressions:
+            print(f"  {key:<28} {metric:<18} {old:>10.1f} -> {new:>10.1f} ({change:+.0%})")
+        status = 1 if regressions else 0
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--worker"]:
+        run_worker(sys.argv[2])
+    else:
+        main()
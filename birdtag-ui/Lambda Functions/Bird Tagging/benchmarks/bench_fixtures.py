@@ -0,0 +1,335 @@
+import io
+import os
+import json
+import socket
+import hashlib
+import numpy as np
+import boto3
+
+# === Fixture layout ===
+# Bucket, table and key names the handlers use in production
+region = "ap-southeast-2"
+model_bucket = "g116-models-s3"
+media_bucket = "g116-media-s3"
+birds_table_name = "birds_table"
+index_table_name = "birds_tag_index"
+cache_table_name = "detection_cache"
+
+detector_keys = {
+    "torch": "model/image_video_model.pt",
+    "onnx": "model/image_video_model.onnx",
+    "onnx_int8": "model/image_video_model.int8.onnx",
+}
+birdnet_model_key = "model/BirdNET_GLOBAL_6K_V2.4_Model_FP32.tflite"
+birdnet_label_key = "model/BirdNET_GLOBAL_6K_V2.4_Labels.txt"
+
+synthetic_class_names = ["crow", "magpie", "pigeon", "sparrow", "kingfisher", "myna", "owl", "peacock", "robin", "wren"]
+
+# Fixed media corpus: (kind, name, generation parameters). Bump corpus_version when it changes,
+# since baselines are only comparable over the same corpus.
+corpus_version = 1
+corpus_spec = [
+    ("image", "small_640x480.jpg", {"width": 640, "height": 480}),
+    ("image", "hd_1280x720.jpg", {"width": 1280, "height": 720}),
+    ("image", "fhd_1920x1080.jpg", {"width": 1920, "height": 1080}),
+    ("image", "camera_4000x3000.jpg", {"width": 4000, "height": 3000}),
+    ("video", "clip_640x360_10s.mp4", {"width": 640, "height": 360, "fps": 25, "seconds": 10}),
+    ("video", "clip_1280x720_5s.mp4", {"width": 1280, "height": 720, "fps": 30, "seconds": 5}),
+    ("audio", "call_48k_mono_3s.wav", {"sr": 48000, "channels": 1, "seconds": 3}),
+    ("audio", "song_44k_stereo_30s.wav", {"sr": 44100, "channels": 2, "seconds": 30}),
+    ("audio", "dawn_22k_mono_120s.wav", {"sr": 22050, "channels": 1, "seconds": 120}),
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def file_digest(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# === Media corpus ===
+
+def _scene(rng, width, height, birds, t=0.0):
+    """A sky-to-ground gradient with noise and a few dark ellipses drifting across it."""
+    import cv2 as cv
+
+    sky = np.linspace([235, 200, 150], [70, 120, 60], height, dtype=np.float32)
+    img = np.repeat(sky[:, None, :], width, axis=1)
+    img += rng.normal(0, 12, img.shape).astype(np.float32)
+    img = np.clip(img, 0, 255).astype(np.uint8)
+    for x, y, size, speed in birds:
+        cx = int((x + speed * t) % 1.0 * width)
+        cy = int(y * height)
+        axes = (max(2, int(size * width)), max(1, int(size * width * 0.4)))
+        cv.ellipse(img, (cx, cy), axes, 0, 0, 360, (30, 30, 40), -1)
+    return img
+
+
+def _random_birds(rng, n):
+    return [(rng.random(), rng.uniform(0.15, 0.7), rng.uniform(0.02, 0.08), rng.uniform(0.02, 0.1)) for _ in range(n)]
+
+
+def write_image(path, width, height, seed):
+    import cv2 as cv
+
+    rng = np.random.default_rng(seed)
+    cv.imwrite(path, _scene(rng, width, height, _random_birds(rng, 4)), [cv.IMWRITE_JPEG_QUALITY, 90])
+
+
+def write_video(path, width, height, fps, seconds, seed):
+    import cv2 as cv
+
+    rng = np.random.default_rng(seed)
+    birds = _random_birds(rng, 3)
+    writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    try:
+        for i in range(int(fps * seconds)):
+            writer.write(_scene(rng, width, height, birds, t=i / fps))
+    finally:
+        writer.release()
+
+
+def write_audio(path, sr, channels, seconds, seed):
+    import soundfile as sf
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(sr * seconds)) / sr
+    # Repeating two-note calls over background noise
+    calls = np.sin(2 * np.pi * np.where((t % 1.0) < 0.5, 3200, 4100) * t) * ((t % 1.0) < 0.8)
+    signal = 0.25 * calls + 0.02 * rng.standard_normal(len(t))
+    audio = np.stack([signal] * channels, axis=1) if channels > 1 else signal
+    sf.write(path, audio.astype(np.float32), sr, subtype='PCM_16')
+
+
+def build_corpus(directory):
+    """
+    Generate the fixed media corpus into directory (once; reused while the manifest matches).
+
+    Returns the manifest: {"version", "files": [{"kind", "name", "path", "sha256", "bytes"}], "digest"}.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get("version") == corpus_version and all(os.path.exists(e["path"]) for e in manifest["files"]):
+            return manifest
+
+    files = []
+    for seed, (kind, name, params) in enumerate(corpus_spec):
+        path = os.path.join(directory, name)
+        if kind == "image":
+            write_image(path, seed=seed, **params)
+        elif kind == "video":
+            write_video(path, seed=seed, **params)
+        else:
+            write_audio(path, seed=seed, **params)
+        files.append({"kind": kind, "name": name, "path": path,
+                      "sha256": file_digest(path), "bytes": os.path.getsize(path)})
+
+    # Encoders differ between OpenCV/libsndfile builds, so the digest tells whether two runs saw the same bytes
+    digest = hashlib.sha256("".join(e["sha256"] for e in files).encode()).hexdigest()[:16]
+    manifest = {"version": corpus_version, "files": files, "digest": digest}
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Generated media corpus {digest} in {directory}")
+    return manifest
+
+
+# === Synthetic models ===
+
+def build_synthetic_detector(path, num_classes=len(synthetic_class_names), imgsz=640, stride=32, seed=0):
+    """
+    Write a tiny YOLOv8-shaped ONNX detector: (batch, 3, imgsz, imgsz) -> (batch, 4 + classes, anchors).
+
+    One strided convolution stands in for the network, so the detector's cost is almost
+    all letterboxing, session overhead and NMS over (imgsz / stride)^2 candidate boxes.
+    """
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    rng = np.random.default_rng(seed)
+    channels = 4 + num_classes
+    weights = rng.normal(0, 0.02, (channels, 3, stride, stride)).astype(np.float32)
+    bias = rng.normal(0, 1.0, channels).astype(np.float32)
+    # Sigmoid outputs scaled into box centres, box sizes and class scores
+    scale = np.array([imgsz, imgsz, imgsz / 8, imgsz / 8] + [1.0] * num_classes, dtype=np.float32).reshape(1, channels, 1)
+
+    graph = helper.make_graph(
+        [
+            helper.make_node("Conv", ["images", "W", "B"], ["features"], kernel_shape=[stride, stride], strides=[stride, stride]),
+            helper.make_node("Reshape", ["features", "shape"], ["flat"]),
+            helper.make_node("Sigmoid", ["flat"], ["activated"]),
+            helper.make_node("Mul", ["activated", "scale"], ["output0"]),
+        ],
+        "synthetic_detector",
+        [helper.make_tensor_value_info("images", TensorProto.FLOAT, ["batch", 3, imgsz, imgsz])],
+        [helper.make_tensor_value_info("output0", TensorProto.FLOAT, ["batch", channels, (imgsz // stride) ** 2])],
+        initializer=[
+            numpy_helper.from_array(weights, "W"),
+            numpy_helper.from_array(bias, "B"),
+            numpy_helper.from_array(np.array([0, channels, -1], dtype=np.int64), "shape"),
+            numpy_helper.from_array(scale, "scale"),
+        ],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    # Same metadata key the ultralytics export writes
+    helper.set_model_props(model, {"names": repr(dict(enumerate(synthetic_class_names[:num_classes])))})
+    onnx.checker.check_model(model)
+    onnx.save(model, path)
+    return path
+
+
+def build_synthetic_birdnet(path, num_labels, window_len=144000):
+    """
+    Write a small TFLite model with BirdNET's interface: (batch, window_len) float32 -> (batch, num_labels) logits.
+
+    Needs TensorFlow on the machine building the fixtures only.
+    """
+    import tensorflow as tf
+
+    tf.random.set_seed(0)
+    frames = window_len // 480
+    model = tf.keras.Sequential([
+        tf.keras.layers.InputLayer(input_shape=(window_len,)),
+        tf.keras.layers.Reshape((frames, 480)),
+        tf.keras.layers.Dense(32, activation="relu"),
+        tf.keras.layers.GlobalAveragePooling1D(),
+        tf.keras.layers.Dense(num_labels),
+    ])
+    with open(path, "wb") as f:
+        f.write(tf.lite.TFLiteConverter.from_keras_model(model).convert())
+    return path
+
+
+# === AWS stand-ins ===
+
+class MotoEndpoint:
+    """A moto server shared by the benchmark workers; handlers reach it through AWS_ENDPOINT_URL."""
+
+    def __init__(self, port=None):
+        from moto.server import ThreadedMotoServer
+
+        self.port = port or free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.server = ThreadedMotoServer(ip_address="127.0.0.1", port=self.port, verbose=False)
+
+    def __enter__(self):
+        self.server.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.stop()
+
+    def env(self):
+        """Environment for worker processes (boto3 >= 1.28 reads AWS_ENDPOINT_URL)."""
+        return {
+            "AWS_ENDPOINT_URL": self.url,
+            "AWS_REGION": region,
+            "AWS_DEFAULT_REGION": region,
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "AWS_SESSION_TOKEN": "testing",
+        }
+
+    def client(self, service):
+        return boto3.client(service, region_name=region, endpoint_url=self.url,
+                            aws_access_key_id="testing", aws_secret_access_key="testing")
+
+
+def create_resources(endpoint):
+    """Create the buckets and tables the handlers expect, with production key schemas."""
+    s3 = endpoint.client("s3")
+    for bucket in (model_bucket, media_bucket):
+        s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": region})
+
+    dynamodb = endpoint.client("dynamodb")
+    dynamodb.create_table(
+        TableName=birds_table_name,
+        KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}, {"AttributeName": "file_type", "KeyType": "RANGE"}],
+        AttributeDefinitions=[
+            {"AttributeName": "id", "AttributeType": "N"},
+            {"AttributeName": "file_type", "AttributeType": "S"},
+            {"AttributeName": "upload_date", "AttributeType": "S"},
+        ],
+        GlobalSecondaryIndexes=[{
+            "IndexName": "upload_date-id-index",
+            "KeySchema": [{"AttributeName": "upload_date", "KeyType": "HASH"}, {"AttributeName": "id", "KeyType": "RANGE"}],
+            "Projection": {"ProjectionType": "ALL"},
+        }],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    dynamodb.create_table(
+        TableName=index_table_name,
+        KeySchema=[{"AttributeName": "tag", "KeyType": "HASH"}, {"AttributeName": "count_key", "KeyType": "RANGE"}],
+        AttributeDefinitions=[
+            {"AttributeName": "tag", "AttributeType": "S"},
+            {"AttributeName": "count_key", "AttributeType": "S"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    dynamodb.create_table(
+        TableName=cache_table_name,
+        KeySchema=[{"AttributeName": "cache_key", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "cache_key", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+
+def upload_corpus(endpoint, manifest):
+    """Upload the corpus under "<type>/<fileName>" like the upload Lambda; returns {name: originalUrl}."""
+    s3 = endpoint.client("s3")
+    urls = {}
+    for entry in manifest["files"]:
+        key = f"{entry['kind']}/{entry['name']}"
+        s3.upload_file(entry["path"], media_bucket, key)
+        urls[entry["name"]] = f"https://{media_bucket}.s3.{region}.amazonaws.com/{key}"
+    return urls
+
+
+def upload_models(endpoint, detector=None, detector_backend="onnx", birdnet=None, labels=None):
+    """Upload the model files that were built or given; returns {"detector": backend, "audio": bool}."""
+    s3 = endpoint.client("s3")
+    available = {"detector": None, "audio": False}
+    if detector:
+        s3.upload_file(detector, model_bucket, detector_keys[detector_backend])
+        available["detector"] = detector_backend
+    if birdnet and labels:
+        s3.upload_file(birdnet, model_bucket, birdnet_model_key)
+        s3.upload_file(labels, model_bucket, birdnet_label_key)
+        available["audio"] = True
+    return available
+
+
+class FakeReturnFileQuery:
+    """
+    In-process stand-in for the return_file_query_handler Lambda (ReturnFileQueryHandler.js):
+    scans birds_table and keeps files holding any of the tags with at least the given count.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def invoke(self, FunctionName, InvocationType="RequestResponse", Payload=b"{}"):
+        event = json.loads(Payload)
+        tags = [str(tag).lower().strip() for tag in event.get("tags") or []]
+        counts = event.get("counts") or []
+        results = []
+        for item in self.table.scan().get("Items", []):
+            file_counts = {str(tag).lower().strip(): int(count)
+                           for tag, count in zip(item.get("tags") or [], item.get("counts") or [])}
+            for i, tag in enumerate(tags):
+                if file_counts.get(tag, 0) >= int(counts[i] if i < len(counts) else 1):
+                    results.append({"id": str(item["id"]), "s3_url": item.get("s3_url"), "file_type": item["file_type"]})
+                    break
+        body = {"tags": tags, "counts": counts, "results": results, "totalCount": len(results)}
+        payload = {"statusCode": 200, "body": json.dumps(body)}
+        return {"StatusCode": 200, "Payload": io.BytesIO(json.dumps(payload).encode("utf-8"))}
@@ -0,0 +1,122 @@
+import sys
+import time
+import inspect
+import functools
+import importlib
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+stages = ("model_load", "download", "decode", "preprocess", "inference", "write", "invoke")
+
+# (module, attribute path, stage) wrapped in the handler's process. Time is exclusive: a
+# probe nested in another (letterboxing inside detect, ranged reads inside decoding)
+# is charged to its own stage only. Probes whose module or attribute is missing are skipped.
+probes = [
+    ("model_registry", "get_model", "model_load"),
+    ("birdnet_runtime", "get_runtime", "model_load"),
+
+    ("media_ingest", "S3Download.__init__", "download"),
+    ("media_ingest", "S3Download.wait", "download"),
+    ("media_ingest", "_DownloadReader.readinto", "download"),
+    ("media_ingest", "open_s3_object", "download"),
+    ("media_ingest", "S3RangeReader.readinto", "download"),
+
+    ("cv2", "imread", "decode"),
+    ("video_frames", "probe_video", "decode"),
+    ("video_frames", "probe_fps", "decode"),
+    ("video_frames", "iter_frame_batches", "decode"),
+    ("audio_decode", "read_first_window", "decode"),
+    ("audio_decode", "iter_windows", "decode"),
+
+    ("detector_backends", "OnnxDetector._letterbox", "preprocess"),
+    ("audio_decode", "resample_window", "preprocess"),
+
+    ("detector_backends", "OnnxDetector.detect", "inference"),
+    ("detector_backends", "UltralyticsDetector.detect", "inference"),
+    ("birdnet_runtime", "BirdNetRuntime.predict", "inference"),
+
+    ("item_ids", "put_new_item", "write"),
+    ("batch_ingest", "write_items", "write"),
+    ("tag_index", "write_index", "write"),
+]
+
+
+class StageTimer:
+    """Accumulates exclusive wall time per stage, summed over every thread of the process."""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def reset(self):
+        """Return the totals (ms) since the last reset and start over."""
+        with self._lock:
+            totals = {stage: seconds * 1000 for stage, seconds in self.totals.items()}
+            self.totals.clear()
+        return totals
+
+    @contextmanager
+    def measure(self, stage):
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                self.totals[stage] += elapsed - children
+
+    def wrap(self, stage, fn):
+        if inspect.isgeneratorfunction(fn):
+            # Only the time spent producing each item counts, not the consumer's work between items
+            @functools.wraps(fn)
+            def timed_generator(*args, **kwargs):
+                generator = fn(*args, **kwargs)
+                try:
+                    while True:
+                        with self.measure(stage):
+                            try:
+                                item = next(generator)
+                            except StopIteration:
+                                return
+                        yield item
+                finally:
+                    generator.close()
+            return timed_generator
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            with self.measure(stage):
+                return fn(*args, **kwargs)
+        return timed
+
+    def install(self, probe_list=probes):
+        """Wrap every probe whose module can be imported; returns the probes installed."""
+        installed = []
+        for module_name, path, stage in probe_list:
+            if module_name not in sys.modules:
+                try:
+                    importlib.import_module(module_name)
+                except ImportError:
+                    continue
+            owner = sys.modules[module_name]
+            *parents, name = path.split(".")
+            try:
+                for parent in parents:
+                    owner = getattr(owner, parent)
+                fn = getattr(owner, name)
+            except AttributeError:
+                continue
+            setattr(owner, name, self.wrap(stage, fn))
+            installed.append((module_name, path, stage))
+        return installed
+
+    def wrap_client(self, client, method, stage):
+        """Time one method of a client object (e.g. the downstream Lambda invoke)."""
+        setattr(client, method, self.wrap(stage, getattr(client, method)))
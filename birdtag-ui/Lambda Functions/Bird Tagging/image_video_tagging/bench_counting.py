@@ -0,0 +1,90 @@
+import time
+import argparse
+import numpy as np
+import supervision as sv
+from species_counting import SpeciesCounter
+
+
+def synthetic_detections(rng, boxes, class_names):
+    class_id = rng.integers(0, len(class_names), size=boxes)
+    xy = rng.uniform(0, 600, size=(boxes, 2))
+    return sv.Detections(
+        xyxy=np.hstack([xy, xy + 40]).astype(np.float32),
+        confidence=rng.uniform(0, 1, size=boxes).astype(np.float32),
+        class_id=class_id,
+        data={"class_name": np.array(class_names)[class_id]},
+    )
+
+
+def loop_image_count(detections, confidence):
+    # The per-box dict counting image_prediction used before SpeciesCounter
+    detections = detections[(detections.confidence > confidence)]
+    species_count = {}
+    if len(detections.class_id) > 0:
+        for species in detections.data['class_name']:
+            species = species.lower()
+            species_count[species] = species_count.get(species, 0) + 1
+    return {"tags": list(species_count.keys()), "counts": list(species_count.values())}
+
+
+def loop_video_count(frames, confidence):
+    max_species_count = {}
+    for detections in frames:
+        detections = detections[(detections.confidence > confidence)]
+        if len(detections.class_id) > 0:
+            current_count = {}
+            for species in detections.data['class_name']:
+                species = species.lower()
+                current_count[species] = current_count.get(species, 0) + 1
+            for species, count in current_count.items():
+                max_species_count[species] = max(max_species_count.get(species, 0), count)
+    return {"tags": list(max_species_count.keys()), "counts": list(max_species_count.values())}
+
+
+def vector_video_count(counter, frames, confidence):
+    running = None
+    for detections in frames:
+        running = counter.running_max(running, counter.count(detections, confidence))
+    return counter.result(running)
+
+
+def timed_us(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1e6, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark per-box loop counting against SpeciesCounter.")
+    parser.add_argument("--classes", type=int, default=80)
+    parser.add_argument("--boxes", type=int, nargs="+", default=[5, 50, 200, 800])
+    parser.add_argument("--frames", type=int, default=300, help="Sampled frames per simulated video")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--confidence", type=float, default=0.5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    class_names = [f"Species {i}" for i in range(args.classes)]
+    counter = SpeciesCounter(class_names)
+
+    print(f"{'case':<8} {'boxes':>6} {'loop us':>10} {'vector us':>10} {'speedup':>8}")
+    for boxes in args.boxes:
+        detections = synthetic_detections(rng, boxes, class_names)
+        loop_us, expected = timed_us(lambda: loop_image_count(detections, args.confidence), args.repeat)
+        vector_us, result = timed_us(lambda: counter.result(counter.count(detections, args.confidence)), args.repeat)
+        assert dict(zip(*expected.values())) == dict(zip(*result.values()))
+        print(f"{'image':<8} {boxes:>6} {loop_us:>10.1f} {vector_us:>10.1f} {loop_us / vector_us:>7.1f}x")
+
+    for boxes in args.boxes:
+        frames = [synthetic_detections(rng, boxes, class_names) for _ in range(args.frames)]
+        repeat = max(1, args.repeat // 50)
+        loop_us, expected = timed_us(lambda: loop_video_count(frames, args.confidence), repeat)
+        vector_us, result = timed_us(lambda: vector_video_count(counter, frames, args.confidence), repeat)
+        assert dict(zip(*expected.values())) == dict(zip(*result.values()))
+        print(f"{'video':<8} {boxes:>6} {loop_us / args.frames:>10.1f} {vector_us / args.frames:>10.1f} "
+              f"{loop_us / vector_us:>7.1f}x  (per frame)")
+
+
+if __name__ == "__main__":
+    main()
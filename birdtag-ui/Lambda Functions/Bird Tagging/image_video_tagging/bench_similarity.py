@@ -0,0 +1,81 @@
+import os
+import time
+import resource
+import argparse
+import tempfile
+import numpy as np
+from similarity_index import SimilarityIndex, write_snapshot, item_key
+
+
+def synthetic_items(rng, items, species):
+    """Items with 1-4 species drawn Zipf-like (a few common birds, a long tail) and small counts."""
+    popularity = 1 / np.arange(1, species + 1) ** 1.1
+    popularity /= popularity.sum()
+    sizes = rng.choice([1, 2, 3, 4], size=items, p=[0.55, 0.25, 0.13, 0.07])
+    drawn = rng.choice(species, size=int(sizes.sum()), p=popularity)
+    counts = rng.geometric(0.45, size=len(drawn))
+    keys, vectors, start = [], [], 0
+    for i, size in enumerate(sizes):
+        keys.append(item_key(f"{i:08x}-0000-4000-8000-{i:012x}", ("image", "video", "audio")[i % 3]))
+        vectors.append({f"species {s}": int(c) for s, c in zip(drawn[start:start + size], counts[start:start + size])})
+        start += size
+    return keys, vectors
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tag similarity index at birds_table scale.")
+    parser.add_argument("--items", type=int, default=1_000_000)
+    parser.add_argument("--species", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--deltas", type=int, default=1000, help="Writes applied on top of the snapshot")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    keys, vectors = synthetic_items(rng, args.items, args.species)
+    path = os.path.join(tempfile.mkdtemp(), "similarity_snapshot.bin")
+
+    start = time.perf_counter()
+    header = write_snapshot(path, keys, vectors)
+    build_s = time.perf_counter() - start
+    nnz = header['arrays']['rows'][2][0]
+    print(f"snapshot: {args.items} items, {len(header['species'])} species, {nnz} entries, "
+          f"{os.path.getsize(path) / 1e6:.1f} MB, built in {build_s:.1f}s")
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    index = SimilarityIndex(path)
+    print(f"open (mmap): {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    # Queries look like the files people search with: drawn from the same distribution
+    query_keys, queries = synthetic_items(rng, args.queries, args.species)
+    del query_keys
+    # Re-tagged existing files, deletions and new uploads, tagged like the rest of the corpus
+    _, delta_vectors = synthetic_items(rng, args.deltas, args.species)
+    edited = rng.choice(len(keys), args.deltas, replace=False)
+    changes = [(keys[i], vector if n % 10 else None) for n, (i, vector) in enumerate(zip(edited, delta_vectors))]
+    changes += [(item_key(f"new-{n}", "image"), vector) for n, vector in enumerate(delta_vectors[:args.deltas // 2])]
+
+    print(f"{'metric':<8} {'deltas':>7} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'qps':>8}")
+    for with_deltas in (False, True):
+        if with_deltas:
+            index.apply(changes)
+        for metric in ("cosine", "jaccard"):
+            latencies = []
+            for vector in queries:
+                start = time.perf_counter()
+                index.query(vector, args.top_k, metric)
+                latencies.append((time.perf_counter() - start) * 1000)
+            print(f"{metric:<8} {len(index.overlay):>7} {percentile(latencies, 50):>8.2f} "
+                  f"{percentile(latencies, 95):>8.2f} {max(latencies):>8.2f} {1000 / np.mean(latencies):>8.0f}")
+
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"peak RSS growth after open: {(rss_after - rss_before) / 1024:.0f} MB (ru_maxrss, includes the benchmark's own data)")
+
+
+if __name__ == "__main__":
+    main()
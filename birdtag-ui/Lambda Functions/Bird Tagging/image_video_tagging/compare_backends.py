@@ -0,0 +1,101 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import numpy as np
+import detector_backends
+from lambda_bird_detection import image_prediction
+
+
+def export_models(torch_model, output_dir):
+    """
+    Export the PyTorch detector to ONNX and an INT8 dynamically-quantized ONNX copy.
+
+    Upload the results to the models bucket under the keys listed in
+    detector_backends.backends to make them selectable with DETECTOR_BACKEND.
+    """
+    from ultralytics import YOLO
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    os.makedirs(output_dir, exist_ok=True)
+    exported = YOLO(torch_model).export(format="onnx", dynamic=True, simplify=True)
+    onnx_path = os.path.join(output_dir, "image_video_model.onnx")
+    os.replace(exported, onnx_path)
+
+    int8_path = os.path.join(output_dir, "image_video_model.int8.onnx")
+    quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QUInt8)
+    print(f"Exported {onnx_path} and {int8_path}")
+    return onnx_path, int8_path
+
+
+def run_backend(model, images, confidence, warmup=1):
+    for image in images[:warmup]:
+        image_prediction(image, confidence=confidence, model=model)
+
+    results, latencies = [], []
+    for image in images:
+        start = time.perf_counter()
+        results.append(image_prediction(image, confidence=confidence, model=model))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.array(latencies)
+
+
+def compare(reference, candidate):
+    """Return (exact tag/count matches, tag set matches, mean absolute count error) against the reference."""
+    exact, same_tags, count_errors = 0, 0, []
+    for ref, cand in zip(reference, candidate):
+        ref_counts = dict(zip(ref["tags"], ref["counts"]))
+        cand_counts = dict(zip(cand["tags"], cand["counts"]))
+        exact += ref_counts == cand_counts
+        same_tags += set(ref_counts) == set(cand_counts)
+        for tag in set(ref_counts) | set(cand_counts):
+            count_errors.append(abs(ref_counts.get(tag, 0) - cand_counts.get(tag, 0)))
+    return exact, same_tags, float(np.mean(count_errors)) if count_errors else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare detector backends on a fixed local image set.")
+    parser.add_argument("images", help="Directory of test images")
+    parser.add_argument("--torch-model", default="image_video_model.pt")
+    parser.add_argument("--onnx-model", default="image_video_model.onnx")
+    parser.add_argument("--int8-model", default="image_video_model.int8.onnx")
+    parser.add_argument("--confidence", type=float, default=0.5)
+    parser.add_argument("--export", action="store_true", help="Export ONNX and INT8 models from --torch-model first")
+    args = parser.parse_args()
+
+    if args.export:
+        args.onnx_model, args.int8_model = export_models(args.torch_model, os.path.dirname(args.onnx_model) or ".")
+
+    images = sorted(
+        path for pattern in ("*.jpg", "*.jpeg", "*.png")
+        for path in glob.glob(os.path.join(args.images, pattern))
+    )
+    if not images:
+        print(f"No images found in {args.images}")
+        sys.exit(1)
+
+    model_paths = {"torch": args.torch_model, "onnx": args.onnx_model, "onnx_int8": args.int8_model}
+    outputs = {}
+    print(f"{'backend':<10} {'load ms':>9} {'p50 ms':>8} {'p95 ms':>8} {'exact':>7} {'tags':>7} {'count MAE':>10}")
+    for backend, path in model_paths.items():
+        if not os.path.exists(path):
+            print(f"{backend:<10} skipped, {path} not found")
+            continue
+
+        start = time.perf_counter()
+        model = detector_backends.load_detector(path)
+        load_ms = (time.perf_counter() - start) * 1000
+
+        results, latencies = run_backend(model, images, args.confidence)
+        outputs[backend] = results
+        reference = outputs.get("torch", results)
+        exact, same_tags, mae = compare(reference, results)
+        print(
+            f"{backend:<10} {load_ms:>9.0f} {np.percentile(latencies, 50):>8.1f} {np.percentile(latencies, 95):>8.1f}"
+            f" {exact:>3}/{len(images):<3} {same_tags:>3}/{len(images):<3} {mae:>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import os
+import ast
+import numpy as np
+import model_registry
+import metrics
+
+# supervision and cv2 are imported where they are used, so a handler that never
+# loads a detector (presigned upload URLs, cache hits) does not pay for them at cold start
+
+# === Detector backend selection ===
+# "torch" runs ultralytics/PyTorch, "onnx" an exported ONNX Runtime model,
+# "onnx_int8" the dynamically INT8-quantized ONNX export
+detector_backend = os.environ.get("DETECTOR_BACKEND", "torch")
+# "on" loads the detector and runs one blank frame during the init phase, so the first
+# invocation skips model loading and session warm-up (SnapStart-style pre-warming)
+prewarm_enabled = os.environ.get("PREWARM", "off") == "on"
+
+backends = {
+    "torch": ("model/image_video_model.pt", "/tmp/image_video_model.pt"),
+    "onnx": ("model/image_video_model.onnx", "/tmp/image_video_model.onnx"),
+    "onnx_int8": ("model/image_video_model.int8.onnx", "/tmp/image_video_model.int8.onnx"),
+}
+
+
+class UltralyticsDetector:
+    """Stock ultralytics YOLO on PyTorch; torch is only imported when this backend is used."""
+
+    def __init__(self, model_path):
+        from ultralytics import YOLO
+        self.model = YOLO(model_path)
+        # {class_id: name}, used to build the species counting table
+        self.names = self.model.names
+        # ultralytics predicts at 640 unless told otherwise
+        self.imgsz = 640
+
+    @metrics.timed("inference")
+    def detect(self, frames):
+        import supervision as sv
+        return [sv.Detections.from_ultralytics(result) for result in self.model(frames)]
+
+
+class OnnxDetector:
+    """YOLOv8 ONNX export run with ONNX Runtime: letterbox, single session run, class-aware NMS."""
+
+    def __init__(self, model_path, conf_threshold=0.25, iou_threshold=0.7, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # Static exports have batch 1; dynamic exports report a symbolic batch dimension
+        self.static_batch = model_input.shape[0] if isinstance(model_input.shape[0], int) else None
+        self.imgsz = model_input.shape[2] if isinstance(model_input.shape[2], int) else 640
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        names = ast.literal_eval(metadata["names"]) if "names" in metadata else {}
+        self.class_names = np.array([names.get(i, str(i)) for i in range(len(names))])
+        self.names = list(self.class_names)
+
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+
+    def _letterbox(self, img):
+        import cv2 as cv
+
+        h, w = img.shape[:2]
+        scale = min(self.imgsz / h, self.imgsz / w)
+        nh, nw = int(round(h * scale)), int(round(w * scale))
+        top, left = (self.imgsz - nh) // 2, (self.imgsz - nw) // 2
+
+        canvas = np.full((self.imgsz, self.imgsz, 3), 114, dtype=np.uint8)
+        canvas[top:top + nh, left:left + nw] = cv.resize(img, (nw, nh), interpolation=cv.INTER_LINEAR)
+        # BGR HWC uint8 -> RGB CHW float32 in [0, 1]
+        blob = canvas[:, :, ::-1].transpose(2, 0, 1).astype(np.float32) / 255.0
+        return blob, scale, left, top
+
+    def _postprocess(self, output, scale, left, top, shape):
+        import cv2 as cv
+        import supervision as sv
+
+        preds = output.T
+        scores = preds[:, 4:]
+        class_id = scores.argmax(axis=1)
+        confidence = scores[np.arange(len(scores)), class_id]
+        keep = confidence > self.conf_threshold
+        preds, class_id, confidence = preds[keep], class_id[keep], confidence[keep]
+
+        cx, cy, bw, bh = preds[:, 0], preds[:, 1], preds[:, 2], preds[:, 3]
+        xyxy = np.stack([cx - bw / 2, cy - bh / 2, cx + bw / 2, cy + bh / 2], axis=1)
+        xyxy = (xyxy - [left, top, left, top]) / scale
+        xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clip(0, shape[1])
+        xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clip(0, shape[0])
+
+        if len(xyxy):
+            # Offset boxes per class so one NMS call never suppresses across classes
+            offset = class_id[:, None] * (max(shape) + 1)
+            shifted = xyxy + offset
+            boxes = np.concatenate([shifted[:, :2], shifted[:, 2:] - shifted[:, :2]], axis=1)
+            kept = cv.dnn.NMSBoxes(boxes.tolist(), confidence.tolist(), self.conf_threshold, self.iou_threshold)
+            kept = np.array(kept, dtype=int).reshape(-1)
+            xyxy, class_id, confidence = xyxy[kept], class_id[kept], confidence[kept]
+
+        return sv.Detections(
+            xyxy=xyxy.astype(np.float32),
+            confidence=confidence.astype(np.float32),
+            class_id=class_id.astype(int),
+            data={"class_name": self._class_names(class_id)},
+        )
+
+    def _class_names(self, class_id):
+        if len(class_id) == 0:
+            return np.array([], dtype=str)
+        if len(self.class_names) == 0:
+            return class_id.astype(str)
+        return self.class_names[class_id]
+
+    def _run(self, blobs):
+        return self.session.run(None, {self.input_name: np.stack(blobs)})[0]
+
+    def detect(self, frames):
+        with metrics.stage("preprocess"):
+            prepared = [self._letterbox(frame) for frame in frames]
+            blobs = [blob for blob, _, _, _ in prepared]
+
+        with metrics.stage("inference"):
+            if self.static_batch == 1:
+                outputs = [self._run([blob])[0] for blob in blobs]
+            else:
+                outputs = self._run(blobs)
+
+        with metrics.stage("postprocess"):
+            return [
+                self._postprocess(output, scale, left, top, frame.shape)
+                for output, (_, scale, left, top), frame in zip(outputs, prepared, frames)
+            ]
+
+
+def load_detector(model_path):
+    """Pick the backend class from the model file extension."""
+    if model_path.endswith(".onnx"):
+        return OnnxDetector(model_path)
+    return UltralyticsDetector(model_path)
+
+
+def get_detector(backend=None):
+    """Return the warm detector for the configured backend, loaded through the model registry."""
+    backend = backend or detector_backend
+    if backend not in backends:
+        raise ValueError(f"Unknown detector backend: {backend}")
+    key, local_path = backends[backend]
+    return model_registry.get_model(model_registry.model_bucket, key, local_path, loader=load_detector)
+
+
+def detector_version(backend=None):
+    """Identify the loaded detector (backend and model ETag), e.g. to key cached results."""
+    backend = backend or detector_backend
+    key, _ = backends[backend]
+    return f"{backend}:{model_registry.model_etag(model_registry.model_bucket, key)}"
+
+
+def prewarm(backend=None):
+    """Load the detector and run one blank frame so the first request skips session warm-up."""
+    detector = get_detector(backend)
+    detector.detect([np.zeros((640, 640, 3), dtype=np.uint8)])
+    return detector
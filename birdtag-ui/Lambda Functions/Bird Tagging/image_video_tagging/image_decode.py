@@ -0,0 +1,241 @@
+import os
+import math
+import struct
+import numpy as np
+import metrics
+
+# === Image decode settings ===
+# "reduced" decodes at the smallest scale that still covers the model input,
+# "tiled" runs overlapping tiles plus one whole-image pass and merges the boxes,
+# "full" is the legacy full-resolution decode, "auto" picks reduced or tiled per image
+image_decode_mode = os.environ.get("IMAGE_DECODE_MODE", "auto")
+# Only images of at least this many megapixels (DSLR and camera-trap stills) are tiled in
+# auto mode; ordinary phone photos (12 MP) are decoded reduced and run as one pass
+tile_min_megapixels = float(os.environ.get("IMAGE_TILE_MIN_MEGAPIXELS", "20"))
+# Tiled inference budget per image, and the cost of one model input on this function's CPU
+# (take it from the inference stage of benchmarks/bench_e2e.py)
+latency_budget_ms = float(os.environ.get("IMAGE_LATENCY_BUDGET_MS", "1500"))
+frame_cost_ms = float(os.environ.get("IMAGE_FRAME_COST_MS", "60"))
+max_tiles = int(os.environ.get("IMAGE_MAX_TILES", "16"))
+tile_overlap = float(os.environ.get("IMAGE_TILE_OVERLAP", "0.2"))
+tile_batch_size = int(os.environ.get("IMAGE_TILE_BATCH", "8"))
+# Boxes of one class from different views are one bird when their IoU reaches merge_iou, or when
+# one is cut by a tile seam and this fraction of the smaller box lies in the other (a bird cut by
+# a tile edge is mostly contained in its whole box from the neighbour tile or the whole image).
+# Boxes from the same view already went through the detector's NMS and are all kept.
+merge_threshold = float(os.environ.get("IMAGE_TILE_MERGE_IOS", "0.6"))
+merge_iou = float(os.environ.get("IMAGE_TILE_MERGE_IOU", "0.5"))
+# A box edge within this many pixels of an inner tile edge counts as cut by the seam
+seam_margin = 2
+
+_reduce_factors = (8, 4, 2)
+_sof_markers = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def decode_version(mode=None):
+    """Suffix for detection cache versions of image results, since detections depend on the decode plan."""
+    mode = mode or image_decode_mode
+    if mode == "full":
+        return ""
+    if mode == "reduced":
+        return ":img:reduced"
+    return (f":img:{mode}:{tile_min_megapixels}mp:{latency_budget_ms}:{frame_cost_ms}:{max_tiles}"
+            f":{tile_overlap}:{merge_threshold}:{merge_iou}")
+
+
+def image_size(path):
+    """Return (width, height) from a JPEG or PNG header without decoding, or None for other formats."""
+    with open(path, 'rb') as f:
+        head = f.read(24)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and len(head) >= 24:
+            return struct.unpack('>II', head[16:24])
+        if head[:2] != b'\xff\xd8':
+            return None
+        f.seek(2)
+        while True:
+            byte = f.read(1)
+            while byte == b'\xff':
+                marker = f.read(1)
+                if marker != b'\xff':
+                    break
+            else:
+                return None
+            if not marker:
+                return None
+            code = marker[0]
+            if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:
+                continue
+            try:
+                length = struct.unpack('>H', f.read(2))[0]
+                if code in _sof_markers:
+                    _, height, width = struct.unpack('>BHH', f.read(5))
+                    return width, height
+            except struct.error:
+                # Truncated header: let the decoder deal with the file
+                return None
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+def reduce_factor(long_side, min_side):
+    """Largest IMREAD_REDUCED_* factor that keeps long_side at or above min_side."""
+    for factor in _reduce_factors:
+        if long_side / factor >= min_side:
+            return factor
+    return 1
+
+
+def tile_origins(length, tile, stride):
+    if length <= tile:
+        return [0]
+    count = math.ceil((length - tile) / stride) + 1
+    # The last tile sits flush with the edge instead of running past it
+    return sorted({min(i * stride, length - tile) for i in range(count)})
+
+
+def tile_count(width, height, tile, overlap=None):
+    stride = max(1, int(tile * (1 - (tile_overlap if overlap is None else overlap))))
+    return len(tile_origins(width, tile, stride)) * len(tile_origins(height, tile, stride))
+
+
+class ImagePlan:
+    """How one image is decoded and run: mode, IMREAD_REDUCED factor and tile size in decoded pixels."""
+
+    def __init__(self, mode, factor=1, tile=None):
+        self.mode = mode
+        self.factor = factor
+        self.tile = tile
+
+    def __repr__(self):
+        return f"ImagePlan({self.mode}, factor={self.factor}, tile={self.tile})"
+
+
+def plan_image(size, imgsz=640, mode=None):
+    """
+    Pick the decode plan for an image of size (width, height) (None when unknown).
+
+    auto tiles an image of at least tile_min_megapixels when a tiling fits the latency
+    budget (tiles plus one whole-image pass at frame_cost_ms each, at most max_tiles
+    tiles): the smallest tile, in steps of half a model input, that keeps the tile count
+    within budget. Everything else is decoded reduced, as a single pass.
+    """
+    mode = mode or image_decode_mode
+    if mode == "full" or size is None:
+        return ImagePlan("full")
+    width, height = size
+    long_side = max(width, height)
+
+    if mode in ("auto", "tiled"):
+        budget = min(max_tiles, int(latency_budget_ms // frame_cost_ms) - 1)
+        if mode == "tiled" or width * height >= tile_min_megapixels * 1e6:
+            tile = imgsz
+            while tile < long_side and tile_count(width, height, tile) > budget:
+                tile += imgsz // 2
+            if tile < long_side and budget >= 2:
+                # Decode only as fine as the tiles need: each tile still covers one model input
+                factor = reduce_factor(tile, imgsz)
+                return ImagePlan("tiled", factor, tile // factor)
+
+    return ImagePlan("reduced", reduce_factor(long_side, imgsz))
+
+
+def decode(path, factor=1):
+    """Decode to BGR, letting the JPEG decoder scale by factor (DCT scaling) instead of resizing afterwards."""
+    import cv2 as cv
+
+    flags = {1: cv.IMREAD_COLOR, 2: cv.IMREAD_REDUCED_COLOR_2, 4: cv.IMREAD_REDUCED_COLOR_4, 8: cv.IMREAD_REDUCED_COLOR_8}
+    with metrics.stage("decode"):
+        return cv.imread(path, flags[factor])
+
+
+def load_image(path, imgsz=640, mode=None):
+    """Return (image, plan) for path, decoded as the plan asks; image is None if it cannot be decoded."""
+    plan = plan_image(image_size(path), imgsz, mode)
+    return decode(path, plan.factor), plan
+
+
+def merge_boxes(xyxy, confidence, class_id, view, at_seam, threshold=None, iou_threshold=None):
+    """
+    Greedy class-aware suppression across views (tiles and the whole-image pass).
+
+    Returns the indices kept, highest confidence first. A box only suppresses boxes of
+    the same class from other views: by IoU, or for a box cut by a tile seam (at_seam)
+    by intersection over the smaller box, which also folds the truncated box into the
+    whole box of the same bird. Neighbouring birds in one view are never merged.
+    """
+    threshold = merge_threshold if threshold is None else threshold
+    iou_threshold = merge_iou if iou_threshold is None else iou_threshold
+    areas = np.clip(xyxy[:, 2] - xyxy[:, 0], 0, None) * np.clip(xyxy[:, 3] - xyxy[:, 1], 0, None)
+    suppressed = np.zeros(len(xyxy), dtype=bool)
+    keep = []
+    for i in np.argsort(-confidence):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        width = np.clip(np.minimum(xyxy[i, 2], xyxy[:, 2]) - np.maximum(xyxy[i, 0], xyxy[:, 0]), 0, None)
+        height = np.clip(np.minimum(xyxy[i, 3], xyxy[:, 3]) - np.maximum(xyxy[i, 1], xyxy[:, 1]), 0, None)
+        intersection = width * height
+        iou = intersection / np.maximum(areas[i] + areas - intersection, 1e-6)
+        ios = intersection / np.maximum(np.minimum(areas[i], areas), 1e-6)
+        same_bird = (iou >= iou_threshold) | ((at_seam[i] | at_seam) & (ios >= threshold))
+        suppressed |= (class_id == class_id[i]) & (view != view[i]) & same_bird
+    return np.array(keep, dtype=int)
+
+
+def seam_boxes(xyxy, x, y, view_width, view_height, width, height, margin=None):
+    """True for boxes (in view coordinates) that touch an edge of the view inside the image."""
+    margin = seam_margin if margin is None else margin
+    return (((xyxy[:, 0] <= margin) & (x > 0))
+            | ((xyxy[:, 1] <= margin) & (y > 0))
+            | ((xyxy[:, 2] >= view_width - margin) & (x + view_width < width))
+            | ((xyxy[:, 3] >= view_height - margin) & (y + view_height < height)))
+
+
+def detect_tiled(model, img, tile, overlap=None, batch_size=None):
+    """
+    Run the detector on overlapping tile x tile views of img plus the whole image, in
+    batches, and return the merged detections in img coordinates.
+    """
+    import supervision as sv
+
+    overlap = tile_overlap if overlap is None else overlap
+    batch_size = batch_size or tile_batch_size
+    height, width = img.shape[:2]
+    stride = max(1, int(tile * (1 - overlap)))
+    # Views into img, no copies; (0, 0, img) is the whole-image pass that catches birds larger than a tile
+    views = [(0, 0, img)] + [
+        (x, y, img[y:y + tile, x:x + tile])
+        for y in tile_origins(height, tile, stride)
+        for x in tile_origins(width, tile, stride)
+    ]
+    metrics.count("image_tiles", len(views) - 1)
+
+    parts, view_ids, seams = [], [], []
+    for start in range(0, len(views), batch_size):
+        batch = views[start:start + batch_size]
+        for n, ((x, y, view), detections) in enumerate(zip(batch, model.detect([view for _, _, view in batch])), start):
+            if len(detections):
+                seams.append(seam_boxes(detections.xyxy, x, y, view.shape[1], view.shape[0], width, height))
+                view_ids.append(np.full(len(detections), n))
+                detections.xyxy = detections.xyxy + np.array([x, y, x, y], dtype=detections.xyxy.dtype)
+                parts.append(detections)
+    if not parts:
+        return sv.Detections.empty()
+
+    merged = sv.Detections.merge(parts)
+    keep = merge_boxes(merged.xyxy, merged.confidence, merged.class_id, np.concatenate(view_ids), np.concatenate(seams))
+    return merged[keep]
+
+
+def detect_loaded(model, img, plan):
+    """Detections for an image load_image decoded, in img coordinates."""
+    if plan.mode == "tiled":
+        return detect_tiled(model, img, plan.tile)
+    return model.detect([img])[0]
+
+
+def detect_image(path, model, mode=None):
+    """Decode path per its plan and return its detections, or None if the image cannot be decoded."""
+    img, plan = load_image(path, getattr(model, "imgsz", 640), mode)
+    if img is None:
+        return None
+    return detect_loaded(model, img, plan)
@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import boto3
+import metrics
+
+region = os.environ.get("AWS_REGION", "ap-southeast-2")
+s3 = boto3.client('s3', region_name=region)
+dynamodb = boto3.resource('dynamodb', region_name=region)
+
+# === Index snapshot files ===
+# Shared by the tag similarity snapshot and the audio embedding index:
+#   magic (8 bytes), header length (uint64), JSON header, then 64-byte aligned arrays
+# whose [offset, dtype, shape] are listed in header["arrays"], so they memory-map in place.
+_align = 64
+
+
+def item_key(item_id, file_type):
+    return f"{item_id}\t{file_type}"
+
+
+def parse_key(key):
+    """Return (id, file_type) of an item_key, the id back as the number birds_table is keyed on."""
+    item_id, file_type = key.split('\t')
+    return int(item_id), file_type
+
+
+def encode_keys(keys):
+    """Fixed-width bytes array of keys (sorted byte keys binary-search with np.searchsorted)."""
+    encoded = [key.encode('utf-8') for key in keys]
+    return np.array(encoded, dtype=f"S{max((len(k) for k in encoded), default=1)}")
+
+
+def _aligned(offset):
+    return (offset + _align - 1) // _align * _align
+
+
+def write_file(path, magic, header, arrays):
+    """Write header (a JSON-able dict) and arrays ({name: ndarray}) to path; returns header with its array table."""
+    header = dict(header, arrays={})
+    # Offsets depend on the header length, so lay out with a provisional header first
+    for _ in range(2):
+        raw = json.dumps(header).encode('utf-8')
+        offset = _aligned(len(magic) + 8 + len(raw))
+        for name, array in arrays.items():
+            header['arrays'][name] = [offset, array.dtype.str, list(array.shape)]
+            offset = _aligned(offset + array.nbytes)
+
+    raw = json.dumps(header).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(magic)
+        f.write(len(raw).to_bytes(8, 'little'))
+        f.write(raw)
+        for name, array in arrays.items():
+            f.seek(header['arrays'][name][0])
+            f.write(array.tobytes())
+    return header
+
+
+def read_header(path, magic, description="index snapshot"):
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f"{path} is not a {description}")
+        length = int.from_bytes(f.read(8), 'little')
+        return json.loads(f.read(length))
+
+
+def map_arrays(path, header):
+    """Memory-map the arrays of a snapshot; pages are only read in as queries touch them."""
+    return {
+        name: np.memmap(path, dtype=np.dtype(dtype), mode='r', offset=offset, shape=tuple(shape))
+        if shape[0] else np.zeros(shape, dtype=np.dtype(dtype))
+        for name, (offset, dtype, shape) in header['arrays'].items()
+    }
+
+
+class WarmIndex:
+    """
+    An index file in S3, downloaded to /tmp and opened once per container.
+
+    At most every refresh_seconds the object's ETag is checked and a changed file
+    replaces the index; after_check(index, loaded) then runs (e.g. to apply deltas).
+    If S3 is unreachable the warm index keeps serving.
+    """
+
+    def __init__(self, description, bucket, key, path, refresh_seconds, open_index, after_check=None):
+        self.description = description
+        self.bucket = bucket
+        self.key = key
+        self.path = path
+        self.refresh_seconds = refresh_seconds
+        self.open_index = open_index
+        self.after_check = after_check
+        self.index = None
+        self.etag = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the container's index, or None if none has been built yet."""
+        with metrics.stage("model_load"), self._lock:
+            now = time.monotonic()
+            if self.index is not None and now - self.checked_at < self.refresh_seconds:
+                return self.index
+            try:
+                etag = s3.head_object(Bucket=self.bucket, Key=self.key)['ETag']
+                loaded = etag != self.etag
+                if loaded:
+                    s3.download_file(self.bucket, self.key, self.path, ExtraArgs={'IfMatch': etag})
+                    metrics.count("bytes_fetched", os.path.getsize(self.path))
+                    self.index = self.open_index(self.path)
+                    self.etag = etag
+                    print(f"Loaded {self.description} of {len(self.index)} items (ETag {etag})")
+                if self.after_check is not None:
+                    self.after_check(self.index, loaded)
+            except Exception as e:
+                if self.index is None:
+                    print(f"{self.description.capitalize()} unavailable: {repr(e)}")
+                    return None
+                # Keep serving the warm index if S3 is briefly unreachable
+                print(f"{self.description.capitalize()} refresh failed, using cached index: {repr(e)}")
+            self.checked_at = now
+            return self.index
+
+
+def parallel_scan(table_name, convert, total_segments=8, **scan_kwargs):
+    """
+    Segmented parallel scan of table_name; returns convert(item) for every item it is not None for.
+
+    Items are converted as pages arrive, so only the converted values are held.
+    """
+    table = dynamodb.Table(table_name)
+
+    def scan_segment(segment):
+        values = []
+        kwargs = dict(scan_kwargs, Segment=segment, TotalSegments=total_segments)
+        while True:
+            response = table.scan(**kwargs)
+            for item in response['Items']:
+                value = convert(item)
+                if value is not None:
+                    values.append(value)
+            if 'LastEvaluatedKey' not in response:
+                return values
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        segments = list(executor.map(scan_segment, range(total_segments)))
+    return [value for values in segments for value in values]
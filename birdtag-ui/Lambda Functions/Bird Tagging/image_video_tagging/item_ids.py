@@ -0,0 +1,115 @@
+import os
+import time
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key
+import metrics
+
+# === Time-ordered item IDs ===
+# Snowflake-style layout kept under 2**53 so the JS Lambdas can still use Number(id):
+#   41 bits milliseconds since 2024-01-01 | 6 bits container node | 6 bits sequence
+_epoch_ms = 1704067200000
+_node_bits = 6
+_sequence_bits = 6
+_max_sequence = (1 << _sequence_bits) - 1
+
+# Random per container; a clash between containers is caught by the conditional write
+_node = random.getrandbits(_node_bits)
+_last_ms = -1
+_sequence = 0
+_lock = threading.Lock()
+
+# GSI on birds_table: partition key upload_date (S), sort key id (N)
+recent_index_name = os.environ.get("RECENT_INDEX", "upload_date-id-index")
+
+
+def new_item_id():
+    """Return a unique, time-sortable integer ID."""
+    global _last_ms, _sequence
+    with _lock:
+        now_ms = int(time.time() * 1000) - _epoch_ms
+        if now_ms < _last_ms:
+            # Clock stepped backwards; keep issuing from the last timestamp
+            now_ms = _last_ms
+        if now_ms == _last_ms:
+            _sequence = (_sequence + 1) & _max_sequence
+            if _sequence == 0:
+                while now_ms <= _last_ms:
+                    time.sleep(0.0005)
+                    now_ms = int(time.time() * 1000) - _epoch_ms
+        else:
+            _sequence = 0
+        _last_ms = now_ms
+        return (now_ms << (_node_bits + _sequence_bits)) | (_node << _sequence_bits) | _sequence
+
+
+def id_datetime(item_id):
+    """Return the UTC creation time encoded in an item ID."""
+    ms = (int(item_id) >> (_node_bits + _sequence_bits)) + _epoch_ms
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+
+
+def date_bucket(item_id):
+    return id_datetime(item_id).strftime("%Y-%m-%d")
+
+
+def assign_id(item):
+    """Set item['id'] and its item['upload_date'] bucket."""
+    item['id'] = new_item_id()
+    item['upload_date'] = date_bucket(item['id'])
+    return item
+
+
+@metrics.timed("write")
+def put_new_item(table, item, attempts=5):
+    """
+    Assign item['id'] and item['upload_date'] and write it, refusing to overwrite.
+
+    A ConditionalCheckFailed (ID already taken) retries with a fresh ID.
+    """
+    for attempt in range(attempts):
+        assign_id(item)
+        try:
+            table.put_item(Item=item, ConditionExpression='attribute_not_exists(id)')
+            return item
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException' or attempt == attempts - 1:
+                raise
+            print(f"Item ID {item['id']} already taken, retrying")
+
+
+def list_recent_items(table, limit=50, max_days=30, exclusive_start_key=None):
+    """
+    Return up to limit items, newest first, by querying the upload_date index day by day.
+
+    Returns (items, next_key); pass next_key back as exclusive_start_key for the next page.
+    """
+    items = []
+    start_key = exclusive_start_key
+    day = datetime.now(timezone.utc).date()
+    if start_key is not None:
+        day = datetime.strptime(start_key['upload_date'], "%Y-%m-%d").date()
+
+    for _ in range(max_days):
+        kwargs = {
+            'IndexName': recent_index_name,
+            'KeyConditionExpression': Key('upload_date').eq(day.isoformat()),
+            'ScanIndexForward': False,
+            'Limit': limit - len(items),
+        }
+        if start_key is not None:
+            kwargs['ExclusiveStartKey'] = start_key
+        response = table.query(**kwargs)
+        items.extend(response['Items'])
+        start_key = response.get('LastEvaluatedKey')
+
+        if len(items) >= limit:
+            if start_key is None and items:
+                start_key = {k: items[-1][k] for k in ('id', 'file_type', 'upload_date')}
+            return items, start_key
+        if start_key is None:
+            day -= timedelta(days=1)
+
+    return items, None
@@ -2,14 +2,23 @@
 # coding: utf-8
 
 import os
-import tempfile
 import boto3
 from urllib.parse import urlparse
-from ultralytics import YOLO
-import supervision as sv
-import cv2 as cv
-import random
 import json
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import detector_backends
+import video_frames
+import species_counting
+import video_tracking
+import media_ingest
+import detection_cache
+import tag_index
+import item_ids
+import batch_ingest
+import image_decode
+import previews
+import metrics
 from datetime import datetime
 
 region = os.environ.get("AWS_REGION", "ap-southeast-2")
@@ -17,80 +26,331 @@ dynamodb = boto3.resource('dynamodb', region_name=region)
 table = dynamodb.Table('birds_table')
 s3 = boto3.client('s3', region_name=region)
 
-def image_prediction(image_path, confidence=0.5, model_path="./model.pt"):
-    model = YOLO(model_path)
-    img = cv.imread(image_path)
+# === Batch ingest settings ===
+# Images per detector call in batch_handler; videos are still run one at a time
+image_batch_size = int(os.environ.get("IMAGE_BATCH_SIZE", "8"))
+# Stage concurrency: files fetched and decoded ahead of the detector, and parallel DynamoDB flushes
+fetch_concurrency = int(os.environ.get("PIPELINE_FETCH_CONCURRENCY", "8"))
+write_concurrency = int(os.environ.get("PIPELINE_WRITE_CONCURRENCY", "2"))
+# Finished items per write_items flush
+write_batch_items = 25
+
+if detector_backends.prewarm_enabled:
+    try:
+        detector_backends.prewarm()
+    except Exception as e:
+        print(f"Pre-warm failed, loading on first request instead: {repr(e)}")
+
+
+def image_prediction(image_path, confidence=0.5, model_path="./model.pt", model=None, preview=None):
+    if model is None:
+        model = detector_backends.load_detector(model_path)
+
+    # Large images are decoded reduced or run as tiles, see image_decode.plan_image
+    img, plan = image_decode.load_image(image_path, getattr(model, "imgsz", 640))
     if img is None:
         print("Couldn't load the image! Please check the image path.")
         return {"tags": [], "counts": []}
+    detections = image_decode.detect_loaded(model, img, plan)
+    if preview is not None:
+        # The thumbnail and crops come from the pixels just decoded for detection
+        preview.add_image(img, detections)
 
-    result = model(img)[0]
-    detections = sv.Detections.from_ultralytics(result)
-    detections = detections[(detections.confidence > confidence)]
-
-    species_count = {}
-    if len(detections.class_id) > 0:
-        species_names = detections.data['class_name']
-        for species in species_names:
-            species = species.lower()
-            species_count[species] = species_count.get(species, 0) + 1
+    counter = species_counting.counter_for(model)
+    return counter.result(counter.count(detections, confidence))
 
-    tags = list(species_count.keys())
-    counts = list(species_count.values())
-    return {"tags": tags, "counts": counts}
 
+def video_prediction(video_path, confidence=0.5, model_path="./model.pt", model=None,
+                     batch_size=None, sampling_mode=None, sample_fps=None, count_mode=None, preview=None):
+    import supervision as sv
 
-def video_prediction(video_path, confidence=0.5, model_path="./model.pt"):
     try:
-        video_info = sv.VideoInfo.from_video_path(video_path=video_path)
-        fps = int(video_info.fps)
+        if model is None:
+            model = detector_backends.load_detector(model_path)
+
+        if (count_mode or video_tracking.video_count_mode) == "tracks":
+            track_fps, tracking = video_tracking.plan_sampling(video_path)
+            if tracking:
+                return video_tracking.count_tracks(video_path, model, track_fps, confidence, batch_size, preview=preview)
+            # The frame budget only allows a rate too low to track at; count per-frame maxima instead
+            print(f"Sampling at {track_fps:.2f} fps is too sparse to track, using per-frame maxima")
+            sampling_mode, sample_fps = "fps", track_fps
 
-        model = YOLO(model_path)
+        # video_path may also be a file object streaming from an in-flight download
+        fps = int(video_frames.probe_fps(video_path))
         tracker = sv.ByteTrack(frame_rate=fps)
 
-        cap = cv.VideoCapture(video_path)
-        if not cap.isOpened():
-            raise Exception("Error: couldn't open the video!")
+        # Largest per-frame count of each species, indexed like counter.tags
+        counter = species_counting.counter_for(model)
+        max_species_count = None
 
-        max_species_count = {}
-        frame_idx = 0
+        # Frames are decoded on a background thread; only sampled frames are retrieved
+        for batch in video_frames.iter_frame_batches(
+            video_path, batch_size=batch_size, mode=sampling_mode, fps=sample_fps
+        ):
+            tracked = []
+            for detections in model.detect([frame for _, _, frame in batch]):
+                detections = tracker.update_with_detections(detections=detections)
+                max_species_count = counter.running_max(max_species_count, counter.count(detections, confidence))
+                tracked.append(detections)
+            if preview is not None:
+                preview.add_frames(batch, tracked)
 
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
-                break
+        if max_species_count is None:
+            return {"tags": [], "counts": []}
+        return counter.result(max_species_count)
 
-            if frame_idx % fps == 0:
-                result = model(frame)[0]
-                detections = sv.Detections.from_ultralytics(result)
-                detections = tracker.update_with_detections(detections=detections)
-                detections = detections[(detections.confidence > confidence)]
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return {"tags": [], "counts": []}
+
+
+def model_version(file_type):
+    # Video counts also depend on the counting mode, image detections on the decode plan
+    suffix = video_tracking.counting_version() if file_type == 'video' else image_decode.decode_version()
+    return detector_backends.detector_version() + suffix
+
+
+def predict_download(download, file_type, model, preview=None):
+    """Run detection on a download; preview, a previews.PreviewBuilder, collects frames as they are detected."""
+    if file_type == 'video' and video_frames.has_pyav():
+        # Nothing needs the whole file up front, so decode while later ranges are still arriving
+        return detection_cache.cached_stream_detection(
+            download, model_version(file_type), lambda stream: video_prediction(stream, model=model, preview=preview)
+        )
+
+    path = download.wait()
+    predict = image_prediction if file_type == 'image' else video_prediction
+    result = detection_cache.cached_detection(
+        path, model_version(file_type), lambda: predict(path, model=model, preview=preview)
+    )
+    if preview is not None and preview.thumbnail is None and file_type == 'image':
+        # A cache hit decoded nothing, so decode just enough for the thumbnail
+        preview.thumbnail = previews.thumbnail_image(path)
+    return result
+
+
+def new_item(file_type, file_name, s3_url, result, s3_thumbnail_url=None):
+    item = {
+        'file_type': file_type,
+        'file_name': file_name,
+        's3_url': s3_url,
+        'tags': result["tags"],
+        'counts': result["counts"],
+        'timestamp': datetime.utcnow().isoformat()
+    }
+
+    # Track-based video counting also reports when each species was first and last in view
+    for key in ('first_seen_ms', 'last_seen_ms'):
+        if key in result:
+            item[key] = result[key]
+
+    if s3_thumbnail_url:
+        item["s3_thumbnail_url"] = s3_thumbnail_url
+    return item
+
+
+def fetch_media(ref, cache=None, version=None, imgsz=640):
+    """
+    Fetch stage: download one file off the detector thread.
+
+    Images are also hashed, looked up in the detection cache and decoded here (at
+    the scale their decode plan asks for), so the detector only ever waits on pixels. Videos come back with their download
+    still open, since the frame reader can decode while later ranges arrive.
+    """
+    suffix = os.path.splitext(ref['key'])[1]
+    if ref['type'] == 'video':
+        return {'download': media_ingest.S3Download(ref['bucket'], ref['key'], suffix=suffix)}
+
+    with media_ingest.S3Download(ref['bucket'], ref['key'], suffix=suffix) as download:
+        path = download.wait()
+        digest = None
+        if cache is not None:
+            digest = detection_cache.hash_media(path)
+            cached = cache.get(digest, version)
+            if cached is not None:
+                metrics.count("detection_cache_hit")
+                if previews.enabled():
+                    return {'result': cached, 'thumbnail': previews.thumbnail_image(path)}
+                return {'result': cached}
+            metrics.count("detection_cache_miss")
+        img, plan = image_decode.load_image(path, imgsz)
+    if img is None:
+        raise ValueError(f"Couldn't decode image {ref['key']}")
+    return {'image': img, 'plan': plan, 'digest': digest}
+
+
+def iter_fetched(refs, executor, depth, cache=None, version=None, imgsz=640):
+    """Yield (ref, fetched or exception) in order, keeping up to depth fetches in flight."""
+    pending = deque()
+    refs = iter(refs)
 
-                if len(detections.class_id) > 0:
-                    species_names = detections.data['class_name']
-                    current_count = {}
-                    for species in species_names:
-                        species = species.lower()
-                        current_count[species] = current_count.get(species, 0) + 1
-                    for species, count in current_count.items():
-                        max_species_count[species] = max(max_species_count.get(species, 0), count)
+    def submit_next():
+        ref = next(refs, None)
+        if ref is not None:
+            pending.append((ref, executor.submit(fetch_media, ref, cache, version, imgsz)))
 
-            frame_idx += 1
+    for _ in range(max(1, depth)):
+        submit_next()
+    while pending:
+        ref, future = pending.popleft()
+        submit_next()
+        try:
+            yield ref, future.result()
+        except Exception as e:
+            yield ref, e
 
-        tags = list(max_species_count.keys())
-        counts = list(max_species_count.values())
-        return {"tags": tags, "counts": counts}
 
+@metrics.instrumented("lambda_bird_detection")
+def batch_handler(event, context=None):
+    """
+    Tag a batch of uploads from SQS (single-file tagging events or S3 notifications) or S3 events.
+
+    Runs as a staged pipeline: a fetch pool downloads and decodes files ahead of the
+    detector, the warm detector runs images several at a time on this thread, and a
+    write pool flushes finished items with batch writers while detection continues.
+    Returns a partial batch response so only the messages that failed are retried.
+    """
+    refs, failed = batch_ingest.parse_records(event)
+    failed = set(failed)
+
+    supported = []
+    for ref in refs:
+        if ref['type'] in ('image', 'video'):
+            supported.append(ref)
+        else:
+            print(f"Skipping {ref['key']}: unsupported file type {ref['type']}")
+
+    try:
+        model = detector_backends.get_detector()
     except Exception as e:
-        print(f"An error occurred: {e}")
-        return {"tags": [], "counts": []}
-    
-    finally:
-        cap.release()
+        print(f"Failed to download model from S3: {repr(e)}")
+        return batch_ingest.batch_response(list(failed) + [ref['identifier'] for ref in supported])
+
+    cache = detection_cache.get_cache()
+    version = model_version('image')
+    imgsz = getattr(model, "imgsz", 640)
+
+    # A message is retried as a whole, so its items are only written once all of its files succeed
+    remaining = Counter(ref['identifier'] for ref in supported)
+    finished = defaultdict(list)
+    ready = []
+    writes = []
+    # (identifier, item, published preview, fallback thumbnail) for items whose previews are uploading
+    published = []
+
+    with ThreadPoolExecutor(max_workers=fetch_concurrency) as fetch_pool, \
+            ThreadPoolExecutor(max_workers=write_concurrency) as write_pool:
+
+        def flush():
+            if ready:
+                batch = list(ready)
+                ready.clear()
+                future = write_pool.submit(batch_ingest.write_items, table, [item for _, item in batch])
+                writes.append((future, {identifier for identifier, _ in batch}))
 
+        def finish(ref, result, preview=None):
+            identifier = ref['identifier']
+            if result is None:
+                failed.add(identifier)
+            else:
+                item = new_item(ref['type'], ref['fileName'], ref['originalUrl'], result, ref['thumbnailUrl'])
+                if preview is not None:
+                    # Encoded and uploaded on the preview workers while detection and writes go on
+                    upload = previews.publish(preview, ref['key'])
+                    item.update(upload.urls)
+                    published.append((identifier, item, upload, ref['thumbnailUrl']))
+                finished[identifier].append(item)
+            remaining[identifier] -= 1
+            if remaining[identifier] == 0:
+                items = finished.pop(identifier, [])
+                if identifier not in failed:
+                    ready.extend((identifier, item) for item in items)
+            if len(ready) >= write_batch_items:
+                flush()
 
+        def finish_image(ref, fetched, detections):
+            counter = species_counting.counter_for(model)
+            result = counter.result(counter.count(detections))
+            if cache is not None and result["tags"]:
+                cache.put(fetched['digest'], version, result)
+            preview = previews.new_builder(model)
+            if preview is not None:
+                preview.add_image(fetched['image'], detections)
+            finish(ref, result, preview)
+
+        def detect_images(batch):
+            try:
+                detections = model.detect([fetched['image'] for _, fetched in batch])
+            except Exception as e:
+                print(f"Failed to tag image batch: {repr(e)}")
+                for ref, _ in batch:
+                    finish(ref, None)
+                return
+            for (ref, fetched), image_detections in zip(batch, detections):
+                finish_image(ref, fetched, image_detections)
+
+        images = []
+        for ref, fetched in iter_fetched(supported, fetch_pool, fetch_concurrency, cache, version, imgsz):
+            if isinstance(fetched, Exception):
+                print(f"Failed to fetch {ref['key']}: {repr(fetched)}")
+                finish(ref, None)
+            elif 'result' in fetched:
+                preview = previews.new_builder(model)
+                if preview is not None:
+                    preview.thumbnail = fetched.get('thumbnail')
+                finish(ref, fetched['result'], preview)
+            elif 'image' in fetched and fetched['plan'].mode == 'tiled':
+                # A tiled image is its own batch of tiles
+                try:
+                    finish_image(ref, fetched, image_decode.detect_tiled(model, fetched['image'], fetched['plan'].tile))
+                except Exception as e:
+                    print(f"Failed to tag {ref['key']}: {repr(e)}")
+                    finish(ref, None)
+            elif 'image' in fetched:
+                images.append((ref, fetched))
+                if len(images) == image_batch_size:
+                    detect_images(images)
+                    images = []
+            else:
+                try:
+                    preview = previews.new_builder(model)
+                    with fetched['download'] as download:
+                        finish(ref, predict_download(download, 'video', model, preview), preview)
+                except Exception as e:
+                    print(f"Failed to tag {ref['key']}: {repr(e)}")
+                    finish(ref, None)
+        if images:
+            detect_images(images)
+        flush()
+
+    saved = 0
+    for future, identifiers in writes:
+        try:
+            saved += len(future.result())
+        except Exception as e:
+            print(f"Failed to save batch to DynamoDB: {repr(e)}")
+            failed.update(identifiers)
+    print(f"Saved {saved} items to DynamoDB")
+
+    for identifier, item, upload, fallback in published:
+        if identifier in failed:
+            # Not written; the retry uploads to the same keys
+            continue
+        try:
+            previews.settle(table, item, upload, fallback)
+        except Exception as e:
+            print(f"Failed to settle previews of {item['file_name']}: {repr(e)}")
+
+    return batch_ingest.batch_response(list(failed))
+
+
+@metrics.instrumented("lambda_bird_detection")
 def lambda_handler(event, context=None):
-    item_id = random.randint(0, 9999999)
+    # Multi-file events (SQS batches, S3 notifications) go through the staged pipeline
+    if 'Records' in event:
+        return batch_handler(event, context)
+
     file_name = event.get('fileName')
     file_type = event.get('type')
     s3_url = event.get('originalUrl')
@@ -101,50 +361,50 @@ def lambda_handler(event, context=None):
     bucket = parsed.netloc.split('.')[0]
     key = parsed.path.lstrip('/')
 
-    # Download media file from S3
-    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-        tmp_path = tmp_file.name
-        s3.download_file(bucket, key, tmp_path)
-
-    # === Download model file from the different bucket ===
-    model_bucket = "g116-models-s3"
-    model_key = "model/image_video_model.pt"
-    model_path = "/tmp/image_video_model.pt"
-
-    try:
-        s3.download_file(model_bucket, model_key, model_path)
-        print(f"Downloaded model from s3://{model_bucket}/{model_key}")
-    except Exception as e:
-        print(f"Failed to download model from S3: {repr(e)}")  # Add repr() to print the full exception
-        return {"message": "Failed to load model from external S3 bucket."}
-
-    # Run detection
-    if file_type == 'image':
-        result = image_prediction(tmp_path, model_path=model_path)
-    elif file_type == 'video':
-        result = video_prediction(tmp_path, model_path=model_path)
-    else:
+    metrics.set_property("file_type", file_type)
+    if file_type not in ('image', 'video'):
         print("Unsupported file type for bird detection.")
         return {"message": "Unsupported file type"}
 
+    # Start fetching the media file in parallel ranges; the temp file is removed on exit
+    with media_ingest.S3Download(bucket, key, suffix=os.path.splitext(key)[1]) as download:
+
+        # === Load model from the different bucket while the media downloads ===
+        try:
+            model = detector_backends.get_detector()
+        except Exception as e:
+            print(f"Failed to download model from S3: {repr(e)}")  # Add repr() to print the full exception
+            return {"message": "Failed to load model from external S3 bucket."}
+
+        # Run detection, reusing the stored result when these exact bytes were seen before
+        preview = previews.new_builder(model)
+        result = predict_download(download, file_type, model, preview)
+
     # Prepare item to save in DynamoDB
-    item = {
-        'id': item_id,
-        'file_type': file_type,
-        'file_name': file_name,
-        's3_url': s3_url,
-        'tags': result["tags"],
-        'counts': result["counts"],
-        'timestamp': datetime.utcnow().isoformat()
-    }
+    item = new_item(file_type, file_name, s3_url, result, s3_thumbnail_url)
 
-    if s3_thumbnail_url:
-        item["s3_thumbnail_url"] = s3_thumbnail_url
+    # Previews are encoded and uploaded on worker threads while the item is written
+    upload = previews.publish(preview, key) if preview is not None else None
+    if upload is not None:
+        item.update(upload.urls)
 
     # Save to DynamoDB
-    table.put_item(Item=item)
+    # Assigns a time-ordered id and upload_date bucket; never overwrites an existing item
+    item_ids.put_new_item(table, item)
     print("Saved item to DynamoDB:", item)
 
+    # Keep the inverted tag index in step with the item
+    try:
+        tag_index.write_index(item)
+    except Exception as e:
+        print(f"Failed to update tag index: {repr(e)}")
+
+    if upload is not None:
+        try:
+            previews.settle(table, item, upload, s3_thumbnail_url)
+        except Exception as e:
+            print(f"Failed to settle previews: {repr(e)}")
+
     return item
 
 
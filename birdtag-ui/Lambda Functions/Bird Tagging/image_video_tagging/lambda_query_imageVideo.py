@@ -4,106 +4,97 @@
 import os
 import tempfile
 import boto3
-from urllib.parse import urlparse
-from ultralytics import YOLO
-import supervision as sv
-import cv2 as cv
-import random
 import json
-from datetime import datetime
+import detector_backends
+import video_frames
+import species_counting
+import video_tracking
+import media_ingest
+import detection_cache
+import image_decode
+import similarity_index
+import metrics
 import base64
 
 region = os.environ.get("AWS_REGION", "ap-southeast-2")
 s3 = boto3.client('s3', region_name=region)
 lambda_client = boto3.client('lambda')
 
-model_bucket = "g116-models-s3"
-model_key = "model/image_video_model.pt"
-model_path = "/tmp/image_video_model.pt"
+# === Similarity search settings ===
+# "on" answers with files ranked by the similarity index instead of return_file_query_handler's
+# exact tag match; a request can also ask for it with "ranked": true
+similarity_search = os.environ.get("SIMILARITY_SEARCH", "off")
 
-def image_prediction(image_path, confidence=0.5, model_path="./model.pt"):
-    model = YOLO(model_path)
-    img = cv.imread(image_path)
-    if img is None:
+if detector_backends.prewarm_enabled:
+    try:
+        detector_backends.prewarm()
+    except Exception as e:
+        print(f"Pre-warm failed, loading on first request instead: {repr(e)}")
+
+def image_prediction(image_path, confidence=0.5, model_path="./model.pt", model=None):
+    if model is None:
+        model = detector_backends.load_detector(model_path)
+
+    # Large images are decoded reduced or run as tiles, see image_decode.plan_image
+    detections = image_decode.detect_image(image_path, model)
+    if detections is None:
         print("Couldn't load the image! Please check the image path.")
         return {"tags": [], "counts": []}
 
-    result = model(img)[0]
-    detections = sv.Detections.from_ultralytics(result)
-    detections = detections[(detections.confidence > confidence)]
-
-    species_count = {}
-    if len(detections.class_id) > 0:
-        species_names = detections.data['class_name']
-        for species in species_names:
-            species = species.lower()
-            species_count[species] = species_count.get(species, 0) + 1
+    counter = species_counting.counter_for(model)
+    return counter.result(counter.count(detections, confidence))
 
-    tags = list(species_count.keys())
-    counts = list(species_count.values())
-    return {"tags": tags, "counts": counts}
 
+def video_prediction(video_path, confidence=0.5, model_path="./model.pt", model=None,
+                     batch_size=None, sampling_mode=None, sample_fps=None, count_mode=None):
+    import supervision as sv
 
-def video_prediction(video_path, confidence=0.5, model_path="./model.pt"):
     try:
-        video_info = sv.VideoInfo.from_video_path(video_path=video_path)
-        fps = int(video_info.fps)
-
-        model = YOLO(model_path)
+        if model is None:
+            model = detector_backends.load_detector(model_path)
+
+        if (count_mode or video_tracking.video_count_mode) == "tracks":
+            track_fps, tracking = video_tracking.plan_sampling(video_path)
+            if tracking:
+                return video_tracking.count_tracks(video_path, model, track_fps, confidence, batch_size)
+            # The frame budget only allows a rate too low to track at; count per-frame maxima instead
+            print(f"Sampling at {track_fps:.2f} fps is too sparse to track, using per-frame maxima")
+            sampling_mode, sample_fps = "fps", track_fps
+
+        # video_path may also be a file object streaming from an in-flight download
+        fps = int(video_frames.probe_fps(video_path))
         tracker = sv.ByteTrack(frame_rate=fps)
 
-        cap = cv.VideoCapture(video_path)
-        if not cap.isOpened():
-            raise Exception("Error: couldn't open the video!")
+        # Largest per-frame count of each species, indexed like counter.tags
+        counter = species_counting.counter_for(model)
+        max_species_count = None
 
-        max_species_count = {}
-        frame_idx = 0
-
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
-                break
-
-            if frame_idx % fps == 0:
-                result = model(frame)[0]
-                detections = sv.Detections.from_ultralytics(result)
+        # Frames are decoded on a background thread; only sampled frames are retrieved
+        for batch in video_frames.iter_frame_batches(
+            video_path, batch_size=batch_size, mode=sampling_mode, fps=sample_fps
+        ):
+            for detections in model.detect([frame for _, _, frame in batch]):
                 detections = tracker.update_with_detections(detections=detections)
-                detections = detections[(detections.confidence > confidence)]
-
-                if len(detections.class_id) > 0:
-                    species_names = detections.data['class_name']
-                    current_count = {}
-                    for species in species_names:
-                        species = species.lower()
-                        current_count[species] = current_count.get(species, 0) + 1
-                    for species, count in current_count.items():
-                        max_species_count[species] = max(max_species_count.get(species, 0), count)
+                max_species_count = counter.running_max(max_species_count, counter.count(detections, confidence))
 
-            frame_idx += 1
-
-        tags = list(max_species_count.keys())
-        counts = list(max_species_count.values())
-        return {"tags": tags, "counts": counts}
+        if max_species_count is None:
+            return {"tags": [], "counts": []}
+        return counter.result(max_species_count)
 
     except Exception as e:
         print(f"An error occurred: {e}")
         return {"tags": [], "counts": []}
-    
-    finally:
-        cap.release()
 
 
 
-def lambda_handler(event, context=None):
-    item_id = random.randint(0, 9999999)
-    file_name = event.get('file_name')  
-    file_type = event.get('file_type')
-    file_content_b64 = event.get('file_content')
+def model_version(file_type):
+    # Video counts also depend on the counting mode, image detections on the decode plan
+    suffix = video_tracking.counting_version() if file_type == 'video' else image_decode.decode_version()
+    return detector_backends.detector_version() + suffix
 
-    if not (file_name and file_type and file_content_b64):
-        return {"message": "Missing required parameters: file_name, file_type, file_content"}
 
-    # Decode base64 content and save to temp file
+def predict_uploaded_file(file_name, file_type, file_content_b64, model):
+    # Legacy path: small files arrive base64-encoded in the invoke payload
     try:
         decoded_bytes = base64.b64decode(file_content_b64)
     except Exception as e:
@@ -113,47 +104,104 @@ def lambda_handler(event, context=None):
         tmp_path = tmp_file.name
         tmp_file.write(decoded_bytes)
 
+    try:
+        predict = image_prediction if file_type == 'image' else video_prediction
+        return detection_cache.cached_detection(
+            decoded_bytes, model_version(file_type), lambda: predict(tmp_path, model=model)
+        )
+    finally:
+        # Cleanup temp file
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-    # Download model and label file from S3 only if not already present
+
+def predict_s3_file(s3_url, file_type, model):
+    # Reference path: the client uploaded to the scratch prefix with a presigned URL
+    bucket, key = media_ingest.parse_s3_url(s3_url)
     try:
-        if not os.path.exists(model_path):
-            s3.download_file(model_bucket, model_key, model_path)
-            print(f"Downloaded model to {model_path}")
-        else:
-            print(f"Model already exists at {model_path}, skipping download.")
+        with media_ingest.S3Download(bucket, key, suffix=os.path.splitext(key)[1]) as download:
+            if file_type == 'video' and video_frames.has_pyav():
+                return detection_cache.cached_stream_detection(
+                    download, model_version(file_type), lambda stream: video_prediction(stream, model=model)
+                )
+
+            path = download.wait()
+            predict = image_prediction if file_type == 'image' else video_prediction
+            return detection_cache.cached_detection(
+                path, model_version(file_type), lambda: predict(path, model=model)
+            )
+    finally:
+        media_ingest.delete_query_upload(bucket, key)
+
+
+@metrics.instrumented("lambda_query_imageVideo")
+def lambda_handler(event, context=None):
+    file_name = event.get('file_name')  
+    file_type = event.get('file_type')
+    file_content_b64 = event.get('file_content')
+    s3_url = event.get('s3_url')
+
+    # Step 1 of the reference flow: hand out a presigned URL for the scratch prefix
+    if event.get('action') == 'upload_url':
+        if not (file_name and file_type):
+            return {"message": "Missing required parameters: file_name, file_type"}
+        return media_ingest.create_query_upload(file_name, event.get('content_type'))
+
+    if not (file_name and file_type and (file_content_b64 or s3_url)):
+        return {"message": "Missing required parameters: file_name, file_type, file_content or s3_url"}
 
+    metrics.set_property("file_type", file_type)
+    if file_type not in ('image', 'video'):
+        return {"message": "Unsupported file type"}
+
+    # Only scratch uploads handed out by action "upload_url" are read by reference, never other objects
+    if s3_url and not media_ingest.is_query_upload(*media_ingest.parse_s3_url(s3_url)):
+        return {"message": "s3_url must be an upload URL returned by action 'upload_url'"}
+
+    # Load model from S3 once per container; warm calls only revalidate the ETag
+    try:
+        model = detector_backends.get_detector()
     except Exception as e:
         return {"message": f"Failed to download model or labels: {repr(e)}"}
 
     # Run prediction
-    if file_type == 'image':
-        result = image_prediction(tmp_path, model_path=model_path)
-    elif file_type == 'video':
-        result = video_prediction(tmp_path, model_path=model_path)
+    if s3_url:
+        try:
+            result = predict_s3_file(s3_url, file_type, model)
+        except Exception as e:
+            return {"message": f"Failed to read uploaded file from S3: {repr(e)}"}
     else:
-        return {"message": "Unsupported file type"}
+        result = predict_uploaded_file(file_name, file_type, file_content_b64, model)
+        if "message" in result:
+            return result
     
     item = {
         'tags': result["tags"],
         'counts': result["counts"]
     }
     
+    # Ranked search runs in this container against the warm index; without a snapshot yet, fall back
+    if event.get('ranked', similarity_search == "on"):
+        try:
+            response = similarity_index.search_response(item['tags'], item['counts'], event.get('top_k'))
+        except Exception as e:
+            print(f"Similarity search failed, using exact tag match: {repr(e)}")
+            response = None
+        if response is not None:
+            return response
+
     # Invoke another Lambda function with the item as payload
     try:
-        response = lambda_client.invoke(
-            FunctionName='return_file_query_handler',
-            InvocationType='RequestResponse',  
-            Payload=json.dumps(item).encode('utf-8')
-        )
+        with metrics.stage("invoke"):
+            response = lambda_client.invoke(
+                FunctionName='return_file_query_handler',
+                InvocationType='RequestResponse',
+                Payload=json.dumps(item).encode('utf-8')
+            )
         response_payload = response['Payload'].read().decode('utf-8')
         print("Invoked return_file_query_handler:", response_payload)
         return json.loads(response_payload)
 
     except Exception as e:
         print(f"Failed to invoke return_file_query_handler: {repr(e)}")
-        return {"message": "Failed to invoke downstream lambda"}
-        
-    finally:
-        # Cleanup temp file
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
\ No newline at end of file
+        return {"message": "Failed to invoke downstream lambda"}
\ No newline at end of file
@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+# Run in a fresh interpreter per measurement, so every import is a cold one
+probe_template = """
+import json, time
+start = time.perf_counter()
+import {module}
+import detector_backends
+imported = time.perf_counter()
+model = detector_backends.get_detector()
+loaded = time.perf_counter()
+result = {module}.image_prediction({sample!r}, model=model)
+done = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (imported - start) * 1000,
+    "load_ms": (loaded - imported) * 1000,
+    "first_inference_ms": (done - loaded) * 1000,
+    "tags": result.get("tags"),
+}}))
+"""
+
+handlers = ["lambda_bird_detection", "lambda_query_imageVideo"]
+
+
+def write_sample(directory, width=1280, height=720):
+    import cv2 as cv
+
+    rng = np.random.default_rng(0)
+    path = os.path.join(directory, "cold_start_sample.jpg")
+    cv.imwrite(path, rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+    return path
+
+
+def top_imports(stderr, limit):
+    """Parse `python -X importtime` output into the slowest top-level imports by cumulative time."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            rows.append((int(cumulative) / 1000, name.strip()))
+    return sorted(rows, reverse=True)[:limit]
+
+
+def measure(module, sample, importtime=False):
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-c", probe_template.format(module=module, sample=sample)]
+    proc = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        raise RuntimeError(f"{module} failed:\n{proc.stderr[-2000:]}")
+    return json.loads(proc.stdout.strip().splitlines()[-1]), proc.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import time and first-inference latency of the image/video handlers in fresh interpreters.")
+    parser.add_argument("--handlers", nargs="+", default=handlers, choices=handlers)
+    parser.add_argument("--sample", help="Image to tag (default: a generated 1280x720 noise image)")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--importtime", type=int, default=0, metavar="N",
+                        help="Also list the N slowest top-level imports of the first run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        sample = os.path.abspath(args.sample) if args.sample else write_sample(directory)
+        print(f"PREWARM={os.environ.get('PREWARM', 'off')} MODEL_DIR={os.environ.get('MODEL_DIR', '-')} DETECTOR_BACKEND={os.environ.get('DETECTOR_BACKEND', 'torch')}")
+        print(f"{'handler':<24} {'import ms':>10} {'load ms':>9} {'first ms':>9} {'cold total':>11}")
+        for module in args.handlers:
+            runs, stderr = [], ""
+            for n in range(args.runs):
+                result, err = measure(module, sample, importtime=args.importtime and n == 0)
+                stderr = stderr or err
+                runs.append(result)
+            import_ms = np.median([r["import_ms"] for r in runs])
+            load_ms = np.median([r["load_ms"] for r in runs])
+            first_ms = np.median([r["first_inference_ms"] for r in runs])
+            print(f"{module:<24} {import_ms:>10.1f} {load_ms:>9.1f} {first_ms:>9.1f} {import_ms + load_ms + first_ms:>11.1f}")
+            for cumulative_ms, name in top_imports(stderr, args.importtime):
+                print(f"    {cumulative_ms:>8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import io
+import os
+import uuid
+import glob
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from urllib.parse import urlparse, unquote, quote
+import metrics
+
+region = os.environ.get("AWS_REGION", "ap-southeast-2")
+s3 = boto3.client('s3', region_name=region)
+
+# === Ingest settings ===
+tmp_dir = os.environ.get("INGEST_TMP_DIR", tempfile.gettempdir())
+chunk_size = int(os.environ.get("INGEST_CHUNK_BYTES", str(8 * 1024 * 1024)))
+max_workers = int(os.environ.get("INGEST_MAX_WORKERS", "8"))
+# Bytes of /tmp that downloads may hold at once; defaults to 90% of the volume
+tmp_quota_bytes = int(os.environ.get("INGEST_TMP_QUOTA_BYTES", "0")) or int(shutil.disk_usage(tmp_dir).total * 0.9)
+
+_prefix = "birdtag-media-"
+_reserved_bytes = 0
+_active_paths = set()
+_quota_lock = threading.Lock()
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def _reserve(size):
+    global _reserved_bytes
+    with _quota_lock:
+        if _reserved_bytes + size > tmp_quota_bytes:
+            raise QuotaExceeded(
+                f"Media of {size} bytes does not fit in the /tmp quota "
+                f"({_reserved_bytes} of {tmp_quota_bytes} bytes in use)"
+            )
+        _reserved_bytes += size
+
+
+def _release(size):
+    global _reserved_bytes
+    with _quota_lock:
+        _reserved_bytes = max(0, _reserved_bytes - size)
+
+
+def cleanup_stale_files():
+    """Delete media left in /tmp by earlier invocations of this container that did not finish."""
+    with _quota_lock:
+        for path in glob.glob(os.path.join(tmp_dir, _prefix + "*")):
+            if path not in _active_paths:
+                try:
+                    os.remove(path)
+                    print(f"Removed stale temp file {path}")
+                except OSError:
+                    pass
+
+
+class S3Download:
+    """
+    Download an S3 object into /tmp with parallel ranged GETs.
+
+    Chunks are fetched in file order, so the head of the file lands first and
+    open_stream() readers can start decoding while the rest is in flight. The
+    temp file and its quota reservation are always released by close().
+    """
+
+    def __init__(self, bucket, key, suffix=""):
+        self.bucket = bucket
+        self.key = key
+        head = s3.head_object(Bucket=bucket, Key=key)
+        self.size = head['ContentLength']
+        self.etag = head['ETag']
+        self.path = None
+        self.error = None
+        self._closed = threading.Event()
+        self._executor = None
+        self._reserved = False
+
+        cleanup_stale_files()
+        _reserve(self.size)
+        self._reserved = True
+        try:
+            # Registered under the lock so a concurrent cleanup never sees it as stale
+            with _quota_lock:
+                fd, self.path = tempfile.mkstemp(prefix=_prefix, suffix=suffix, dir=tmp_dir)
+                _active_paths.add(self.path)
+            with os.fdopen(fd, 'wb') as f:
+                f.truncate(self.size)
+        except Exception:
+            self.close()
+            raise
+
+        n_chunks = max(1, -(-self.size // chunk_size))
+        self._done = [threading.Event() for _ in range(n_chunks)]
+        self._executor = ThreadPoolExecutor(max_workers=min(max_workers, n_chunks))
+        self._futures = [self._executor.submit(self._fetch, i) for i in range(n_chunks)]
+
+    def _fetch(self, index):
+        if self._closed.is_set():
+            return
+        start = index * chunk_size
+        end = min(self.size, start + chunk_size) - 1
+        try:
+            if end >= start:
+                body = s3.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end}")['Body']
+                with open(self.path, 'r+b') as f:
+                    f.seek(start)
+                    shutil.copyfileobj(body, f, length=1024 * 1024)
+                metrics.count("bytes_fetched", end - start + 1)
+        except Exception as e:
+            self.error = self.error or e
+        finally:
+            self._done[index].set()
+
+    def wait_range(self, start, end):
+        """Block until bytes [start, end) are on disk."""
+        first = start // chunk_size
+        last = min(len(self._done) - 1, max(start, end - 1) // chunk_size)
+        with metrics.stage("download"):
+            for index in range(first, last + 1):
+                self._done[index].wait()
+        if self.error is not None:
+            raise self.error
+
+    def wait(self):
+        """Block until the whole object is on disk and return its path."""
+        self.wait_range(0, self.size)
+        return self.path
+
+    def open_stream(self):
+        """Return a seekable file object that blocks on reads until the bytes have arrived."""
+        return io.BufferedReader(_DownloadReader(self), buffer_size=1024 * 1024)
+
+    def close(self):
+        self._closed.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            with _quota_lock:
+                _active_paths.discard(self.path)
+            self.path = None
+        if self._reserved:
+            _release(self.size)
+            self._reserved = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _DownloadReader(io.RawIOBase):
+    def __init__(self, download):
+        self.download = download
+        self.file = open(download.path, 'rb')
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = self.download.size + offset
+        return self.pos
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self.download.size - self.pos)
+        if n <= 0:
+            return 0
+        self.download.wait_range(self.pos, self.pos + n)
+        self.file.seek(self.pos)
+        read = self.file.readinto(memoryview(buffer)[:n])
+        self.pos += read
+        return read
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+# === Scratch uploads for "search by uploaded file" queries ===
+# Kept out of the media bucket, whose uploads trigger tagging; give the prefix a short
+# S3 lifecycle expiry (handlers also delete objects once processed)
+query_upload_bucket = os.environ.get("QUERY_UPLOAD_BUCKET", "g116-query-uploads-s3")
+query_upload_prefix = os.environ.get("QUERY_UPLOAD_PREFIX", "query-uploads/")
+query_upload_expires = int(os.environ.get("QUERY_UPLOAD_EXPIRES", "300"))
+
+
+def parse_s3_url(s3_url):
+    """Split a virtual-hosted style S3 URL into (bucket, key)."""
+    parsed = urlparse(s3_url)
+    return parsed.netloc.split('.')[0], unquote(parsed.path.lstrip('/'))
+
+
+def create_query_upload(file_name, content_type=None):
+    """Return a presigned PUT URL under the scratch prefix and the s3_url to query with afterwards."""
+    key = f"{query_upload_prefix}{uuid.uuid4().hex}/{os.path.basename(file_name)}"
+    params = {'Bucket': query_upload_bucket, 'Key': key}
+    if content_type:
+        params['ContentType'] = content_type
+    upload_url = s3.generate_presigned_url('put_object', Params=params, ExpiresIn=query_upload_expires)
+    return {
+        "upload_url": upload_url,
+        "s3_url": f"https://{query_upload_bucket}.s3.{region}.amazonaws.com/{quote(key)}",
+        "expires_in": query_upload_expires,
+    }
+
+
+def is_query_upload(bucket, key):
+    """True for objects under the scratch prefix, which are queried and deleted, never tagged."""
+    return bucket == query_upload_bucket and key.startswith(query_upload_prefix)
+
+
+def delete_query_upload(bucket, key):
+    """Remove a processed scratch upload; objects outside the scratch prefix are left alone."""
+    if not is_query_upload(bucket, key):
+        return
+    try:
+        s3.delete_object(Bucket=bucket, Key=key)
+    except Exception as e:
+        print(f"Failed to delete scratch upload s3://{bucket}/{key}: {repr(e)}")
@@ -0,0 +1,133 @@
+import os
+import time
+import hashlib
+import threading
+import boto3
+from botocore.exceptions import ClientError
+import metrics
+
+region = os.environ.get("AWS_REGION", "ap-southeast-2")
+s3 = boto3.client('s3', region_name=region)
+
+# === Default model location in the models bucket ===
+model_bucket = "g116-models-s3"
+model_key = "model/image_video_model.pt"
+model_path = "/tmp/image_video_model.pt"
+
+# Seconds a warm model is trusted before the ETag is checked again (0 = every call)
+revalidate_seconds = float(os.environ.get("MODEL_REVALIDATE_SECONDS", "30"))
+
+# Directory holding models under their S3 file names, baked into the image or an EFS
+# mount; models found there are loaded from disk and never fetched or revalidated
+local_model_dir = os.environ.get("MODEL_DIR")
+
+# (bucket, key) -> {"etag", "model", "path", "checked_at", "local"}
+_models = {}
+_lock = threading.Lock()
+
+
+def _is_not_modified(error):
+    code = str(error.response.get('Error', {}).get('Code', ''))
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in ('304', 'NotModified') or status == 304
+
+
+def _revalidate(bucket, key, etag):
+    # Conditional HEAD: S3 answers 304 when the object still carries this ETag
+    try:
+        response = s3.head_object(Bucket=bucket, Key=key, IfNoneMatch=etag)
+    except ClientError as e:
+        if _is_not_modified(e):
+            return etag
+        raise
+    return response['ETag']
+
+
+def _download(bucket, key, local_path):
+    etag = s3.head_object(Bucket=bucket, Key=key)['ETag']
+    # IfMatch pins the download to the version whose ETag we just recorded
+    s3.download_file(bucket, key, local_path, ExtraArgs={'IfMatch': etag})
+    metrics.count("bytes_fetched", os.path.getsize(local_path))
+    print(f"Downloaded model from s3://{bucket}/{key} (ETag {etag})")
+    return etag
+
+
+def _local_copy(key):
+    if not local_model_dir:
+        return None
+    path = os.path.join(local_model_dir, os.path.basename(key))
+    return path if os.path.exists(path) else None
+
+
+def _file_digest(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _load_yolo(path):
+    from ultralytics import YOLO
+    return YOLO(path)
+
+
+def get_model(bucket=model_bucket, key=model_key, local_path=model_path, loader=_load_yolo):
+    """
+    Return the warm model for s3://bucket/key, loading it at most once per container.
+
+    The cached entry is reused while its ETag matches the object in S3, checked
+    with a conditional HEAD at most every MODEL_REVALIDATE_SECONDS.
+    """
+    with metrics.stage("model_load"), _lock:
+        entry = _models.get((bucket, key))
+        now = time.monotonic()
+
+        if entry is not None:
+            if entry['local'] or now - entry['checked_at'] < revalidate_seconds:
+                metrics.count("model_cache_hit")
+                return entry['model']
+            try:
+                current_etag = _revalidate(bucket, key, entry['etag'])
+            except ClientError as e:
+                # Keep serving the warm model if S3 is briefly unreachable
+                print(f"Model revalidation failed, using cached model: {repr(e)}")
+                entry['checked_at'] = now
+                metrics.count("model_cache_hit")
+                return entry['model']
+            if current_etag == entry['etag']:
+                entry['checked_at'] = now
+                metrics.count("model_cache_hit")
+                return entry['model']
+            print(f"Model s3://{bucket}/{key} changed ({entry['etag']} -> {current_etag}), reloading")
+
+        metrics.count("model_cache_miss")
+        local_copy = _local_copy(key)
+        if local_copy is not None:
+            # Identified by content so cached detections stay keyed to the weights
+            local_path = local_copy
+            etag = f"local:{_file_digest(local_path)[:16]}"
+        else:
+            etag = _download(bucket, key, local_path)
+        model = loader(local_path)
+        _models[(bucket, key)] = {
+            'etag': etag,
+            'model': model,
+            'path': local_path,
+            'checked_at': now,
+            'local': local_copy is not None,
+        }
+        return model
+
+
+def cached_models():
+    """Return the (bucket, key, etag) of every model currently held warm."""
+    with _lock:
+        return [(bucket, key, entry['etag']) for (bucket, key), entry in _models.items()]
+
+
+def model_etag(bucket=model_bucket, key=model_key):
+    """Return the ETag of the warm model for s3://bucket/key, or None if it is not loaded."""
+    with _lock:
+        entry = _models.get((bucket, key))
+        return entry['etag'] if entry is not None else None
@@ -0,0 +1,266 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import numpy as np
+import batch_ingest
+import image_decode
+import species_counting
+import metrics
+
+region = os.environ.get("AWS_REGION", "ap-southeast-2")
+s3 = boto3.client('s3', region_name=region)
+
+# === Preview settings ===
+# "on" makes the thumbnail (and for videos a keyframe strip) from the frames already decoded
+# for detection, replacing the thumbnailUrl of an external producer that decodes every upload again
+preview_mode = os.environ.get("PREVIEWS", "off")
+preview_bucket = os.environ.get("PREVIEW_BUCKET", "g116-thumbnails-s3")
+# Long side of the thumbnail, height and frame count of the video strip
+thumbnail_size = int(os.environ.get("PREVIEW_THUMBNAIL_SIZE", "320"))
+strip_height = int(os.environ.get("PREVIEW_STRIP_HEIGHT", "120"))
+strip_frames = int(os.environ.get("PREVIEW_STRIP_FRAMES", "8"))
+# "on" also uploads a boxed, labelled crop of the most confident detections (for videos, from the thumbnail frame)
+crop_mode = os.environ.get("PREVIEW_CROPS", "off")
+max_crops = int(os.environ.get("PREVIEW_MAX_CROPS", "4"))
+crop_size = int(os.environ.get("PREVIEW_CROP_SIZE", "256"))
+# Context kept around a box, as a fraction of its width and height
+crop_padding = float(os.environ.get("PREVIEW_CROP_PADDING", "0.2"))
+jpeg_quality = int(os.environ.get("PREVIEW_JPEG_QUALITY", "80"))
+# Worker threads encoding and uploading previews, shared by every file of an invocation
+upload_concurrency = int(os.environ.get("PREVIEW_UPLOAD_CONCURRENCY", "4"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def enabled():
+    return preview_mode == "on"
+
+
+def resize(frame, scale):
+    """Return a copy of frame scaled by scale (only ever down), never aliasing the decoder's buffer."""
+    import cv2 as cv
+
+    if scale >= 1:
+        return frame.copy()
+    height, width = frame.shape[:2]
+    size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    return cv.resize(frame, size, interpolation=cv.INTER_AREA)
+
+
+def fit(frame, long_side):
+    return resize(frame, long_side / max(frame.shape[:2]))
+
+
+def crop_detections(frame, detections, counter, confidence=0.5, limit=None):
+    """
+    Cut padded crops of the most confident boxes out of frame.
+
+    Returns (crop, box, label) with the box in crop coordinates; the box and label are
+    drawn when the crop is encoded, off the detector thread.
+    """
+    limit = max_crops if limit is None else limit
+    if detections is None or detections.class_id is None or len(detections) == 0:
+        return []
+    keep = np.flatnonzero(detections.confidence > confidence)
+    keep = keep[np.argsort(-detections.confidence[keep], kind="stable")][:limit]
+    tags = counter.tag_indices(detections.class_id[keep])
+    height, width = frame.shape[:2]
+
+    crops = []
+    for i, tag in zip(keep.tolist(), tags.tolist()):
+        x1, y1, x2, y2 = detections.xyxy[i].tolist()
+        pad_x, pad_y = (x2 - x1) * crop_padding, (y2 - y1) * crop_padding
+        left, top = int(max(0, x1 - pad_x)), int(max(0, y1 - pad_y))
+        right, bottom = int(min(width, x2 + pad_x)), int(min(height, y2 + pad_y))
+        if right <= left or bottom <= top:
+            continue
+        crop = frame[top:bottom, left:right]
+        scale = min(1.0, crop_size / max(crop.shape[:2]))
+        box = tuple(int(round(v * scale)) for v in (x1 - left, y1 - top, x2 - left, y2 - top))
+        crops.append((resize(crop, scale), box, f"{counter.tags[tag]} {detections.confidence[i]:.2f}"))
+    return crops
+
+
+class PreviewBuilder:
+    """
+    Collects preview frames from the detection loop.
+
+    Only small copies are kept: the thumbnail, the crops and at most 2 * strip_frames
+    strip frames, so a long video costs no more memory than a short one.
+    """
+
+    def __init__(self, counter, confidence=0.5, crops=None):
+        self.counter = counter
+        self.confidence = confidence
+        self.with_crops = (crop_mode == "on") if crops is None else crops
+        self.thumbnail = None
+        self.crops = []
+        self.strip = []
+        self._best = -1.0
+        self._seen = 0
+        self._stride = 1
+
+    def add_image(self, img, detections=None):
+        with metrics.stage("preview"):
+            self.thumbnail = fit(img, thumbnail_size)
+            if self.with_crops:
+                self.crops = crop_detections(img, detections, self.counter, self.confidence)
+
+    def add_frames(self, batch, detections):
+        """Take one detected batch of (frame_idx, timestamp, frame) and its detections."""
+        with metrics.stage("preview"):
+            for (_, _, frame), frame_detections in zip(batch, detections):
+                self._add_strip_frame(frame)
+                # The thumbnail is the frame with the most confident birds, the first frame if none are seen
+                score = 0.0
+                if len(frame_detections):
+                    score = float(frame_detections.confidence[frame_detections.confidence > self.confidence].sum())
+                if score > self._best:
+                    self._best = score
+                    self.thumbnail = fit(frame, thumbnail_size)
+                    if self.with_crops:
+                        self.crops = crop_detections(frame, frame_detections, self.counter, self.confidence)
+
+    def _add_strip_frame(self, frame):
+        # Every stride-th frame is kept; when twice the strip is held, every other one is
+        # dropped and the stride doubles, so the kept frames stay evenly spread over the clip
+        if self._seen % self._stride == 0:
+            self.strip.append(resize(frame, strip_height / frame.shape[0]))
+            if len(self.strip) >= 2 * strip_frames:
+                self.strip = self.strip[::2]
+                self._stride *= 2
+        self._seen += 1
+
+    def strip_image(self):
+        picks = np.unique(np.linspace(0, len(self.strip) - 1, min(strip_frames, len(self.strip))).round().astype(int))
+        frames = [self.strip[i] for i in picks]
+        width = min(frame.shape[1] for frame in frames)
+        return np.hstack([frame[:, :width] for frame in frames])
+
+
+def new_builder(model, confidence=0.5):
+    """A PreviewBuilder for model's detections, or None when previews are off."""
+    if not enabled():
+        return None
+    return PreviewBuilder(species_counting.counter_for(model), confidence)
+
+
+def thumbnail_image(path):
+    """Decode path just large enough for a thumbnail, for files whose detections came from the cache."""
+    size = image_decode.image_size(path)
+    factor = image_decode.reduce_factor(max(size), thumbnail_size) if size else 1
+    img = image_decode.decode(path, factor)
+    return None if img is None else fit(img, thumbnail_size)
+
+
+def _encode(img):
+    import cv2 as cv
+
+    ok, buffer = cv.imencode(".jpg", img, [cv.IMWRITE_JPEG_QUALITY, jpeg_quality])
+    if not ok:
+        raise ValueError("JPEG encoding failed")
+    return buffer.tobytes()
+
+
+def _annotate(crop, box, label):
+    import cv2 as cv
+
+    crop = crop.copy()
+    cv.rectangle(crop, box[:2], box[2:], (0, 255, 0), 2)
+    cv.putText(crop, label, (4, 16), cv.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1, cv.LINE_AA)
+    return crop
+
+
+def _upload(bucket, key, render):
+    with metrics.stage("preview_encode"):
+        body = _encode(render())
+    with metrics.stage("preview_upload"):
+        s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType="image/jpeg")
+    metrics.count("previews_uploaded")
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=upload_concurrency, thread_name_prefix="preview")
+    return _executor
+
+
+class Preview:
+    """The item attributes a published builder fills in, and the uploads behind them."""
+
+    def __init__(self):
+        self.urls = {}
+        self._uploads = []
+
+    def failed(self):
+        """Wait for the uploads; return the attributes whose object did not make it to S3."""
+        failed = set()
+        for attribute, key, future in self._uploads:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to upload preview {key}: {repr(e)}")
+                failed.add(attribute)
+        return failed
+
+
+def publish(builder, media_key, bucket=None):
+    """
+    Start encoding and uploading what builder collected on the worker threads.
+
+    The keys are known up front, so the returned Preview's urls can go into the item
+    while the uploads run; settle() afterwards takes back any whose upload failed.
+    """
+    bucket = bucket or preview_bucket
+    stem = os.path.splitext(media_key)[0]
+    preview = Preview()
+
+    def submit(attribute, key, render):
+        preview._uploads.append((attribute, key, executor().submit(_upload, bucket, key, render)))
+        return batch_ingest.media_url(bucket, key)
+
+    if builder.thumbnail is not None:
+        preview.urls['s3_thumbnail_url'] = submit('s3_thumbnail_url', f"{stem}_thumb.jpg", lambda: builder.thumbnail)
+    if len(builder.strip) > 1:
+        preview.urls['s3_strip_url'] = submit('s3_strip_url', f"{stem}_strip.jpg", builder.strip_image)
+    if builder.crops:
+        preview.urls['s3_crop_urls'] = [
+            submit('s3_crop_urls', f"{stem}_crop{n}.jpg", lambda crop=crop: _annotate(*crop))
+            for n, crop in enumerate(builder.crops)
+        ]
+    return preview
+
+
+def settle(table, item, preview, fallback_thumbnail=None):
+    """
+    Wait for item's preview uploads and take back the attributes of any that failed.
+
+    A failed thumbnail falls back to the externally made one when the event carried it.
+    """
+    failed = preview.failed()
+    if not failed:
+        return item
+
+    sets, removes, values = [], [], {}
+    for attribute in sorted(failed):
+        if attribute == 's3_thumbnail_url' and fallback_thumbnail:
+            sets.append("s3_thumbnail_url = :thumbnail")
+            values[':thumbnail'] = fallback_thumbnail
+            item[attribute] = fallback_thumbnail
+        else:
+            removes.append(attribute)
+            item.pop(attribute, None)
+    expression = " ".join(
+        clause for clause in ("SET " + ", ".join(sets) if sets else "", "REMOVE " + ", ".join(removes) if removes else "")
+        if clause
+    )
+    kwargs = {'Key': {'id': item['id'], 'file_type': item['file_type']}, 'UpdateExpression': expression}
+    if values:
+        kwargs['ExpressionAttributeValues'] = values
+    table.update_item(**kwargs)
+    return item
@@ -0,0 +1,69 @@
+import numpy as np
+
+
+class SpeciesCounter:
+    """
+    Per-species box counts computed with np.bincount over detections.class_id.
+
+    Class names are lowercased once into a tag table; classes whose names only
+    differ by case share a tag. Counts come back as an array indexed by tag.
+    """
+
+    def __init__(self, class_names):
+        if isinstance(class_names, dict):
+            size = max(class_names, default=-1) + 1
+            class_names = [class_names.get(i, str(i)) for i in range(size)]
+        self.tags = []
+        self._tag_index = {}
+        self.class_to_tag = np.zeros(0, dtype=np.intp)
+        self._add_classes([str(name) for name in class_names])
+
+    def _add_classes(self, names):
+        indices = []
+        for name in names:
+            tag = name.lower()
+            if tag not in self._tag_index:
+                self._tag_index[tag] = len(self.tags)
+                self.tags.append(tag)
+            indices.append(self._tag_index[tag])
+        self.class_to_tag = np.concatenate([self.class_to_tag, np.array(indices, dtype=np.intp)])
+
+    def __len__(self):
+        return len(self.tags)
+
+    def count(self, detections, confidence=0.5):
+        """Return an int array of boxes above confidence per tag."""
+        if detections.class_id is None or len(detections) == 0:
+            return np.zeros(len(self.tags), dtype=np.int64)
+        class_id = detections.class_id[detections.confidence > confidence]
+        return np.bincount(self.tag_indices(class_id), minlength=len(self.tags))
+
+    def tag_indices(self, class_id):
+        """Map an array of class ids to indices into self.tags."""
+        if len(class_id) and class_id.max() >= len(self.class_to_tag):
+            # Model without a names table: unseen ids are named after themselves, as the detectors do
+            self._add_classes([str(i) for i in range(len(self.class_to_tag), int(class_id.max()) + 1)])
+        return self.class_to_tag[class_id]
+
+    def running_max(self, running, counts):
+        """Fold one frame's counts into a per-tag running maximum, growing it if the table grew."""
+        if running is None:
+            return counts.copy()
+        if len(running) < len(counts):
+            running = np.pad(running, (0, len(counts) - len(running)))
+        np.maximum(running, counts, out=running)
+        return running
+
+    def result(self, counts):
+        """Turn a per-tag count array into the {"tags", "counts"} stored on items."""
+        present = np.flatnonzero(counts)
+        return {"tags": [self.tags[i] for i in present], "counts": [int(counts[i]) for i in present]}
+
+
+def counter_for(model):
+    """Return the SpeciesCounter for a detector, built from its class names on first use."""
+    counter = getattr(model, 'species_counter', None)
+    if counter is None:
+        counter = SpeciesCounter(getattr(model, 'names', None) or [])
+        model.species_counter = counter
+    return counter
@@ -0,0 +1,91 @@
+import json
+import threading
+import pytest
+from botocore.exceptions import ClientError
+import batch_ingest
+import item_ids
+import media_ingest
+import tag_index
+
+
+class StubTable:
+    """put_item and batch_writer over a dict, honouring attribute_not_exists(id) as birds_table would."""
+
+    def __init__(self, taken=()):
+        self.items = {item_id: {'id': item_id} for item_id in taken}
+        self.unconditional = 0
+        self._lock = threading.Lock()
+
+    def put_item(self, Item, ConditionExpression=None):
+        with self._lock:
+            if ConditionExpression is None:
+                self.unconditional += 1
+            elif Item['id'] in self.items:
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+                                             'Message': 'The conditional request failed'}}, 'PutItem')
+            self.items[Item['id']] = dict(Item)
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        table = self
+
+        class Writer:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def put_item(self, Item):
+                table.put_item(Item=Item)
+
+        return Writer()
+
+
+@pytest.fixture
+def index_table(monkeypatch):
+    stub = StubTable()
+    monkeypatch.setattr(tag_index, 'index_table', stub)
+    return stub
+
+
+def test_write_items_uses_conditional_puts(index_table):
+    table = StubTable()
+    items = [{'file_type': 'image', 'file_name': f"{n}.jpg", 'tags': ['crow'], 'counts': [1]} for n in range(40)]
+
+    batch_ingest.write_items(table, items)
+
+    assert table.unconditional == 0
+    assert len(table.items) == 40
+    assert len({item['id'] for item in items}) == 40
+    assert all(item['upload_date'] == item_ids.date_bucket(item['id']) for item in items)
+
+
+def test_write_items_retries_an_id_taken_by_another_container(monkeypatch, index_table):
+    ids = iter([7, 7, 8])
+    monkeypatch.setattr(item_ids, 'new_item_id', lambda: next(ids))
+    table = StubTable(taken=[7])
+    item = {'file_type': 'audio', 'file_name': 'call.wav', 'tags': [], 'counts': []}
+
+    batch_ingest.write_items(table, [item])
+
+    assert item['id'] == 8
+    assert table.items[7] == {'id': 7}
+    assert table.items[8]['file_name'] == 'call.wav'
+
+
+def test_parse_records_skips_query_uploads(monkeypatch):
+    monkeypatch.setattr(media_ingest, 'query_upload_bucket', 'g116-media-s3')
+    notification = {'Records': [
+        {'s3': {'bucket': {'name': 'g116-media-s3'}, 'object': {'key': 'image/crow.jpg'}}},
+        {'s3': {'bucket': {'name': 'g116-media-s3'}, 'object': {'key': 'query-uploads/abc/probe.jpg'}}},
+    ]}
+    tagging_event = {'originalUrl': 'https://g116-media-s3.s3.ap-southeast-2.amazonaws.com/query-uploads/def/probe.wav'}
+    event = {'Records': [
+        {'messageId': 'm1', 'body': json.dumps(notification)},
+        {'messageId': 'm2', 'body': json.dumps(tagging_event)},
+    ]}
+
+    refs, failed = batch_ingest.parse_records(event)
+
+    assert [(ref['identifier'], ref['key']) for ref in refs] == [('m1', 'image/crow.jpg')]
+    assert failed == []
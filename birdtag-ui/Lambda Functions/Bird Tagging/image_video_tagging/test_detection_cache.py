@@ -0,0 +1,70 @@
+import io
+import pytest
+import detection_cache
+
+
+class StubCache:
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, digest, model_version):
+        return self.entries.get((digest, model_version))
+
+    def put(self, digest, model_version, result):
+        self.entries[(digest, model_version)] = result
+
+
+class StubDownload:
+    """The parts of media_ingest.S3Download the stream path uses."""
+
+    def __init__(self, data, etag='"abc123"', key="video/clip.mp4"):
+        self.data = data
+        self.etag = etag
+        self.size = len(data)
+        self.key = key
+        self.streams = 0
+
+    def open_stream(self):
+        self.streams += 1
+        return io.BytesIO(self.data)
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    stub = StubCache()
+    monkeypatch.setattr(detection_cache, 'get_cache', lambda: stub)
+    return stub
+
+
+def test_stream_miss_stores_under_object_and_content_keys(cache):
+    download = StubDownload(b"frames" * 1000)
+    seen = []
+
+    def predict(stream):
+        seen.append(stream.read())
+        return {"tags": ["crow"], "counts": [2]}
+
+    result = detection_cache.cached_stream_detection(download, "v1", predict)
+
+    assert result == {"tags": ["crow"], "counts": [2]}
+    assert seen == [download.data]
+    assert cache.get(detection_cache.object_digest(download.etag, download.size), "v1") == result
+    assert cache.get(detection_cache.hash_media(download.data), "v1") == result
+
+
+def test_stream_hit_by_etag_reads_nothing(cache):
+    download = StubDownload(b"frames")
+    cache.put(detection_cache.object_digest(download.etag, download.size), "v1", {"tags": ["owl"], "counts": [1]})
+
+    result = detection_cache.cached_stream_detection(download, "v1", lambda stream: pytest.fail("detector ran"))
+
+    assert result == {"tags": ["owl"], "counts": [1]}
+    assert download.streams == 0
+
+
+def test_stream_does_not_store_empty_results(cache):
+    download = StubDownload(b"static")
+
+    detection_cache.cached_stream_detection(download, "v1", lambda stream: {"tags": [], "counts": []})
+
+    assert cache.entries == {}
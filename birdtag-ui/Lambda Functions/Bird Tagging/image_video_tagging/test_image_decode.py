@@ -0,0 +1,51 @@
+import numpy as np
+from image_decode import merge_boxes, seam_boxes
+
+
+def boxes(*rows):
+    return np.array(rows, dtype=np.float32)
+
+
+def test_overlapping_birds_in_one_view_are_both_kept():
+    # A small crow mostly behind a larger one, both from the same tile
+    xyxy = boxes([100, 100, 300, 300], [120, 120, 200, 200])
+    keep = merge_boxes(xyxy, np.array([0.9, 0.8]), np.array([2, 2]), np.array([1, 1]), np.array([False, False]))
+
+    assert sorted(keep.tolist()) == [0, 1]
+
+
+def test_small_bird_inside_a_larger_one_from_another_view_is_kept():
+    xyxy = boxes([100, 100, 300, 300], [120, 120, 200, 200])
+    keep = merge_boxes(xyxy, np.array([0.9, 0.8]), np.array([2, 2]), np.array([0, 1]), np.array([False, False]))
+
+    assert sorted(keep.tolist()) == [0, 1]
+
+
+def test_bird_seen_in_two_views_is_merged():
+    xyxy = boxes([100, 100, 300, 300], [104, 98, 302, 296])
+    keep = merge_boxes(xyxy, np.array([0.7, 0.9]), np.array([2, 2]), np.array([0, 3]), np.array([False, False]))
+
+    assert keep.tolist() == [1]
+
+
+def test_bird_cut_by_a_seam_folds_into_its_whole_box():
+    # The tile's box stops at the seam (x = 640), so its IoU with the whole box is low
+    xyxy = boxes([600, 100, 700, 200], [600, 100, 640, 200])
+    keep = merge_boxes(xyxy, np.array([0.9, 0.95]), np.array([2, 2]), np.array([0, 1]), np.array([False, True]))
+
+    assert keep.tolist() == [1]
+
+
+def test_different_classes_are_never_merged():
+    xyxy = boxes([100, 100, 300, 300], [100, 100, 300, 300])
+    keep = merge_boxes(xyxy, np.array([0.9, 0.8]), np.array([2, 5]), np.array([0, 1]), np.array([False, False]))
+
+    assert sorted(keep.tolist()) == [0, 1]
+
+
+def test_seam_boxes_ignore_image_borders():
+    # Top-left tile of a 1000x800 image: only its right and bottom edges are seams
+    xyxy = boxes([0, 0, 50, 50], [600, 10, 640, 60], [10, 600, 60, 640])
+    assert seam_boxes(xyxy, 0, 0, 640, 640, 1000, 800).tolist() == [False, True, True]
+    # The whole-image view has no seams
+    assert not seam_boxes(xyxy, 0, 0, 1000, 800, 1000, 800).any()
@@ -0,0 +1,128 @@
+import json
+from decimal import Decimal
+import pytest
+from botocore.exceptions import ClientError
+import similarity_index
+import tag_index
+from similarity_index import SimilarityIndex, write_snapshot, item_key
+
+ITEMS = [
+    {'id': Decimal(1001), 'file_type': 'image', 'tags': ['crow'], 'counts': [Decimal(2)],
+     's3_url': 's3://g116-media-s3/image/crow.jpg', 's3_thumbnail_url': 's3://g116-thumbnails-s3/image/crow_thumb.jpg'},
+    {'id': Decimal(1002), 'file_type': 'video', 'tags': ['crow', 'pigeon'], 'counts': [Decimal(1), Decimal(3)],
+     's3_url': 'https://g116-media-s3.s3.ap-southeast-2.amazonaws.com/video/flock.mp4'},
+    {'id': Decimal(1003), 'file_type': 'audio', 'tags': ['kingfisher'], 'counts': [Decimal(1)],
+     's3_url': 's3://g116-media-s3/audio/kingfisher.wav'},
+]
+
+
+class StubDynamoDB:
+    """batch_get_item over ITEMS, refusing keys whose types do not match birds_table's (id N, file_type S)."""
+
+    def __init__(self, items):
+        self.items = {(int(item['id']), item['file_type']): item for item in items}
+        self.requests = []
+
+    def batch_get_item(self, RequestItems):
+        (table, request), = RequestItems.items()
+        self.requests.append(request['Keys'])
+        found = []
+        for key in request['Keys']:
+            if isinstance(key['id'], bool) or not isinstance(key['id'], (int, Decimal)):
+                raise ClientError({'Error': {'Code': 'ValidationException',
+                                             'Message': 'The provided key element does not match the schema'}},
+                                  'BatchGetItem')
+            item = self.items.get((int(key['id']), key['file_type']))
+            if item is not None:
+                found.append(item)
+        return {'Responses': {table: found}, 'UnprocessedKeys': {}}
+
+
+@pytest.fixture
+def stub_table(monkeypatch):
+    stub = StubDynamoDB(ITEMS)
+    monkeypatch.setattr(tag_index, 'dynamodb', stub)
+    return stub
+
+
+@pytest.fixture
+def warm_index(monkeypatch, tmp_path):
+    # Keys are built from DynamoDB items as rebuild_snapshot does, Decimal ids included
+    path = str(tmp_path / "snapshot.bin")
+    write_snapshot(path, [item_key(item['id'], item['file_type']) for item in ITEMS],
+                   [similarity_index.item_vector(item) for item in ITEMS])
+    index = SimilarityIndex(path)
+    monkeypatch.setattr(similarity_index, 'get_index', lambda: index)
+    return index
+
+
+def test_parse_key_round_trips_numeric_ids():
+    assert similarity_index.parse_key(item_key(Decimal(42), 'audio')) == (42, 'audio')
+
+
+def test_search_response_fetches_matches_with_numeric_keys(stub_table, warm_index):
+    response = similarity_index.search_response(['crow'], [2])
+
+    assert response['statusCode'] == 200
+    body = json.loads(response['body'])
+    assert [result['fileId'] for result in body['results']] == [1001, 1002]
+    assert all(isinstance(key['id'], int) for keys in stub_table.requests for key in keys)
+
+    image, video = body['results']
+    assert image['url'] == 'https://g116-thumbnails-s3.s3.ap-southeast-2.amazonaws.com/image/crow_thumb.jpg'
+    assert image['fullUrl'] == 'https://g116-media-s3.s3.ap-southeast-2.amazonaws.com/image/crow.jpg'
+    assert video['url'] == video['fullUrl']
+    assert video['detectedBirds'] == {'crow': 1, 'pigeon': 3}
+    assert body['totalCount'] == 2
+    assert body['summary'] == {'matchingFiles': 2, 'imageCount': 1, 'videoCount': 1, 'audioCount': 0}
+
+
+def test_search_response_without_index(monkeypatch, stub_table):
+    monkeypatch.setattr(similarity_index, 'get_index', lambda: None)
+    assert similarity_index.search_response(['crow'], [1]) is None
+
+
+def test_matches_response_accepts_string_ids_and_skips_missing_items(stub_table):
+    matches = [
+        {'id': '1003', 'file_type': 'audio', 'score': 0.91},
+        {'id': 9999, 'file_type': 'audio', 'score': 0.5},
+    ]
+    response = similarity_index.matches_response(matches, ['kingfisher'], [1], "Found {} recordings")
+
+    body = json.loads(response['body'])
+    assert body['message'] == "Found 1 recordings"
+    assert [(result['fileId'], result['score']) for result in body['results']] == [(1003, 0.91)]
+    assert body['links'] == ['https://g116-media-s3.s3.ap-southeast-2.amazonaws.com/audio/kingfisher.wav']
+
+
+def test_late_delta_with_an_older_key_is_still_applied(monkeypatch):
+    class StubIndex:
+        watermark_ms = 1_000_000
+
+        def __init__(self):
+            self.applied = []
+
+        def apply(self, changes):
+            self.applied.extend(changes)
+
+    deltas = {}
+
+    def list_deltas(start_after):
+        return iter(sorted(key for key in deltas if key > start_after))
+
+    monkeypatch.setattr(similarity_index, '_list_deltas', list_deltas)
+    monkeypatch.setattr(similarity_index, '_read_delta', lambda key: [deltas[key]])
+    monkeypatch.setattr(similarity_index, '_state', {'cursor_ms': 0, 'applied': set()})
+    key = lambda ms, name: f"{similarity_index.delta_prefix}{ms:013d}-{name}.json"
+    index = StubIndex()
+
+    deltas[key(1_000_200, 'a')] = 'a'
+    similarity_index._apply_deltas(index, True)
+    # 'b' was named before 'c' but its PUT finished after the last listing
+    deltas[key(1_000_900, 'c')] = 'c'
+    similarity_index._apply_deltas(index, False)
+    deltas[key(1_000_500, 'b')] = 'b'
+    similarity_index._apply_deltas(index, False)
+    similarity_index._apply_deltas(index, False)
+
+    assert index.applied == ['a', 'c', 'b']
@@ -0,0 +1,104 @@
+import numpy as np
+from species_counting import SpeciesCounter, counter_for
+
+NAMES = {0: 'Crow', 1: 'Pigeon', 2: 'crow', 3: 'Kingfisher'}
+
+
+class StubDetections:
+    """The parts of sv.Detections counting touches: class_id, confidence, data and mask indexing."""
+
+    def __init__(self, class_id, confidence, names=NAMES):
+        self.class_id = np.array(class_id, dtype=int)
+        self.confidence = np.array(confidence, dtype=np.float32)
+        self.data = {'class_name': np.array([names.get(i, str(i)) for i in self.class_id], dtype=object)}
+
+    def __len__(self):
+        return len(self.class_id)
+
+    def __getitem__(self, mask):
+        kept = StubDetections([], [])
+        kept.class_id, kept.confidence = self.class_id[mask], self.confidence[mask]
+        kept.data = {'class_name': self.data['class_name'][mask]}
+        return kept
+
+
+def old_image_count(detections, confidence=0.5):
+    # The per-box dict counting image_prediction used before SpeciesCounter
+    detections = detections[(detections.confidence > confidence)]
+    species_count = {}
+    if len(detections.class_id) > 0:
+        for species in detections.data['class_name']:
+            species = species.lower()
+            species_count[species] = species_count.get(species, 0) + 1
+    return species_count
+
+
+def old_video_count(frames, confidence=0.5):
+    max_species_count = {}
+    for detections in frames:
+        current_count = old_image_count(detections, confidence)
+        for species, count in current_count.items():
+            max_species_count[species] = max(max_species_count.get(species, 0), count)
+    return max_species_count
+
+
+def as_dict(result):
+    assert len(result['tags']) == len(result['counts'])
+    return dict(zip(result['tags'], result['counts']))
+
+
+def test_count_matches_old_counting_with_confidence_cut():
+    counter = SpeciesCounter(NAMES)
+    # 0.5 itself is dropped, as with the old strict > comparison
+    detections = StubDetections([0, 2, 1, 1, 3, 0], [0.9, 0.7, 0.5, 0.51, 0.2, 0.6])
+
+    result = counter.result(counter.count(detections))
+
+    assert as_dict(result) == old_image_count(detections) == {'crow': 3, 'pigeon': 1}
+    assert all(isinstance(count, int) for count in result['counts'])
+
+
+def test_empty_and_all_low_confidence_detections_give_no_tags():
+    counter = SpeciesCounter(NAMES)
+
+    assert counter.result(counter.count(StubDetections([], []))) == {'tags': [], 'counts': []}
+    assert counter.result(counter.count(StubDetections([1, 3], [0.1, 0.5]))) == {'tags': [], 'counts': []}
+
+
+def test_unknown_class_ids_are_named_after_themselves():
+    counter = SpeciesCounter(NAMES)
+    detections = StubDetections([7, 1, 7, 5], [0.9, 0.9, 0.8, 0.95])
+
+    result = counter.result(counter.count(detections))
+
+    assert as_dict(result) == old_image_count(detections) == {'7': 2, 'pigeon': 1, '5': 1}
+    assert counter.tags == ['crow', 'pigeon', 'kingfisher', '4', '5', '6', '7']
+
+
+def test_model_without_names_counts_by_class_id():
+    class Model:
+        names = None
+
+    model = Model()
+    counter = counter_for(model)
+    detections = StubDetections([2, 0, 2], [0.9, 0.9, 0.9], names={})
+
+    assert counter_for(model) is counter
+    assert as_dict(counter.result(counter.count(detections))) == old_image_count(detections) == {'2': 2, '0': 1}
+
+
+def test_running_max_matches_old_video_counting():
+    counter = SpeciesCounter(NAMES)
+    frames = [
+        StubDetections([0, 0, 1], [0.9, 0.8, 0.7]),
+        StubDetections([1, 1, 1, 2], [0.9, 0.9, 0.4, 0.9]),
+        StubDetections([], []),
+        # A class outside the names table grows the tag table mid-video
+        StubDetections([9, 0, 2, 2], [0.9, 0.9, 0.9, 0.9]),
+    ]
+
+    running = None
+    for detections in frames:
+        running = counter.running_max(running, counter.count(detections))
+
+    assert as_dict(counter.result(running)) == old_video_count(frames) == {'crow': 3, 'pigeon': 2, '9': 1}
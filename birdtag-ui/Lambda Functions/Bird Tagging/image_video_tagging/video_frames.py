@@ -0,0 +1,231 @@
+import os
+import queue
+import threading
+import metrics
+
+# === Decode pipeline settings ===
+# "fps" keeps sample_fps frames per second of video, "keyframes" keeps only I-frames
+video_sampling_mode = os.environ.get("VIDEO_SAMPLING", "fps")
+video_sample_fps = float(os.environ.get("VIDEO_SAMPLE_FPS", "1"))
+video_batch_size = int(os.environ.get("VIDEO_BATCH_SIZE", "8"))
+video_queue_size = int(os.environ.get("VIDEO_QUEUE_SIZE", "16"))
+# Gaps (in frames) at least this long are skipped by seeking instead of grab()
+video_seek_min_gap = int(os.environ.get("VIDEO_SEEK_MIN_GAP", "120"))
+
+_END = object()
+
+
+def iter_sampled_frames(video_path, sample_fps=1.0, seek_min_gap=120):
+    """
+    Yield (frame_idx, timestamp_sec, frame) for roughly sample_fps frames per second.
+
+    Skipped frames are only grabbed (demuxed and decoded, never converted to BGR),
+    and long gaps are skipped with a seek.
+    """
+    import cv2 as cv
+
+    cap = cv.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise Exception("Error: couldn't open the video!")
+
+    try:
+        fps = cap.get(cv.CAP_PROP_FPS) or 30.0
+        step = max(1, int(round(fps / sample_fps))) if sample_fps > 0 else 1
+        frame_idx = 0
+        next_idx = 0
+
+        while True:
+            gap = next_idx - frame_idx
+            if gap >= seek_min_gap:
+                cap.set(cv.CAP_PROP_POS_FRAMES, next_idx)
+                frame_idx = int(cap.get(cv.CAP_PROP_POS_FRAMES))
+            while frame_idx < next_idx:
+                if not cap.grab():
+                    return
+                frame_idx += 1
+
+            ret, frame = cap.read()
+            if not ret:
+                return
+            yield frame_idx, frame_idx / fps, frame
+            frame_idx += 1
+            next_idx += step
+    finally:
+        cap.release()
+
+
+def iter_keyframes(source):
+    """Yield (frame_idx, timestamp_sec, frame) for keyframes only, without decoding other frames."""
+    import av
+
+    with av.open(source) as container:
+        stream = container.streams.video[0]
+        stream.codec_context.skip_frame = "NONKEY"
+        fps = float(stream.average_rate or 30)
+        time_base = float(stream.time_base)
+        for frame in container.decode(stream):
+            timestamp = frame.pts * time_base if frame.pts is not None else 0.0
+            yield int(round(timestamp * fps)), timestamp, frame.to_ndarray(format="bgr24")
+
+
+def iter_stream_frames(source, sample_fps=1.0):
+    """
+    Yield (frame_idx, timestamp_sec, frame) for roughly sample_fps frames per second with PyAV.
+
+    Unlike iter_sampled_frames this accepts a file object, so decoding can start on
+    a download that is still in flight. Only sampled frames are converted to BGR.
+    """
+    import av
+
+    with av.open(source) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        fps = float(stream.average_rate or 30)
+        time_base = float(stream.time_base)
+        interval = 1.0 / sample_fps if sample_fps > 0 else 0.0
+        start_time = None
+        next_time = 0.0
+
+        for frame in container.decode(stream):
+            timestamp = frame.pts * time_base if frame.pts is not None else 0.0
+            if start_time is None:
+                start_time = timestamp
+            timestamp -= start_time
+            if timestamp + 1e-6 < next_time:
+                continue
+            if interval:
+                # Next sample is the first point of the sampling grid after this frame
+                next_time += interval * (int((timestamp - next_time) / interval) + 1)
+            yield int(round(timestamp * fps)), timestamp, frame.to_ndarray(format="bgr24")
+
+
+def has_pyav():
+    try:
+        import av  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def probe_video(source):
+    """Return (fps, duration_sec) of a video path or seekable file object; duration is 0.0 if unknown."""
+    if isinstance(source, str):
+        import cv2 as cv
+
+        cap = cv.VideoCapture(source)
+        try:
+            fps = cap.get(cv.CAP_PROP_FPS) or 30.0
+            return fps, max(0.0, cap.get(cv.CAP_PROP_FRAME_COUNT) / fps)
+        finally:
+            cap.release()
+
+    import av
+
+    with av.open(source) as container:
+        stream = container.streams.video[0]
+        fps = float(stream.average_rate or 30)
+        if container.duration:
+            duration = container.duration / av.time_base
+        elif stream.frames:
+            duration = stream.frames / fps
+        else:
+            duration = 0.0
+    source.seek(0)
+    return fps, duration
+
+
+def probe_fps(source):
+    """Return the frame rate of a video path or seekable file object."""
+    return probe_video(source)[0]
+
+
+def sampled_frames(source, mode=None, fps=None):
+    mode = mode or video_sampling_mode
+    sample_fps = fps or video_sample_fps
+    if not isinstance(source, str):
+        # File objects can only be decoded by PyAV
+        return iter_keyframes(source) if mode == "keyframes" else iter_stream_frames(source, sample_fps)
+    if mode == "keyframes":
+        if has_pyav():
+            return iter_keyframes(source)
+        print("PyAV is not installed, falling back to per-second frame sampling.")
+    return iter_sampled_frames(source, sample_fps=sample_fps, seek_min_gap=video_seek_min_gap)
+
+
+class FrameReader(threading.Thread):
+    """
+    Decode frames on a background thread into a bounded queue.
+
+    Decoding runs ahead of inference by at most maxsize frames, so memory stays
+    bounded while the model never waits on the decoder for long.
+    """
+
+    def __init__(self, frames, maxsize=16):
+        super().__init__(daemon=True)
+        self.frames = frames
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self._stopped = threading.Event()
+
+    def _put(self, item):
+        # Returns False once the consumer has gone away
+        while not self._stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self):
+        try:
+            for item in self.frames:
+                if not self._put(item):
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            close = getattr(self.frames, 'close', None)
+            if close is not None:
+                close()
+            self._put(_END)
+
+    def stop(self):
+        self._stopped.set()
+        # Drain so a blocked producer can observe the stop flag and exit
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def __iter__(self):
+        while True:
+            # Time spent waiting on the decoder thread
+            with metrics.stage("decode"):
+                item = self.queue.get()
+            if item is _END:
+                break
+            metrics.count("frames_sampled")
+            yield item
+        if self.error is not None:
+            raise self.error
+
+
+def iter_frame_batches(source, batch_size=None, mode=None, fps=None, maxsize=None):
+    """Yield lists of (frame_idx, timestamp_sec, frame) decoded on a background thread."""
+    batch_size = batch_size or video_batch_size
+    reader = FrameReader(sampled_frames(source, mode=mode, fps=fps), maxsize=maxsize or video_queue_size)
+    reader.start()
+    try:
+        batch = []
+        for item in reader:
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        reader.stop()
+        reader.join(timeout=5)
@@ -0,0 +1,142 @@
+import os
+import numpy as np
+import video_frames
+import species_counting
+
+# === Video counting settings ===
+# "max_frame" reports the largest per-frame count of each species,
+# "tracks" counts distinct tracked individuals over the whole clip
+video_count_mode = os.environ.get("VIDEO_COUNT_MODE", "max_frame")
+# Tracking sample rate; consecutive samples must overlap enough for the tracker to associate boxes
+track_max_fps = float(os.environ.get("VIDEO_TRACK_FPS", "5"))
+# Below this rate identities no longer carry between samples, so counting falls back to per-frame maxima
+track_min_fps = float(os.environ.get("VIDEO_TRACK_MIN_FPS", "2"))
+# Compute budget: the most frames the detector runs on for one clip
+track_max_frames = int(os.environ.get("VIDEO_MAX_DETECT_FRAMES", "900"))
+# After this many sampled frames with nothing detected, only every idle_stride-th frame is detected
+track_idle_after = int(os.environ.get("VIDEO_IDLE_AFTER_FRAMES", "5"))
+track_idle_stride = int(os.environ.get("VIDEO_IDLE_STRIDE", "4"))
+# Tracks detected in fewer frames than this are treated as noise
+track_min_hits = int(os.environ.get("VIDEO_TRACK_MIN_HITS", "2"))
+
+
+def counting_version(count_mode=None):
+    """Suffix for detection cache versions of video results, since counts depend on the counting settings."""
+    if (count_mode or video_count_mode) != "tracks":
+        return ""
+    return f":tracks:{track_max_fps}:{track_min_fps}:{track_max_frames}:{track_min_hits}"
+
+
+def plan_sampling(source, max_fps=None, min_fps=None, max_frames=None):
+    """
+    Pick the tracking sample rate for a clip: max_fps, lowered so the clip fits the frame budget.
+
+    Returns (sample_fps, tracking); tracking is False when the budget pushes the rate
+    below min_fps.
+    """
+    max_fps = max_fps or track_max_fps
+    min_fps = min_fps or track_min_fps
+    max_frames = max_frames or track_max_frames
+
+    native_fps, duration = video_frames.probe_video(source)
+    sample_fps = min(max_fps, native_fps)
+    if duration > 0:
+        sample_fps = min(sample_fps, max_frames / duration)
+    return sample_fps, sample_fps >= min(min_fps, native_fps)
+
+
+class TrackTally:
+    """Per-track species votes and first/last-seen times, folded into per-species results."""
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.tracks = {}
+
+    def update(self, detections, timestamp, confidence=0.5):
+        """Record one tracked frame; returns the number of boxes above confidence."""
+        detections = detections[(detections.confidence > confidence)]
+        if len(detections) == 0 or detections.tracker_id is None:
+            return 0
+        tags = self.counter.tag_indices(detections.class_id)
+        for tracker_id, tag in zip(detections.tracker_id.tolist(), tags.tolist()):
+            track = self.tracks.get(tracker_id)
+            if track is None:
+                track = self.tracks[tracker_id] = {"votes": {}, "first_seen": timestamp, "last_seen": timestamp, "hits": 0}
+            track["votes"][tag] = track["votes"].get(tag, 0) + 1
+            track["last_seen"] = timestamp
+            track["hits"] += 1
+        return len(detections)
+
+    def result(self, min_hits=None):
+        """
+        Return {"tags", "counts", "first_seen_ms", "last_seen_ms"}.
+
+        Each track counts once, under the species it was most often classified as.
+        """
+        min_hits = min_hits or track_min_hits
+        size = len(self.counter)
+        counts = np.zeros(size, dtype=np.int64)
+        first_seen = np.full(size, np.inf)
+        last_seen = np.full(size, -np.inf)
+        for track in self.tracks.values():
+            if track["hits"] < min_hits:
+                continue
+            tag = max(track["votes"], key=track["votes"].get)
+            counts[tag] += 1
+            first_seen[tag] = min(first_seen[tag], track["first_seen"])
+            last_seen[tag] = max(last_seen[tag], track["last_seen"])
+
+        result = self.counter.result(counts)
+        present = np.flatnonzero(counts)
+        result["first_seen_ms"] = [int(round(first_seen[i] * 1000)) for i in present]
+        result["last_seen_ms"] = [int(round(last_seen[i] * 1000)) for i in present]
+        return result
+
+
+def count_tracks(source, model, sample_fps, confidence=0.5, batch_size=None, max_frames=None, preview=None):
+    """
+    Count distinct tracked individuals per species in a video.
+
+    Frames are sampled at sample_fps and the detector runs on at most max_frames of
+    them; while nothing is in view only every idle_stride-th sampled frame is detected.
+    preview, a previews.PreviewBuilder, is handed the detected frames.
+    """
+    import supervision as sv
+
+    max_frames = max_frames or track_max_frames
+    counter = species_counting.counter_for(model)
+    tally = TrackTally(counter)
+    # ByteTrack sizes its lost-track buffer in processed frames, so give it the sampled rate
+    tracker = sv.ByteTrack(frame_rate=max(1, int(round(sample_fps))))
+
+    detected = 0
+    idle = 0
+    sampled = 0
+    batches = video_frames.iter_frame_batches(source, batch_size=batch_size, mode="fps", fps=sample_fps)
+    try:
+        for batch in batches:
+            first = sampled
+            sampled += len(batch)
+            if idle >= track_idle_after:
+                # Nothing in view lately, so only look at every idle_stride-th frame until a bird appears
+                batch = [item for n, item in enumerate(batch, first) if n % track_idle_stride == 0]
+            if not batch:
+                continue
+            batch = batch[:max_frames - detected]
+
+            tracked = []
+            for (_, timestamp, _), detections in zip(batch, model.detect([frame for _, _, frame in batch])):
+                detections = tracker.update_with_detections(detections=detections)
+                idle = 0 if tally.update(detections, timestamp, confidence) else idle + 1
+                tracked.append(detections)
+            if preview is not None:
+                preview.add_frames(batch, tracked)
+
+            detected += len(batch)
+            if detected >= max_frames:
+                print(f"Video frame budget of {max_frames} reached at {batch[-1][1]:.1f}s")
+                break
+    finally:
+        batches.close()
+
+    return tally.result()
@@ -245,18 +245,18 @@ async function deleteFileCompletely(file) {
       }
     }
 
-    // Step 2: Delete thumbnail from S3 (if it's an image)
-    if (file.file_type === 'image' && file.s3_thumbnail_url) {
+    // Step 2: Delete previews from S3 (thumbnails of any file type, video keyframe strips, detection crops)
+    for (const [label, url] of previewUrls(file)) {
       try {
-        const thumbS3Info = parseS3Url(file.s3_thumbnail_url);
-        if (thumbS3Info) {
-          await deleteFromS3(thumbS3Info.bucket, thumbS3Info.key);
-          deletedFrom.push(`S3 Thumbnail: ${thumbS3Info.bucket}/${thumbS3Info.key}`);
-          console.log(`✓ Deleted thumbnail from S3: ${thumbS3Info.key}`);
+        const previewS3Info = parseS3Url(url);
+        if (previewS3Info) {
+          await deleteFromS3(previewS3Info.bucket, previewS3Info.key);
+          deletedFrom.push(`S3 ${label}: ${previewS3Info.bucket}/${previewS3Info.key}`);
+          console.log(`✓ Deleted ${label.toLowerCase()} from S3: ${previewS3Info.key}`);
         }
       } catch (s3Error) {
-        console.warn(`Failed to delete thumbnail from S3: ${s3Error.message}`);
-        // Continue with database deletion even if thumbnail deletion fails
+        console.warn(`Failed to delete ${label.toLowerCase()} from S3: ${s3Error.message}`);
+        // Continue with database deletion even if a preview deletion fails
       }
     }
 
@@ -286,6 +286,22 @@ async function deleteFileCompletely(file) {
   }
 }
 
+// Preview objects an item references: s3_thumbnail_url, s3_strip_url and s3_crop_urls (see previews.py)
+function previewUrls(file) {
+  const urls = [];
+  if (file.s3_thumbnail_url) {
+    urls.push(['Thumbnail', file.s3_thumbnail_url]);
+  }
+  if (file.s3_strip_url) {
+    urls.push(['Strip', file.s3_strip_url]);
+  }
+  for (const url of file.s3_crop_urls || []) {
+    urls.push(['Crop', url]);
+  }
+  // The media object itself is deleted in step 1
+  return urls.filter(([, url]) => url && url !== file.s3_url);
+}
+
 // Delete object from S3
 async function deleteFromS3(bucket, key) {
   const deleteParams = {
@@ -5,11 +5,53 @@ const {
   UpdateCommand,
   GetCommand,
   PutCommand,
+  BatchWriteCommand,
 } = require("@aws-sdk/lib-dynamodb");
 const rawClient = new DynamoDBClient({ region: "ap-southeast-2" });
 const docClient = DynamoDBDocumentClient.from(rawClient);
 const BIRDS_TABLE = "birds_table";
 const IDEMPOTENCY_TABLE = "idempotency_data";
+// Inverted index read by TagBasedFileSearch.js (see tag_index.py)
+const TAG_INDEX_TABLE = process.env.TAG_INDEX_TABLE || "birds_tag_index";
+const COUNT_WIDTH = 10;
+
+// Same rows as index_rows in tag_index.py: one per (tag, count, item), sort key
+// "<zero-padded count>#<id>#<file_type>"
+function indexRows(id, file_type, tags, counts) {
+  const rows = new Map();
+  for (let i = 0; i < Math.min(tags.length, counts.length); i++) {
+    if (!tags[i]) continue;
+    const tag = String(tags[i]).toLowerCase();
+    const count = parseInt(counts[i]);
+    const count_key = `${String(count).padStart(COUNT_WIDTH, "0")}#${id}#${file_type}`;
+    rows.set(`${tag}#${count_key}`, { tag, count_key, id, file_type, count });
+  }
+  return rows;
+}
+
+// Replace the index rows of the item's previous tags and counts with those of the new ones
+async function updateTagIndex(id, file_type, previous, current) {
+  const oldRows = indexRows(id, file_type, previous.tags, previous.counts);
+  const newRows = indexRows(id, file_type, current.tags, current.counts);
+  const requests = [];
+  for (const [key, row] of oldRows) {
+    if (!newRows.has(key)) {
+      requests.push({ DeleteRequest: { Key: { tag: row.tag, count_key: row.count_key } } });
+    }
+  }
+  for (const row of newRows.values()) {
+    requests.push({ PutRequest: { Item: row } });
+  }
+  // BatchWrite takes at most 25 requests
+  for (let start = 0; start < requests.length; start += 25) {
+    let requestItems = { [TAG_INDEX_TABLE]: requests.slice(start, start + 25) };
+    while (requestItems && Object.keys(requestItems).length > 0) {
+      const result = await docClient.send(new BatchWriteCommand({ RequestItems: requestItems }));
+      requestItems = result.UnprocessedItems;
+    }
+  }
+}
+
 exports.handler = async (event) => {
   try {
     let body;
@@ -54,8 +96,9 @@ exports.handler = async (event) => {
         continue;
       }
       // Proceed with tag operation
-      let currentTags = match.tags || [];
-      let currentCounts = match.counts || [];
+      const previous = { tags: [...(match.tags || [])], counts: [...(match.counts || [])] };
+      let currentTags = [...previous.tags];
+      let currentCounts = [...previous.counts];
       if (currentCounts.length < currentTags.length) {
         currentCounts = Array(currentTags.length).fill(1);
       }
@@ -114,6 +157,12 @@ exports.handler = async (event) => {
       };
       console.log(`Updating bird record ID ${id} - ${file_type}`);
       await docClient.send(new UpdateCommand(updateParams));
+      // Keep count search in step with the edited tags
+      try {
+        await updateTagIndex(id, file_type, previous, { tags: currentTags, counts: currentCounts });
+      } catch (err) {
+        console.error(`Failed to update tag index for ${id}-${file_type}:`, err);
+      }
       // Store idempotency entry with TTL (1 hour)
       const ttl = Math.floor(Date.now() / 1000) + 30;
       await docClient.send(
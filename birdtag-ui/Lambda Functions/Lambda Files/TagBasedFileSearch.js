@@ -1,10 +1,14 @@
 const { DynamoDBClient } = require("@aws-sdk/client-dynamodb");
-const { DynamoDBDocumentClient, ScanCommand } = require("@aws-sdk/lib-dynamodb");
+const { DynamoDBDocumentClient, QueryCommand, BatchGetCommand } = require("@aws-sdk/lib-dynamodb");
 
 // Initialize DynamoDB client
 const client = new DynamoDBClient({ region: 'ap-southeast-2' });
 const dynamodb = DynamoDBDocumentClient.from(client);
 
+const BIRDS_TABLE = 'birds_table';
+// Inverted index maintained by the tagging Lambdas (see tag_index.py)
+const TAG_INDEX_TABLE = process.env.TAG_INDEX_TABLE || 'birds_tag_index';
+
 exports.handler = async (event) => {
   try {
     let searchCriteria = {};
@@ -50,26 +54,42 @@ exports.handler = async (event) => {
       };
     }
 
-    // Query your birds_table - get image, video, and audio files
-    const scanParams = {
-      TableName: 'birds_table',
-      FilterExpression: 'attribute_exists(tags) AND (file_type = :imageType OR file_type = :videoType OR file_type = :audioType)',
-      ExpressionAttributeValues: {
-        ':imageType': 'image',
-        ':videoType': 'video',
-        ':audioType': 'audio'
-      }
-    };
+    // Look up candidates in the inverted tag index: one key-range Query per species
+    // (count_key = "<zero-padded count>#<id>#<file_type>", so >= "<min count>#" means count >= min)
+    const candidateKeys = new Map();
+    for (const [species, minCount] of Object.entries(searchCriteria)) {
+      let exclusiveStartKey;
+      do {
+        const queryResult = await dynamodb.send(new QueryCommand({
+          TableName: TAG_INDEX_TABLE,
+          KeyConditionExpression: 'tag = :tag AND count_key >= :minKey',
+          ExpressionAttributeValues: {
+            ':tag': species,
+            ':minKey': `${String(minCount).padStart(10, '0')}#`
+          },
+          ProjectionExpression: 'id, file_type',
+          ExclusiveStartKey: exclusiveStartKey
+        }));
+        for (const row of queryResult.Items) {
+          candidateKeys.set(`${row.id}#${row.file_type}`, { id: row.id, file_type: row.file_type });
+        }
+        exclusiveStartKey = queryResult.LastEvaluatedKey;
+      } while (exclusiveStartKey);
+    }
+    console.log(`Tag index returned ${candidateKeys.size} candidate files`);
 
-    console.log('Scanning DynamoDB with params:', JSON.stringify(scanParams));
-    const command = new ScanCommand(scanParams);
-    const result = await dynamodb.send(command);
-    console.log(`Found ${result.Items.length} files in database`);
-    
-    // Debug: Log the first item to see the data structure
-    if (result.Items.length > 0) {
-      console.log('Sample item structure:', JSON.stringify(result.Items[0], null, 2));
+    // Fetch the candidate items from birds_table, 100 keys per BatchGet
+    const result = { Items: [] };
+    const keys = Array.from(candidateKeys.values());
+    for (let start = 0; start < keys.length; start += 100) {
+      let requestItems = { [BIRDS_TABLE]: { Keys: keys.slice(start, start + 100) } };
+      while (requestItems && Object.keys(requestItems).length > 0) {
+        const batchResult = await dynamodb.send(new BatchGetCommand({ RequestItems: requestItems }));
+        result.Items.push(...(batchResult.Responses[BIRDS_TABLE] || []));
+        requestItems = batchResult.UnprocessedKeys;
+      }
     }
+    console.log(`Found ${result.Items.length} files in database`);
     
     // Filter results based on search criteria (OR logic - matches any species)
     const matchingFiles = result.Items.filter(file => {
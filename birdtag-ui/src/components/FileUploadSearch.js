@@ -16,6 +16,10 @@ function FileTagSearch() {
   const API_AUDIO = 'https://ns03wx51yk.execute-api.ap-southeast-2.amazonaws.com/fileBasedTagAudio/FileBasedTagAudioAPI';
   const API_LAMBDA_QUERY = 'https://l1fqf07eb1.execute-api.ap-southeast-2.amazonaws.com/returnfilebasedquery/returnfilebasedqueryAPI';
 
+  // Small images are sent inline as base64; everything else is uploaded to S3 and passed by reference
+  const INLINE_UPLOAD_MAX_BYTES = 1 * 1024 * 1024;
+  const MAX_FILE_BYTES = 100 * 1024 * 1024;
+
   const handleFileChange = (e) => {
     const selectedFile = e.target.files[0];
     if (!selectedFile) return;
@@ -102,8 +106,8 @@ function FileTagSearch() {
       return;
     }
 
-    if (file.size > 5 * 1024 * 1024) {
-      setStatus('File too large. Please select a file smaller than 5MB.');
+    if (file.size > MAX_FILE_BYTES) {
+      setStatus('File too large. Please select a file smaller than 100MB.');
       return;
     }
 
@@ -115,23 +119,63 @@ function FileTagSearch() {
     setStatus('Processing your file...');
 
     try {
-      const reader = new FileReader();
-      reader.onloadend = async () => {
-        try {
-          const base64Content = reader.result.split(',')[1]; 
-
-          if (base64Content.length > 7000000) {
-            setStatus('File content too large after encoding. Please select a smaller file.');
-            return;
-          }
-
-          const payload = {
-            file_name: file.name,
-            file_type: fileType,
-            file_content: base64Content
-          };
+      const useInlineUpload = fileType === 'image' && file.size <= INLINE_UPLOAD_MAX_BYTES;
 
+      const analyzeAndSearch = async (base64Content) => {
+        try {
           const apiUrl = (fileType === 'audio') ? API_AUDIO : API_IMAGE_VIDEO;
+          let payload;
+
+          if (base64Content) {
+            payload = {
+              file_name: file.name,
+              file_type: fileType,
+              file_content: base64Content
+            };
+          } else {
+            // Reference flow: get a presigned URL, PUT the file to S3, then query by s3_url
+            setStatus('Uploading file for analysis...');
+            const urlResponse = await fetch(apiUrl, {
+              method: 'POST',
+              headers: { 
+                'Content-Type': 'application/json', 
+                'Authorization': `Bearer ${token}`
+              },
+              body: JSON.stringify({
+                action: 'upload_url',
+                file_name: file.name,
+                file_type: fileType,
+                content_type: file.type
+              })
+            });
+
+            if (!urlResponse.ok) {
+              setStatus(`Error requesting upload URL (${urlResponse.status})`);
+              return;
+            }
+
+            let upload = await urlResponse.json();
+            if (upload.body) {
+              upload = typeof upload.body === 'string' ? JSON.parse(upload.body) : upload.body;
+            }
+
+            const putResponse = await fetch(upload.upload_url, {
+              method: 'PUT',
+              headers: { 'Content-Type': file.type },
+              body: file
+            });
+
+            if (!putResponse.ok) {
+              setStatus(`Error uploading file (${putResponse.status})`);
+              return;
+            }
+
+            payload = {
+              file_name: file.name,
+              file_type: fileType,
+              s3_url: upload.s3_url
+            };
+          }
           
           setStatus('Analyzing file to detect bird species...');
 
@@ -215,11 +259,16 @@ function FileTagSearch() {
         }
       };
 
-      reader.onerror = () => {
-        setStatus('Error reading file.');
-      };
-
-      reader.readAsDataURL(file);
+      if (useInlineUpload) {
+        const reader = new FileReader();
+        reader.onloadend = () => analyzeAndSearch(reader.result.split(',')[1]);
+        reader.onerror = () => {
+          setStatus('Error reading file.');
+        };
+        reader.readAsDataURL(file);
+      } else {
+        await analyzeAndSearch(null);
+      }
     } catch (error) {
       console.error('File processing failed:', error);
       setStatus(`Failed to process file: ${error.message}`);
@@ -266,7 +315,7 @@ function FileTagSearch() {
         <div className="file-info-container">
           <strong>File Info:</strong><br/>
           Name: {file.name} ({fileType})<br/>
-          Size: {formatFileSize(file.size)} {file.size > 5 * 1024 * 1024 && 'Too large!'}
+          Size: {formatFileSize(file.size)} {file.size > MAX_FILE_BYTES && 'Too large!'}
         </div>
       )}
 